@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+"""
+Load test of the worker, run against an in-process stand-in for the
+message broker and a local fake backend that also accepts notification
+websockets. A configurable mix of generated models is replayed, and
+throughput, latency percentiles and resource usage are reported.
+
+Usage: python benchmarks/loadtest.py [--tasks 50] [--mix cvxpy:1000:3 pyomo:1000:1:5]
+                                     [--users 1] [--workers 4] [--rate 0] [--latency 0]
+                                     [--cancel 0.1] [--cancel-after 1]
+"""
+import os
+import re
+import sys
+import json
+import time
+import base64
+import types
+import struct
+import random
+import hashlib
+import argparse
+import resource
+import threading
+import collections
+import importlib.util
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pika
+import stub
+from models import models
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+class Method:
+    """
+    Delivery of the in-process broker.
+    """
+
+    def __init__(self, delivery_tag, routing_key):
+
+        self.delivery_tag = delivery_tag
+        self.routing_key = routing_key
+        self.redelivered = False
+
+class InProcessConnection:
+    """
+    In-process stand-in for a pika BlockingConnection and its channel,
+    with the calls used by the worker. Messages are delivered on the
+    thread that calls start_consuming, up to the prefetch count of each
+    consumer that acks, or of the channel with global_qos, highest priority
+    first. Exchanges are fanout.
+
+    Parameters
+    ----------
+    on_ack : function called with the body of acked messages
+    """
+
+    def __init__(self, on_ack=None):
+
+        self.on_ack = on_ack
+        self.cond = threading.Condition()
+        self.queues = collections.defaultdict(collections.deque)
+        self.consumers = {}
+        self.auto_ack = set()
+        self.bindings = collections.defaultdict(set)
+        self.callbacks = collections.deque()
+        self.unacked = {}
+        self.prefetch = 0
+        self.global_qos = False
+        self.next_tag = 1
+        self.stopped = False
+        self.is_open = True
+
+    def channel(self):
+        return self
+
+    def exchange_declare(self, exchange, **kwargs):
+        with self.cond:
+            self.bindings[exchange]
+
+    def queue_declare(self, queue, **kwargs):
+        with self.cond:
+            if not queue:
+                queue = 'amq.gen-%d' %len(self.queues)
+            self.queues[queue]
+        return types.SimpleNamespace(method=types.SimpleNamespace(queue=queue))
+
+    def queue_bind(self, queue, exchange, **kwargs):
+        with self.cond:
+            self.bindings[exchange].add(queue)
+
+    def basic_qos(self, prefetch_count=0, global_qos=False, **kwargs):
+        self.prefetch = prefetch_count
+        self.global_qos = global_qos
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, **kwargs):
+        with self.cond:
+            self.consumers[queue] = on_message_callback
+            if auto_ack:
+                self.auto_ack.add(queue)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, **kwargs):
+        with self.cond:
+            queues = self.bindings[exchange] if exchange else [routing_key]
+            for queue in queues:
+                self.queues[queue].append((body, properties or pika.BasicProperties()))
+            self.cond.notify_all()
+
+    def basic_ack(self, delivery_tag, **kwargs):
+        with self.cond:
+            body, properties, queue = self.unacked.pop(delivery_tag)
+            self.cond.notify_all()
+        if self.on_ack is not None:
+            self.on_ack(body)
+
+    def add_callback_threadsafe(self, callback):
+        with self.cond:
+            self.callbacks.append(callback)
+            self.cond.notify_all()
+
+    def __ready__(self):
+
+        counts = collections.Counter(q for _, _, q in self.unacked.values())
+        def full(queue):
+            if not self.prefetch or queue in self.auto_ack:
+                return False
+            n = len(self.unacked) if self.global_qos else counts[queue]
+            return n >= self.prefetch
+        return [q for q in self.consumers if self.queues[q] and not full(q)]
+
+    def __work__(self):
+
+        if self.callbacks:
+            return self.callbacks.popleft()
+        for queue in self.__ready__():
+            on_message = self.consumers[queue]
+            messages = self.queues[queue]
+            i = max(range(len(messages)), key=lambda i: (messages[i][1].priority or 0, -i))
+            body, properties = messages[i]
+            del messages[i]
+            method = Method(self.next_tag, queue)
+            if queue not in self.auto_ack:
+                self.unacked[self.next_tag] = (body, properties, queue)
+            self.next_tag += 1
+            return lambda: on_message(self, method, properties, body)
+        return None
+
+    def __peek__(self):
+
+        return bool(self.callbacks or self.__ready__())
+
+    def start_consuming(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.stopped or self.__peek__())
+                if self.stopped:
+                    return
+                work = self.__work__()
+            if work is not None:
+                work()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+class FakeBackend:
+    """
+    Local fake of the MOS backend REST API and notification websockets,
+    serving generated models and recording what the worker sends.
+
+    Parameters
+    ----------
+    latency : delay added to each REST request, in seconds (float)
+    """
+
+    def __init__(self, latency=0.):
+
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.models = {}
+        self.recipes = {}
+        self.statuses = {}
+        self.requests = 0
+        self.states = 0
+        self.notifications = 0
+
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if self.headers.get('Upgrade', '').lower() == 'websocket':
+                    backend.__websocket__(self)
+                else:
+                    backend.__handle__(self, 'get')
+
+            def do_POST(self):
+                backend.__handle__(self, 'post')
+
+            def do_PUT(self):
+                backend.__handle__(self, 'put')
+
+            def do_DELETE(self):
+                backend.__handle__(self, 'delete')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.url = 'http://127.0.0.1:%d/api/' %self.port
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def add_model(self, id, system, spec):
+        """
+        Adds generated model.
+
+        Parameters
+        ----------
+        id : model id (integer)
+        system : modeling system (string)
+        spec : generated model, see models.py (dictionary)
+        """
+
+        self.models[id] = stub.model_data(system,
+                                          variables=spec['variables'],
+                                          functions=spec['functions'],
+                                          constraints=spec['constraints'],
+                                          problem=spec['problem'],
+                                          solver=spec['solver'],
+                                          base_url=self.url,
+                                          id=id)
+        self.recipes[id] = spec['recipe']
+
+    def __handle__(self, handler, method):
+
+        n = int(handler.headers.get('Content-Length', 0))
+        body = handler.rfile.read(n) if n else b''
+        path = handler.path.split('?')[0]
+        if self.latency:
+            time.sleep(self.latency)
+
+        data = None
+        with self.lock:
+            self.requests += 1
+            m = re.match(r'/api/model/(\d+)/(\w*)/?$', path)
+            if path == '/api/authenticate/':
+                data = {'key': 'token'}
+            elif m and m.group(2) == '' and method == 'get':
+                data = self.models.get(int(m.group(1)))
+            elif m and m.group(2) == 'write':
+                data = self.recipes.get(int(m.group(1)))
+            elif m and m.group(2) == 'set_status':
+                self.statuses[int(m.group(1))] = json.loads(body)
+            elif path.endswith('/bulk_create/'):
+                self.states += len(json.loads(body))
+
+        content = json.dumps(data).encode()
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    def __websocket__(self, handler):
+
+        key = handler.headers['Sec-WebSocket-Key']
+        accept = base64.b64encode(hashlib.sha1((key+WS_GUID).encode()).digest()).decode()
+        handler.send_response(101)
+        handler.send_header('Upgrade', 'websocket')
+        handler.send_header('Connection', 'Upgrade')
+        handler.send_header('Sec-WebSocket-Accept', accept)
+        handler.end_headers()
+        handler.wfile.flush()
+        handler.close_connection = True
+
+        # Read client frames until closed
+        f = handler.rfile
+        while True:
+            header = f.read(2)
+            if len(header) < 2:
+                break
+            opcode = header[0] & 0x0f
+            n = header[1] & 0x7f
+            if n == 126:
+                n = struct.unpack('>H', f.read(2))[0]
+            elif n == 127:
+                n = struct.unpack('>Q', f.read(8))[0]
+            if header[1] & 0x80:
+                f.read(4)
+            f.read(n)
+            if opcode == 8:
+                break
+            if opcode == 1:
+                with self.lock:
+                    self.notifications += 1
+
+def percentile(values, q):
+
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values)-1, int(round(q/100.*(len(values)-1))))]
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Load test of the worker')
+    parser.add_argument('--tasks', type=int, default=50,
+                        help='number of tasks')
+    parser.add_argument('--mix', nargs='+', default=['cvxpy:1000'],
+                        help='task mix as system:size[:weight[:priority]] entries')
+    parser.add_argument('--users', type=int, default=1,
+                        help='number of users tasks are spread over')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('MOS_COMPUTE_WORKERS', 2)),
+                        help='model execution slots of the worker')
+    parser.add_argument('--rate', type=float, default=0.,
+                        help='tasks published per second (0 publishes all at once)')
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='delay of each backend request in seconds')
+    parser.add_argument('--cancel', type=float, default=0.,
+                        help='fraction of tasks cancelled after being published')
+    parser.add_argument('--cancel-after', type=float, default=1.,
+                        help='delay of cancellations in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true',
+                        help='show worker and model output')
+    parser.add_argument('--json', help='file where task results are saved')
+    args = parser.parse_args()
+
+    # Task mix
+    mix = []
+    for entry in args.mix:
+        parts = entry.split(':')
+        mix.append((parts[0], int(parts[1]) if len(parts) > 1 else 1000,
+                    float(parts[2]) if len(parts) > 2 else 1.,
+                    int(parts[3]) if len(parts) > 3 else 0))
+    rng = random.Random(args.seed)
+    choices = rng.choices(mix, weights=[w for _, _, w, _ in mix], k=args.tasks)
+    users = [rng.randrange(args.users)+1 for i in range(args.tasks)]
+    cancels = set(i+1 for i in rng.sample(range(args.tasks), int(round(args.cancel*args.tasks))))
+
+    # Fake backend
+    backend = FakeBackend(args.latency)
+    specs = {}
+    for i, (system, size, _, _) in enumerate(choices):
+        if (system, size) not in specs:
+            specs[(system, size)] = models[system](size)
+        backend.add_model(i+1, system, specs[(system, size)])
+    backend.start()
+
+    os.environ['MOS_BACKEND_HOST'] = '127.0.0.1'
+    os.environ['MOS_BACKEND_PORT'] = str(backend.port)
+    os.environ['MOS_BACKEND_TOKEN'] = 'token'
+    os.environ['MOS_COMPUTE_WORKERS'] = str(args.workers)
+    os.environ.setdefault('NO_PROXY', '127.0.0.1')
+
+    # Keep report on stdout, silence worker and models
+    out = os.fdopen(os.dup(1), 'w')
+    if not args.verbose:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        sys.stdout.flush()
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+
+    spec = importlib.util.spec_from_file_location('worker', os.path.join(ROOT, 'workers', 'worker.py'))
+    worker = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(worker)
+
+    # Broker stand-in
+    published = {}
+    finished = {}
+    done = threading.Event()
+    def on_ack(body):
+        task = json.loads(body)
+        finished[task['model_id']] = time.perf_counter()
+        if len(finished) == args.tasks:
+            done.set()
+    connection = InProcessConnection(on_ack)
+    consumer = threading.Thread(target=worker.main, args=(connection,))
+
+    cpu = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    consumer.start()
+
+    def cancel(model_id):
+        connection.basic_publish(exchange='mos-python.cancel',
+                                 routing_key='',
+                                 body=json.dumps({'model_id': model_id, 'cancelled_at': time.time()}),
+                                 properties=pika.BasicProperties(timestamp=int(time.time())))
+
+    for i, (system, size, _, priority) in enumerate(choices):
+        published[i+1] = time.perf_counter()
+        connection.basic_publish(exchange='',
+                                 routing_key='mos-python.%s' %system,
+                                 body=json.dumps({'model_id': i+1,
+                                                  'model_name': 'benchmark-%d' %(i+1),
+                                                  'caller_id': users[i]}),
+                                 properties=pika.BasicProperties(timestamp=int(time.time()),
+                                                                 headers={'timestamp_in_ms': int(time.time()*1000)},
+                                                                 priority=priority))
+        if i+1 in cancels:
+            timer = threading.Timer(args.cancel_after, cancel, args=(i+1,))
+            timer.daemon = True
+            timer.start()
+        if args.rate:
+            time.sleep(max(0., start+(i+1)/args.rate-time.perf_counter()))
+    done.wait()
+    elapsed = time.perf_counter()-start
+
+    connection.stop()
+    consumer.join()
+    backend.stop()
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    # Report
+    results = []
+    for i, (system, size, _, priority) in enumerate(choices):
+        results.append(dict(system=system,
+                            size=size,
+                            priority=priority,
+                            user=users[i],
+                            status=backend.statuses.get(i+1),
+                            latency=finished[i+1]-published[i+1]))
+    statuses = collections.Counter(r['status'] for r in results)
+    print('Tasks:          %d (%s)' %(args.tasks, ', '.join('%s %d' %x for x in statuses.items())), file=out)
+    print('Workers:        %d' %args.workers, file=out)
+    print('Elapsed:        %.3fs' %elapsed, file=out)
+    print('Throughput:     %.2f tasks/s' %(args.tasks/elapsed), file=out)
+    groups = [('all', results)]
+    if len(mix) > 1:
+        groups += [('%s:%d:%d' %(s, n, p), [r for r in results
+                                            if (r['system'], r['size'], r['priority']) == (s, n, p)])
+                   for s, n, _, p in mix]
+    for name, group in groups:
+        latency = [r['latency'] for r in group]
+        print('Latency %-14s p50 %8.3fs  p90 %8.3fs  p99 %8.3fs  max %8.3fs' %(
+            name, percentile(latency, 50), percentile(latency, 90), percentile(latency, 99),
+            max(latency) if latency else float('nan')), file=out)
+    print('CPU worker:     %.2fs user, %.2fs system' %(self_usage.ru_utime-cpu.ru_utime,
+                                                      self_usage.ru_stime-cpu.ru_stime), file=out)
+    print('CPU tasks:      %.2fs user, %.2fs system' %(children.ru_utime, children.ru_stime), file=out)
+    print('Peak RSS:       %.1f MB worker, %.1f MB largest task process' %(
+        self_usage.ru_maxrss/1024, children.ru_maxrss/1024), file=out)
+    print('Backend:        %d requests, %d states, %d notifications' %(
+        backend.requests, backend.states, backend.notifications), file=out)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
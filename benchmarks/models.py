@@ -0,0 +1,174 @@
+import math
+
+# Number of vectors of list components
+LIST_LENGTH = 10
+
+def _dims(n):
+
+    return n, max(int(math.isqrt(n)), 1), max(n//LIST_LENGTH, 1)
+
+def cvxpy_model(n):
+    """
+    Generated cvxpy model with scalar, vector, matrix and list variables
+    and expressions, and scalar, vector and matrix constraints of about n
+    elements each.
+    """
+
+    n, m, k = _dims(n)
+    recipe = '''
+import cvxpy as cp
+import numpy as np
+
+s = cp.Variable()
+x = cp.Variable({n}, nonneg=True)
+xm = cp.Variable(({m}, {m}))
+xl = [cp.Variable({k}) for i in range({l})]
+lx = {{i: 'x%d' %i for i in range({n})}}
+
+g = 2*s
+f = 2*x
+fm = xm+1
+fl = [2*v for v in xl]
+
+cs = s >= 1
+cx = x >= np.arange({n})
+cm = xm == 1
+cl = [v >= 1 for v in xl]
+
+p = cp.Problem(cp.Minimize(s+cp.sum(x)+cp.sum(xm)+sum(cp.sum(v) for v in xl)),
+               [cs, cx, cm]+cl)
+solver = 'HIGHS' if 'HIGHS' in cp.installed_solvers() else None
+p.solve(solver=solver)
+'''.format(n=n, m=m, k=k, l=LIST_LENGTH)
+
+    return dict(recipe=recipe,
+                variables=[('s', None), ('x', 'lx'), ('xm', None), ('xl', None)],
+                functions=[('g', None), ('f', 'lx'), ('fm', None), ('fl', None)],
+                constraints=[('cs', None), ('cx', 'lx'), ('cm', None)],
+                problem='p',
+                solver='solver')
+
+def pyomo_model(n):
+    """
+    Generated Pyomo model with scalar, vector, matrix and list variables,
+    expressions and constraints of about n elements each.
+    """
+
+    n, m, k = _dims(n)
+    recipe = '''
+import pyomo.environ as pyo
+
+model = pyo.ConcreteModel()
+model.I = pyo.RangeSet({n})
+model.J = pyo.RangeSet({m})
+
+model.s = pyo.Var()
+model.x = pyo.Var(model.I, within=pyo.NonNegativeReals)
+model.xm = pyo.Var(model.J, model.J)
+model.xl = pyo.VarList()
+for i in range({k}):
+    model.xl.add()
+
+model.g = pyo.Expression(expr=2*model.s)
+model.f = pyo.Expression(model.I, rule=lambda m, i: 2*m.x[i])
+model.fm = pyo.Expression(model.J, model.J, rule=lambda m, i, j: m.xm[i,j]+1)
+
+model.cs = pyo.Constraint(expr=model.s >= 1)
+model.cx = pyo.Constraint(model.I, rule=lambda m, i: m.x[i] >= i)
+model.cm = pyo.Constraint(model.J, model.J, rule=lambda m, i, j: m.xm[i,j] == 1)
+model.cl = pyo.ConstraintList()
+for v in model.xl.values():
+    model.cl.add(v >= 1)
+
+model.o = pyo.Objective(expr=model.s+pyo.quicksum(model.x.values())+
+                        pyo.quicksum(model.xm.values())+pyo.quicksum(model.xl.values()))
+model.dual = pyo.Suffix(direction=pyo.Suffix.IMPORT)
+
+solver = 'appsi_highs'
+results = pyo.SolverFactory(solver).solve(model, load_solutions=False)
+model.solutions.load_from(results)
+
+# Solver statistics read by the kernel, not reported by appsi
+results.solver.time = 0.
+results.solver.statistics.black_box.number_of_iterations = 0
+'''.format(n=n, m=m, k=k)
+
+    return dict(recipe=recipe,
+                variables=[('s', None), ('x', None), ('xm', None), ('xl', None)],
+                functions=[('g', None), ('f', None), ('fm', None)],
+                constraints=[('cs', None), ('cx', None), ('cm', None), ('cl', None)],
+                problem='results',
+                solver='solver')
+
+def optmod_model(n):
+    """
+    Generated optmod model with a hashmap variable, a scalar expression
+    and a list of constraints of about n elements.
+    """
+
+    recipe = '''
+import optmod
+import optalg
+
+x = optmod.VariableDict(range({n}), name='x')
+
+f = optmod.sum([x[i] for i in range({n})])
+
+c = [x[i] >= i for i in range({n})]
+
+p = optmod.Problem(optmod.minimize(f), c)
+s = optalg.opt_solver.OptSolverClp()
+p.solve(solver=s, parameters={{'quiet': True}})
+'''.format(n=n)
+
+    return dict(recipe=recipe,
+                variables=[('x', None)],
+                functions=[('f', None)],
+                constraints=[('c', None)],
+                problem='p',
+                solver='s')
+
+def gams_model(n):
+    """
+    Generated GAMS model with scalar, vector and matrix variables,
+    parameters and equations of about n elements each. GAMS has no list
+    components.
+    """
+
+    n, m, k = _dims(n)
+    recipe = '''
+Set i /i1*i{n}/;
+Set j /j1*j{m}/;
+Alias (j, jj);
+
+Variable z;
+Positive Variable s, x(i), xm(j,jj);
+
+Equation obj, cs, cx(i), cm(j,jj);
+obj.. z =e= s + sum(i, x(i)) + sum((j,jj), xm(j,jj));
+cs.. s =g= 1;
+cx(i).. x(i) =g= ord(i);
+cm(j,jj).. xm(j,jj) =e= 1;
+
+Model benchmark /all/;
+solve benchmark using lp minimizing z;
+
+Parameter g, f(i), fm(j,jj);
+g = 2*s.l;
+f(i) = 2*x.l(i);
+fm(j,jj) = xm.l(j,jj)+1;
+'''.format(n=n, m=m)
+
+    return dict(recipe=recipe,
+                variables=[('s', None), ('x', None), ('xm', None)],
+                functions=[('g', None), ('f', None), ('fm', None)],
+                constraints=[('cs', None), ('cx', None), ('cm', None)],
+                problem='benchmark',
+                solver='solver')
+
+models = {
+    'cvxpy': cvxpy_model,
+    'pyomo': pyomo_model,
+    'optmod': optmod_model,
+    'gams': gams_model,
+}
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the stages of the compute kernels on generated models, with an
+in-memory stand-in for the backend. Each case runs in a fresh process and
+reports wall time, peak memory and states per second, overall and for
+each stage of the run.
+
+Usage: python benchmarks/run.py [--systems cvxpy pyomo] [--sizes 1000 10000]
+                                [--tracemalloc] [--json results.json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stub
+from models import models
+
+# Modules needed by each modeling system
+REQUIRED = {
+    'cvxpy': ['cvxpy'],
+    'pyomo': ['pyomo'],
+    'optmod': ['optmod', 'optalg'],
+    'gams': ['gams'],
+}
+
+def available(system):
+
+    return all(importlib.util.find_spec(m) is not None for m in REQUIRED[system])
+
+def run_case(system, size, trace):
+    """
+    Runs generated model of given system and size, in the current process.
+    """
+
+    import tracemalloc
+    from mos.compute.kernel import new_kernel
+
+    # Silence model output
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    os.environ['MOS_COMPUTE_LOG_CAPTURE_FD'] = '0'
+
+    spec = models[system](size)
+    model = stub.new_model(system, spec['recipe'],
+                           variables=spec['variables'],
+                           functions=spec['functions'],
+                           constraints=spec['constraints'],
+                           problem=spec['problem'],
+                           solver=spec['solver'])
+    kernel = new_kernel(model, 0)
+    kernel.pusher = stub.StubPusher()
+
+    # Peak traced memory of each stage
+    peaks = {}
+    if trace:
+        phase = kernel.__phase__
+        def traced_phase(name, msg=None):
+            if kernel.phase is not None:
+                peak = tracemalloc.get_traced_memory()[1]
+                peaks[kernel.phase] = max(peaks.get(kernel.phase, 0), peak)
+            tracemalloc.reset_peak()
+            phase(name, msg)
+        kernel.__phase__ = traced_phase
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    kernel.run_model()
+    wall = time.perf_counter()-start
+
+    log = model.data.get('execution_log', '')
+    return dict(system=system,
+                size=size,
+                status=kernel.status,
+                wall=wall,
+                timings=kernel.timings,
+                peaks=peaks,
+                max_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024,
+                states=sum(model.requests.states.values()),
+                requests=sum(model.requests.calls.values()),
+                bytes=model.requests.bytes,
+                log=log[-2000:] if kernel.status != 'success' else '')
+
+def report(r):
+
+    states = r['states']
+    # Uploads overlap with extraction, which includes waiting for them
+    extract = r['timings'].get('extract', 0.)
+    print('%-7s %9d  %-7s  wall %8.3fs  states %9d  %11.0f states/s  rss %8.1f MB  %d requests  %.1f MB sent' %(
+        r['system'], r['size'], r['status'], r['wall'], states,
+        states/extract if extract else 0., r['max_rss']/2**20, r['requests'], r['bytes']/2**20))
+    for phase, seconds in r['timings'].items():
+        line = '    %-9s %8.3fs' %(phase, seconds)
+        if phase in ['extract', 'upload'] and seconds:
+            line += '  %11.0f states/s' %(states/seconds)
+        if phase in r['peaks']:
+            line += '  peak %8.1f MB' %(r['peaks'][phase]/2**20)
+        print(line)
+    if r['log']:
+        print(r['log'])
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmarks compute kernel stages')
+    parser.add_argument('--systems', nargs='+', default=list(models.keys()),
+                        choices=list(models.keys()))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000],
+                        help='number of elements per component (10^3 to 10^6)')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='report peak traced memory per stage (slows down runs)')
+    parser.add_argument('--json', help='file where results are saved')
+    args = parser.parse_args()
+
+    results = []
+    ctx = multiprocessing.get_context('spawn')
+    for system in args.systems:
+        if not available(system):
+            print('%-7s skipped, %s not available' %(system, ', '.join(REQUIRED[system])))
+            continue
+        for size in args.sizes:
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+                r = executor.submit(run_case, system, size, args.tracemalloc).result()
+            report(r)
+            results.append(r)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
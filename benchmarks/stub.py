@@ -0,0 +1,147 @@
+import collections
+from json import dumps, loads
+from urllib.parse import urlparse
+from mos.interface.model import Model
+
+BASE_URL = 'http://stub/api/'
+
+class StubResponse:
+    """
+    Response of a stub request.
+    """
+
+    def __init__(self, content=b'null'):
+
+        self.status_code = 200
+        self.content = content
+        self.headers = {}
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return loads(self.content)
+
+    def iter_content(self, chunk_size=1):
+        yield self.content
+
+    def close(self):
+        pass
+
+class StubRequests:
+    """
+    In-memory stand-in for the requests wrapper of a model, which records
+    calls instead of sending them. Request bodies are JSON encoded, as
+    they would be by requests, but not kept.
+
+    Parameters
+    ----------
+    recipe : model recipe (string)
+    """
+
+    def __init__(self, recipe):
+
+        self.recipe = recipe
+        self.calls = collections.Counter()
+        self.states = collections.Counter()
+        self.bytes = 0
+
+    def request(self, method, url, json=None, **kwargs):
+
+        path = urlparse(url).path
+        self.calls[(method, path)] += 1
+        if json is not None:
+            self.bytes += len(dumps(json))
+            if path.endswith('bulk_create/'):
+                self.states[path.split('/')[-3]] += len(json)
+
+        if path.endswith('/write/'):
+            return StubResponse(dumps(self.recipe).encode())
+        return StubResponse()
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request('post', url, json=json, **kwargs)
+
+    def get(self, url, params=None, **kwargs):
+        return self.request('get', url, **kwargs)
+
+    def put(self, url, data=None, json=None, **kwargs):
+        return self.request('put', url, json=json, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('delete', url, **kwargs)
+
+def _components(base_url, kind, items):
+
+    return [dict(name=name,
+                 labels=labels,
+                 url='%s%s/%d/' %(base_url, kind, i))
+            for i, (name, labels) in enumerate(items)]
+
+def model_data(system, variables=(), functions=(), constraints=(),
+               problem=None, solver=None, base_url=BASE_URL, id=1):
+    """
+    Creates raw model data, as returned by the backend.
+
+    Parameters
+    ----------
+    system : modeling system (string)
+    variables : list of (name, labels) pairs
+    functions : list of (name, labels) pairs
+    constraints : list of (name, labels) pairs
+    problem : problem name (string)
+    solver : solver name (string)
+    base_url : REST API url (string)
+    id : model id (integer)
+
+    Returns
+    -------
+    data : dictionary
+    """
+
+    return dict(id=id,
+                name='benchmark-%d' %id,
+                system=system,
+                owner=dict(id=1),
+                url='%smodel/%d/' %(base_url, id),
+                status='queued',
+                execution_log='',
+                interface_files=[],
+                interface_objects=[],
+                helper_objects=[],
+                variables=_components(base_url, 'variable', variables),
+                functions=_components(base_url, 'function', functions),
+                constraints=_components(base_url, 'constraint', constraints),
+                problem=_components(base_url, 'problem', [(problem, None)])[0] if problem else None,
+                solver=_components(base_url, 'solver', [(solver, None)])[0] if solver else None)
+
+def new_model(system, recipe, variables=(), functions=(), constraints=(),
+              problem=None, solver=None):
+    """
+    Creates model backed by stub requests.
+
+    Parameters
+    ----------
+    system : modeling system (string)
+    recipe : model recipe (string)
+    variables : list of (name, labels) pairs
+    functions : list of (name, labels) pairs
+    constraints : list of (name, labels) pairs
+    problem : problem name (string)
+    solver : solver name (string)
+
+    Returns
+    -------
+    model : mos.interface Model
+    """
+
+    data = model_data(system, variables, functions, constraints, problem, solver)
+    return Model(BASE_URL, data, StubRequests(recipe))
+
+class StubPusher:
+    """
+    Pusher that drops notifications.
+    """
+
+    def send(self, msg):
+        pass
@@ -0,0 +1,179 @@
+import os
+import threading
+import urllib
+import requests
+from requests.adapters import HTTPAdapter
+from mos.interface import Interface
+
+class SessionRequests:
+    """
+    Drop-in replacement for the requests wrapper of mos.interface that
+    sends requests through the pooled session and renews the token once
+    when the backend rejects it.
+
+    Parameters
+    ----------
+    pool : InterfacePool
+    """
+
+    def __init__(self, pool):
+
+        self.pool = pool
+
+    @property
+    def token(self):
+        return self.pool.get_token()
+
+    @property
+    def headers(self):
+        return {'Authorization': 'Token %s' %self.token}
+
+    def request(self, method, url, **kwargs):
+
+        token = self.pool.get_token()
+        headers = dict(kwargs.pop('headers', None) or {})
+        if token:
+            headers['Authorization'] = 'Token %s' %token
+        r = self.pool.session.request(method, url, headers=headers, **kwargs)
+
+        # Renew token, unless request body has been consumed
+        if r.status_code == 401 and 'files' not in kwargs and self.pool.can_login():
+            r.close()
+            token = self.pool.refresh_token(token)
+            headers['Authorization'] = 'Token %s' %token
+            r = self.pool.session.request(method, url, headers=headers, **kwargs)
+
+        return r
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request('post', url, data=data, json=json, **kwargs)
+
+    def get(self, url, params=None, **kwargs):
+        return self.request('get', url, params=params, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('put', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('delete', url, **kwargs)
+
+class InterfacePool:
+    """
+    Worker-lifetime source of backend interfaces that share a keep-alive
+    HTTP session and a cached authentication token. Safe to use from
+    concurrent threads.
+
+    Parameters
+    ----------
+    url : REST API url (string). If not provided, it is constructed from
+          env vars MOS_BACKEND_HOST and MOS_BACKEND_PORT
+    pool_size : maximum number of kept-alive connections per host (integer)
+    """
+
+    def __init__(self, url=None, pool_size=None):
+
+        # URL
+        if url is None:
+            host = os.getenv('MOS_BACKEND_HOST', 'localhost')
+            port = os.getenv('MOS_BACKEND_PORT', '8000')
+            if port == '443':
+                protocol = 'https'
+            else:
+                protocol = 'http'
+            url = '%s://%s:%s/api/' %(protocol, host, port)
+
+        # Session
+        if pool_size is None:
+            pool_size = int(os.getenv('MOS_BACKEND_POOL_SIZE', 10))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.url = url
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.token = os.getenv('MOS_BACKEND_TOKEN')
+
+    def can_login(self):
+        """
+        Whether a new token can be obtained with admin credentials.
+        """
+
+        return not os.getenv('MOS_BACKEND_TOKEN')
+
+    def __login__(self):
+
+        url = urllib.parse.urljoin(self.url, 'authenticate/')
+        r = self.session.post(url, data={
+            'username': os.getenv('MOS_ADMIN_USR'),
+            'password': os.getenv('MOS_ADMIN_PWD'),
+        })
+        r.raise_for_status()
+        return r.json()['key']
+
+    def get_token(self):
+        """
+        Gets cached token, logging in if needed.
+
+        Returns
+        -------
+        token : user token (string)
+        """
+
+        with self.lock:
+            if not self.token:
+                self.token = self.__login__()
+            return self.token
+
+    def refresh_token(self, stale_token):
+        """
+        Replaces a rejected token. Concurrent callers holding the same
+        stale token trigger a single login.
+
+        Parameters
+        ----------
+        stale_token : rejected token (string)
+
+        Returns
+        -------
+        token : user token (string)
+        """
+
+        with self.lock:
+            if self.token == stale_token:
+                self.token = self.__login__()
+            return self.token
+
+    def get_interface(self):
+        """
+        Gets backend interface bound to the pooled session.
+
+        Returns
+        -------
+        interface : Interface
+        """
+
+        interface = Interface(self.url)
+        interface.requests = SessionRequests(self)
+        return interface
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    Gets the interface pool of the current process, creating it on first
+    use (and again in forked children, which must not share sockets).
+
+    Returns
+    -------
+    pool : InterfacePool
+    """
+
+    global _pool
+
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = InterfacePool()
+        return _pool
@@ -0,0 +1,654 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import marshal
+import threading
+import collections
+import shutil
+import hashlib
+import tempfile
+
+# Relative cache paths are taken from the worker's starting directory,
+# since tasks run in their own working directories
+_start_dir = os.getcwd()
+
+class InputCache:
+    """
+    On-disk, content-addressed cache of downloaded model input files,
+    shared by the processes of a worker.
+
+    Files are stored once under the SHA-256 of their content and exposed
+    to recipes through hard links (or copies where hard links are not
+    supported), so deleting the linked input files leaves cached entries
+    alone, and evicting entries leaves linked input files alone. Each
+    source url is mapped to its content together with the HTTP validators
+    of the response and the version of the input reported by the backend.
+    An entry of an unchanged version is used without a request; otherwise
+    it is revalidated with a conditional request. Least recently used
+    entries are evicted beyond the size cap, and content is removed once
+    no url maps to it.
+
+    Parameters
+    ----------
+    path : cache directory (string)
+    max_size : size cap in bytes (integer)
+    """
+
+    def __init__(self, path, max_size):
+
+        self.path = path
+        self.max_size = max_size
+        self.objects = os.path.join(path, 'objects')
+        self.keys = os.path.join(path, 'keys')
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.keys, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+
+    def __lock__(self):
+
+        lock = open(os.path.join(self.path, '.lock'), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def __meta_path__(self, url):
+
+        return os.path.join(self.keys, hashlib.sha256(url.encode()).hexdigest()+'.json')
+
+    def __object_path__(self, digest):
+
+        return os.path.join(self.objects, digest)
+
+    def __load__(self, url):
+
+        try:
+            with open(self.__meta_path__(url), 'r') as f:
+                meta = json.load(f)
+            st = os.stat(self.__object_path__(meta['sha256']))
+        except (OSError, ValueError, KeyError):
+            return None
+
+        # Detect objects modified through a link
+        if st.st_size != meta['size'] or st.st_mtime_ns != meta['mtime_ns']:
+            return None
+
+        return meta
+
+    def __hit__(self, url, meta, filename):
+
+        with self.__lock__():
+
+            # Entry may have been evicted or replaced since it was loaded
+            if self.__load__(url) != meta:
+                return False
+            os.utime(self.__meta_path__(url))
+            self.__link__(meta['sha256'], filename)
+            self.hits += 1
+            return True
+
+    def __store__(self, url, response, transform, filename, version):
+
+        # Download while hashing
+        fd, tmp = tempfile.mkstemp(dir=self.objects, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as handle:
+                for data in response.iter_content(chunk_size=1024*1024):
+                    handle.write(data)
+            if transform is not None:
+                transform(tmp)
+            sha = hashlib.sha256()
+            with open(tmp, 'rb') as handle:
+                for data in iter(lambda: handle.read(1024*1024), b''):
+                    sha.update(data)
+            digest = sha.hexdigest()
+
+            # Add object, map url to it and link it before it can be evicted
+            with self.__lock__():
+                if os.path.exists(self.__object_path__(digest)):
+                    os.remove(tmp)
+                else:
+                    os.replace(tmp, self.__object_path__(digest))
+                st = os.stat(self.__object_path__(digest))
+                meta = dict(sha256=digest,
+                            size=st.st_size,
+                            mtime_ns=st.st_mtime_ns,
+                            etag=response.headers.get('ETag'),
+                            last_modified=response.headers.get('Last-Modified'),
+                            version=version)
+                fd, tmp = tempfile.mkstemp(dir=self.keys, prefix='.tmp-')
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(meta, f)
+                os.replace(tmp, self.__meta_path__(url))
+                self.__link__(digest, filename)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def __link__(self, digest, filename):
+
+        if os.path.lexists(filename):
+            os.remove(filename)
+        src = self.__object_path__(digest)
+        try:
+            os.link(src, filename)
+        except OSError:
+            shutil.copyfile(src, filename)
+
+    def fetch(self, requests, url, filename, transform=None, version=None):
+        """
+        Makes the content of an input url available as a local file.
+
+        Parameters
+        ----------
+        requests : requests wrapper of the model
+        url : input data url (string)
+        filename : local file name (string)
+        transform : function applied to the downloaded file before it is
+                    stored, given its path
+        version : version of the input reported by the backend, e.g. its
+                  modification time, or None if unknown (string)
+        """
+
+        meta = self.__load__(url)
+
+        # Unchanged input
+        if meta is not None and version is not None and meta.get('version') == version:
+            if self.__hit__(url, meta, filename):
+                return
+            meta = None
+
+        # Revalidate
+        headers = {}
+        if meta is not None:
+            if meta['etag']:
+                headers['If-None-Match'] = meta['etag']
+            if meta['last_modified']:
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        r = requests.get(url, headers=headers, stream=True)
+        if r.status_code == 304 and meta is not None:
+            r.close()
+            if self.__hit__(url, meta, filename):
+                return
+            r = requests.get(url, stream=True)
+
+        r.raise_for_status()
+        self.misses += 1
+        self.__store__(url, r, transform, filename, version)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes content no url maps to any more, then least recently used
+        entries until the cache fits its size cap. Content shared by
+        several urls is removed with the last of them.
+        """
+
+        with self.__lock__():
+
+            sizes = {}
+            for name in os.listdir(self.objects):
+                path = self.__object_path__(name)
+                try:
+
+                    # Downloads left by killed processes
+                    if name.startswith('.tmp-'):
+                        if os.path.getmtime(path) < time.time()-86400:
+                            os.remove(path)
+                        continue
+                    sizes[name] = os.path.getsize(path)
+                except FileNotFoundError:
+                    pass
+            total = sum(sizes.values())
+
+            entries = []
+            refs = collections.Counter()
+            for name in os.listdir(self.keys):
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(self.keys, name)
+                try:
+                    with open(path, 'r') as f:
+                        digest = json.load(f)['sha256']
+                    entries.append((os.path.getmtime(path), path, digest))
+                except (OSError, ValueError, KeyError):
+                    continue
+                refs[digest] += 1
+            entries.sort()
+
+            # Content of urls that were remapped or dropped
+            for digest in [d for d in sizes if not refs[d]]:
+                try:
+                    os.remove(self.__object_path__(digest))
+                except FileNotFoundError:
+                    pass
+                total -= sizes.pop(digest)
+
+            for _, path, digest in entries:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                refs[digest] -= 1
+                if not refs[digest] and digest in sizes:
+                    try:
+                        os.remove(self.__object_path__(digest))
+                    except FileNotFoundError:
+                        pass
+                    total -= sizes.pop(digest)
+
+_input_cache = None
+
+def get_input_cache():
+    """
+    Gets the input cache of the current process, configured by env vars
+    MOS_COMPUTE_INPUT_CACHE (directory) and MOS_COMPUTE_INPUT_CACHE_SIZE
+    (megabytes).
+
+    Returns
+    -------
+    cache : InputCache, or None if caching is disabled
+    """
+
+    global _input_cache
+
+    path = os.getenv('MOS_COMPUTE_INPUT_CACHE')
+    if not path:
+        return None
+
+    if _input_cache is None:
+        _input_cache = InputCache(
+            os.path.join(_start_dir, path),
+            int(os.getenv('MOS_COMPUTE_INPUT_CACHE_SIZE', 10240))*1024*1024)
+    return _input_cache
+
+class RecipeCache:
+    """
+    Bounded cache of compiled model recipes, keyed by the SHA-256 of
+    their source. Compiled code is kept in memory, least recently used
+    first out, and optionally marshaled to a directory so that processes
+    forked per task also benefit from it.
+
+    Parameters
+    ----------
+    max_entries : maximum number of code objects kept in memory (integer)
+    path : directory of marshaled code objects (string)
+    """
+
+    def __init__(self, max_entries, path=None):
+
+        self.max_entries = max_entries
+        self.path = path
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __file_path__(self, key):
+
+        return os.path.join(self.path, '%s.%s' %(key, sys.implementation.cache_tag))
+
+    def compile(self, source):
+        """
+        Gets compiled recipe.
+
+        Parameters
+        ----------
+        source : recipe source (string)
+
+        Returns
+        -------
+        code : code object
+        """
+
+        key = hashlib.sha256(source.encode()).hexdigest()
+
+        with self.lock:
+            code = self.entries.get(key)
+            if code is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return code
+
+        if self.path:
+            try:
+                with open(self.__file_path__(key), 'rb') as f:
+                    code = marshal.load(f)
+            except (OSError, EOFError, ValueError, TypeError):
+                code = None
+
+        with self.lock:
+            if code is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if code is None:
+            code = compile(source, '<string>', 'exec')
+            if self.path:
+                fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+                with os.fdopen(fd, 'wb') as f:
+                    marshal.dump(code, f)
+                os.replace(tmp, self.__file_path__(key))
+
+        with self.lock:
+            self.entries[key] = code
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        return code
+
+_recipe_cache = None
+
+def get_recipe_cache():
+    """
+    Gets the recipe cache of the current process, configured by env vars
+    MOS_COMPUTE_RECIPE_CACHE_SIZE (entries) and MOS_COMPUTE_RECIPE_CACHE
+    (directory, optional).
+
+    Returns
+    -------
+    cache : RecipeCache
+    """
+
+    global _recipe_cache
+
+    if _recipe_cache is None:
+        path = os.getenv('MOS_COMPUTE_RECIPE_CACHE')
+        _recipe_cache = RecipeCache(
+            int(os.getenv('MOS_COMPUTE_RECIPE_CACHE_SIZE', 64)),
+            os.path.join(_start_dir, path) if path else None)
+    return _recipe_cache
+
+# Model methods through which runs store their results, replayed in order
+RESULT_CALLS = ['__set_var_type_and_shape__',
+                '__set_func_type_and_shape__',
+                '__set_constraint_type_and_shape__',
+                '__set_helper_object__',
+                '__add_variable_states__',
+                '__add_function_states__',
+                '__add_constraint_states__',
+                '__add_problem_state__',
+                '__add_solver_state__',
+                '__set_interface_file__',
+                '__set_interface_object__']
+
+def _json_default(x):
+
+    if hasattr(x, 'tolist'):
+        return x.tolist()
+    raise TypeError('%s is not JSON serializable' %type(x).__name__)
+
+class ResultRecorder:
+    """
+    Records the results a model run stores through its model, for a
+    ResultCache entry. The model's result methods are wrapped until the
+    recorder is committed or discarded.
+
+    Parameters
+    ----------
+    cache : ResultCache
+    model : mos.interface Model
+    key : entry key (string)
+    """
+
+    def __init__(self, cache, model, key):
+
+        self.cache = cache
+        self.model = model
+        self.key = key
+        self.lock = threading.Lock()
+        self.failed = False
+        self.path = tempfile.mkdtemp(dir=cache.path, prefix='.tmp-')
+        self.calls = open(os.path.join(self.path, 'calls.jsonl'), 'w')
+        self.files = 0
+
+        for name in RESULT_CALLS:
+            setattr(model, name, self.__wrap__(name, getattr(model, name)))
+
+    def __wrap__(self, name, method):
+
+        def recorded(*args, **kwargs):
+            self.__record__(name, args, kwargs)
+            return method(*args, **kwargs)
+
+        return recorded
+
+    def __record__(self, name, args, kwargs):
+
+        with self.lock:
+            if self.failed:
+                return
+            try:
+                if name in ['__set_helper_object__', '__set_interface_object__']:
+                    o, data = args[:2]
+                    encoder = args[2] if len(args) > 2 else kwargs.get('encoder')
+                    args = (o, json.loads(json.dumps(data, cls=encoder, default=None if encoder else _json_default)))
+                elif name == '__set_interface_file__':
+                    f, filepath = args
+                    filename = os.path.join('files', str(self.files), os.path.basename(filepath))
+                    os.makedirs(os.path.dirname(os.path.join(self.path, filename)))
+                    shutil.copyfile(filepath, os.path.join(self.path, filename))
+                    self.files += 1
+                    args = (f, filename)
+                self.calls.write(json.dumps([name, list(args)], default=_json_default)+'\n')
+            except Exception as e:
+                print('Unable to record results for caching: %s' %e)
+                self.failed = True
+
+    def __restore__(self):
+
+        for name in RESULT_CALLS:
+            self.model.__dict__.pop(name, None)
+        self.calls.close()
+
+    def commit(self, log):
+        """
+        Stores recorded results in the cache.
+
+        Parameters
+        ----------
+        log : execution log of the run (string)
+        """
+
+        self.__restore__()
+        if self.failed:
+            self.discard()
+            return
+        with open(os.path.join(self.path, 'log.txt'), 'w') as f:
+            f.write(log)
+        try:
+            os.rename(self.path, self.cache.__entry_path__(self.key))
+        except OSError:
+            # Stored concurrently by another run
+            self.discard()
+            return
+        self.cache.evict()
+
+    def discard(self):
+        """
+        Drops recorded results.
+        """
+
+        self.__restore__()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+class ResultCache:
+    """
+    On-disk cache of the results of model runs, shared by the processes
+    of a worker and keyed by a hash of everything a run depends on. An
+    entry holds the calls through which a run stored its results (types
+    and shapes, states, helper and output objects, output files), in
+    order, and its execution log, so that an identical run replays them
+    instead of executing its recipe. Least recently used entries are
+    evicted beyond the size cap. Recipes are assumed to be deterministic.
+
+    Parameters
+    ----------
+    path : cache directory (string)
+    max_size : size cap in bytes (integer)
+    """
+
+    def __init__(self, path, max_size):
+
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+
+    def __entry_path__(self, key):
+
+        return os.path.join(self.path, key)
+
+    def record(self, model, key):
+        """
+        Starts recording the results of a run.
+
+        Parameters
+        ----------
+        model : mos.interface Model
+        key : entry key (string)
+
+        Returns
+        -------
+        recorder : ResultRecorder
+        """
+
+        self.misses += 1
+        return ResultRecorder(self, model, key)
+
+    def replay(self, model, key):
+        """
+        Stores the cached results of an identical run through model.
+
+        Parameters
+        ----------
+        model : mos.interface Model
+        key : entry key (string)
+
+        Returns
+        -------
+        log : execution log of the cached run, or None if not cached (string)
+        """
+
+        path = self.__entry_path__(key)
+
+        # Shared lock keeps the entry from being evicted while replayed
+        with open(os.path.join(self.path, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+
+            try:
+                with open(os.path.join(path, 'log.txt'), 'r') as f:
+                    log = f.read()
+                os.utime(path)
+            except OSError:
+                return None
+            self.hits += 1
+
+            with open(os.path.join(path, 'calls.jsonl'), 'r') as f:
+                for line in f:
+                    name, args = json.loads(line)
+                    if name == '__set_interface_file__':
+                        args[1] = os.path.join(path, args[1])
+                    getattr(model, name)(*args)
+
+        return log
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits its size
+        cap.
+        """
+
+        with open(os.path.join(self.path, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            entries = []
+            for name in os.listdir(self.path):
+                path = self.__entry_path__(name)
+
+                # Recordings left by killed processes
+                if name.startswith('.tmp-'):
+                    try:
+                        if os.path.getmtime(path) < time.time()-86400:
+                            shutil.rmtree(path, ignore_errors=True)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                if name.startswith('.'):
+                    continue
+                size = 0
+                for root, dirs, files in os.walk(path):
+                    for filename in files:
+                        try:
+                            size += os.path.getsize(os.path.join(root, filename))
+                        except FileNotFoundError:
+                            pass
+                try:
+                    entries.append((os.path.getmtime(path), path, size))
+                except FileNotFoundError:
+                    pass
+            total = sum(size for _, _, size in entries)
+            entries.sort()
+
+            for _, path, size in entries:
+                if total <= self.max_size:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+_result_cache = None
+
+def get_result_cache():
+    """
+    Gets the result cache of the current process, configured by env vars
+    MOS_COMPUTE_RESULT_CACHE (directory) and MOS_COMPUTE_RESULT_CACHE_SIZE
+    (megabytes).
+
+    Returns
+    -------
+    cache : ResultCache, or None if caching is disabled
+    """
+
+    global _result_cache
+
+    path = os.getenv('MOS_COMPUTE_RESULT_CACHE')
+    if not path:
+        return None
+
+    if _result_cache is None:
+        _result_cache = ResultCache(
+            os.path.join(_start_dir, path),
+            int(os.getenv('MOS_COMPUTE_RESULT_CACHE_SIZE', 10240))*1024*1024)
+    return _result_cache
+
+def get_cache_counts():
+    """
+    Gets the hit and miss counts of the enabled caches of the current
+    process, since it started.
+
+    Returns
+    -------
+    counts : hits and misses by cache, 'input', 'recipe' or 'result'
+             (dictionary)
+    """
+
+    counts = {}
+    for name, c in [('input', get_input_cache()),
+                    ('recipe', get_recipe_cache()),
+                    ('result', get_result_cache())]:
+        if c is not None:
+            counts[name] = dict(hits=c.hits, misses=c.misses)
+    return counts
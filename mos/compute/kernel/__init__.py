@@ -12,3 +12,20 @@ def new_kernel(model, caller_id):
             return kernel(model, caller_id)
     else:
         raise ValueError("Unsupported modeling system %s" %model.get_system())
+
+def get_modules(names):
+    """
+    Gets the modules to import ahead of time for the given modeling
+    systems. Names that are not modeling systems are taken as module
+    names, e.g. solver bindings.
+    """
+
+    modules = []
+    for name in names:
+        for kernel in kernels:
+            if kernel.system == name:
+                modules.extend(kernel.modules)
+                break
+        else:
+            modules.append(name)
+    return modules
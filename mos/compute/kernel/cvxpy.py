@@ -1,11 +1,57 @@
 import io
+import os
+import hashlib
+import collections
 import numpy as np
 
+from .. import states
 from .kernel import ComputeKernel
 
+def _values(x, name):
+    """
+    Flattens the value of a variable, expression, dual or violation,
+    evaluated once, into a float array in row-major order. Raises
+    ValueError if there is no value, e.g. after a failed solve.
+    """
+
+    if x is None:
+        raise ValueError('%s has no value' %name)
+    return np.asarray(x, dtype=float).ravel()
+
+def _indices(shape, prefix=[]):
+    """
+    State indices of the elements of an array of the given shape, in
+    row-major order, as an integer array with one row per element.
+    """
+
+    index = np.indices(shape).reshape(len(shape), -1).T
+    if prefix:
+        index = np.hstack([np.tile(prefix, (index.shape[0], 1)), index])
+    return index
+
+def _labels(labels, shape):
+    """
+    Labels of the elements of an array of the given shape, in row-major
+    order (keyed by integers for 1d arrays and tuples otherwise), empty
+    if not labeled.
+    """
+
+    if not labels:
+        return ['']*int(np.prod(shape))
+    if len(shape) == 1:
+        keys = range(shape[0])
+    else:
+        keys = np.ndindex(*shape)
+    return [labels[k] if k in labels else '' for k in keys]
+
+# Scopes of executed recipes that support parameter-only re-solves,
+# keyed by model id and recipe hash, least recently used first
+_problems = collections.OrderedDict()
+
 class CvxpyKernel(ComputeKernel):
 
     system = 'cvxpy'
+    modules = ['cvxpy']
 
     def __run_model__(self):
 
@@ -20,25 +66,45 @@ class CvxpyKernel(ComputeKernel):
         try:
 
             # Get recipe
-            print('Getting recipe')
+            self.__phase__('recipe', 'Getting recipe')
             recipe = io.StringIO()
             model.__write__(recipe)
             
             # Download input files
-            print('Downloading input files')
-            model.__download_input_files__()
+            self.__phase__('download', 'Downloading input files')
+            self.__download_input_files__()
 
             # Download input object files
-            print('Downloading input object files')
-            model.__download_input_object_files__()
+            self.__phase__('download', 'Downloading input object files')
+            self.__download_input_object_files__()
+
+            # Replay results of an identical earlier run
+            if self.__replay__(recipe):
+                return
+
+            # Re-solve problem of previous run with same structure, updating
+            # its parameters from the new inputs through the recipe's
+            # mos_resolve function, which reuses cvxpy's cached problem data.
+            # Everything extracted below is read from the scope afterwards,
+            # so mos_resolve must also refresh whatever depends on inputs
+            key = (model.get_id(), hashlib.sha256(recipe.getvalue().encode()).hexdigest())
+            scope = _problems.pop(key, None)
+            if scope is not None:
+                self.__phase__('execute', 'Re-solving cached problem')
+                try:
+                    scope['mos_resolve']()
+                except Exception as e:
+                    print('Unable to re-solve cached problem: %s' %e)
+                    scope = None
 
             # Execute recipe in isolated scope
-            print('Executing model')
-            scope = {}
-            exec(recipe.getvalue(), scope, scope)
+            if scope is None:
+                self.__phase__('execute', 'Executing model')
+                scope = {}
+                self.__exec_recipe__(recipe, scope)
 
             # Extract helper objects
-            print('Extracting helper objects')
+            self.__phase__('extract', 'Extracting helper objects')
             for o in model.__get_helper_objects__():
                 o_cvxpy = scope[o['name']]
                 if type(o_cvxpy) == np.ndarray:
@@ -47,15 +113,16 @@ class CvxpyKernel(ComputeKernel):
                     if type(o_cvxpy) == list:
                         # Want to check if any elements in list are ndarrays
                         # If they are, want to make those elements JSON serializable
-                        for key,item in enumerate(o_cvxpy):
+                        for i,item in enumerate(o_cvxpy):
                             if type(item) == np.ndarray:
-                                o_cvxpy[key] = item.tolist()
+                                o_cvxpy[i] = item.tolist()
                                 
                     model.__set_helper_object__(o, o_cvxpy)
             
             # Extract variable states
-            print('Extracting variable states')
-            var_states = []
+            self.__phase__('extract', 'Extracting variable states')
+            var_states = states.StateUploader(self.__timed__('upload', model.__add_variable_states__))
+            owner = model.get_owner_id()
             for v in model.__get_variables__():
 
                 # Extract var from scope
@@ -85,67 +152,39 @@ class CvxpyKernel(ComputeKernel):
                     # Type and shape
                     model.__set_var_type_and_shape__(v, 'scalar', None)
 
-                    # Value
-                    vtemp = v_cvxpy.value.tolist()
-                    if isinstance(vtemp, float):
-                        vv = v_cvxpy.value.tolist()
-                    elif isinstance(vtemp, list):
-                        vv = vtemp[0]
-                    else:
-                        raise ValueError('unable to get scalar variable value')
-                        
                     # State
-                    var_states.append(dict(
-                        variable=v['url'],
-                        owner=model.get_owner_id(),
-                        index=None,
-                        label=v['name'],
-                        value=vv,
-                        kind=kind_v,
-                        upper_bound=ub,
-                        lower_bound=lb))
-
-                # Vector
-                ########
-                elif isinstance(v_cvxpy, Variable) and v_cvxpy.is_vector():
+                    var_states.add(states.StateBatch(
+                        dict(variable=v['url'],
+                             owner=owner,
+                             kind=kind_v,
+                             upper_bound=ub,
+                             lower_bound=lb),
+                        index=[None],
+                        label=[v['name']],
+                        value=_values(v_cvxpy.value, v['name'])[:1]))
+
+                # Vector or matrix
+                ##################
+                elif isinstance(v_cvxpy, Variable) and (v_cvxpy.is_vector() or 
+                                                        v_cvxpy.is_matrix()):
 
                     # Type and shape
-                    model.__set_var_type_and_shape__(v, 'array', [v_cvxpy.size])
+                    if v_cvxpy.is_vector():
+                        shape = [v_cvxpy.size]
+                    else:
+                        shape = list(v_cvxpy.shape)
+                    model.__set_var_type_and_shape__(v, 'array', shape)
                      
                     # States
-                    for i in range(v_cvxpy.size):
-                        var_states.append(dict(
-                            variable=v['url'],
-                            owner=model.get_owner_id(),
-                            index=[i],
-                            label=v_labels[i] if i in v_labels else '',
-                            value=v_cvxpy.value[i],
-                            kind=kind_v,
-                            upper_bound=ub,
-                            lower_bound=lb))
-
-                # Matrix 
-                ########
-                elif isinstance(v_cvxpy, Variable) and v_cvxpy.is_matrix():
-                    
-                    # Type and shape
-                    model.__set_var_type_and_shape__(v, 
-                                                     'array',
-                                                     list(v_cvxpy.shape))
-                    
-                    # States
-                    for i in range(v_cvxpy.shape[0]):
-                        for j in range(v_cvxpy.shape[1]):
-                            var_states.append(dict(
-                                variable=v['url'],
-                                owner=model.get_owner_id(),
-                                index=[i,j],
-                                label=v_labels[(i,j)] if (i,j) in v_labels else '',
-                                kind=kind_v,
-                                value=v_cvxpy.value[i][j],
-                                upper_bound=ub,
-                                lower_bound=lb))
-
+                    var_states.add(states.StateBatch(
+                        dict(variable=v['url'],
+                             owner=owner,
+                             kind=kind_v,
+                             upper_bound=ub,
+                             lower_bound=lb),
+                        index=_indices(shape),
+                        label=_labels(v_labels, shape),
+                        value=_values(v_cvxpy.value, v['name'])))
 
                 # List
                 ########
@@ -177,96 +216,68 @@ class CvxpyKernel(ComputeKernel):
                             kind_v = 'integer'
                         else:
                             kind_v = 'continuous'
-                            
+
+                        shared = dict(variable=v['url'],
+                                      owner=owner,
+                                      kind=kind_v,
+                                      upper_bound=ub,
+                                      lower_bound=lb)
                         if item.is_scalar():
-                            var_states.append(dict(
-                                variable=v['url'],
-                                owner=model.get_owner_id(),
-                                index=[i],
-                                label=v_labels_local if not isinstance(v_labels,dict) else '',
-                                value=item.value,
-                                kind=kind_v,
-                                upper_bound=ub,
-                                lower_bound=lb))                            
-                        elif item.is_vector():
-                            for j in range(item.size):
-                                var_states.append(dict(
-                                    variable=v['url'],
-                                    owner=model.get_owner_id(),
-                                    index=[i,j],
-                                    label=v_labels_local[j] if j in v_labels_local else '',
-                                    value=item.value[j],
-                                    kind=kind_v,
-                                    upper_bound=ub,
-                                    lower_bound=lb))                                
-                        elif item.is_matrix():
-                            for j in range(item.size[0]):
-                                for k in range(item.size[1]):
-                                    var_states.append(dict(
-                                        variable=v['url'],
-                                        owner=model.get_owner_id(),
-                                        index=[i,j,k],
-                                        label=v_labels_local[(j,k)] if (j,k) in v_labels_local else '',
-                                        value=item.value[j][k],
-                                        kind=kind_v,
-                                        upper_bound=ub,
-                                        lower_bound=lb))                                                        
+                            var_states.add(states.StateBatch(
+                                shared,
+                                index=[[i]],
+                                label=[v_labels_local if not isinstance(v_labels,dict) else ''],
+                                value=_values(item.value, v['name'])[:1]))
+                        else:
+                            item_shape = [item.size] if item.is_vector() else list(item.shape)
+                            var_states.add(states.StateBatch(
+                                shared,
+                                index=_indices(item_shape, [i]),
+                                label=_labels(v_labels_local, item_shape),
+                                value=_values(item.value, v['name'])))
 
                 # Unknown
                 #########
                 else:
                     raise TypeError('invalid variable type')
 
-            model.__add_variable_states__(var_states)
+            var_states.flush()
 
             # Extract function states
-            print('Extracting function states')
-            func_states = []
+            self.__phase__('extract', 'Extracting function states')
+            func_states = states.StateUploader(self.__timed__('upload', model.__add_function_states__))
             for f in model.__get_functions__():
 
                 # Extract cvxpy function from scope
                 f_cvxpy = scope[f['name']]
                 f_labels = scope[f['labels']] if f['labels'] else {}
+                shared = dict(function=f['url'], owner=owner)
 
                 # Expression scalar
                 ###################
                 if isinstance(f_cvxpy, Expression) and f_cvxpy.is_scalar():
                     model.__set_func_type_and_shape__(f, 'scalar', None)
-                    func_states.append(dict(
-                        function=f['url'],
-                        owner=model.get_owner_id(),
-                        index=None,
-                        label=f['name'],
-                        value=float(f_cvxpy.value)))
-
-                # Expression vector
-                ###################
-                elif isinstance(f_cvxpy, Expression) and f_cvxpy.is_vector():
-                    model.__set_func_type_and_shape__(f, 
-                                                      'array',
-                                                      [f_cvxpy.size])
-                    for i in range(f_cvxpy.size):
-                        func_states.append(dict(
-                            function=f['url'],
-                            owner=model.get_owner_id(),
-                            index=[i],
-                            label=f_labels[i] if i in f_labels else '',
-                            value=float(f_cvxpy.value[i])))
-
-                # Expression matrix
-                ###################
-                elif isinstance(f_cvxpy, Expression) and f_cvxpy.is_matrix():
-                    model.__set_func_type_and_shape__(f, 
-                                                      'array',
-                                                      list(f_cvxpy.shape))
-                    for i in range(f_cvxpy.shape[0]):
-                        for j in range(f_cvxpy.shape[1]):
-                            func_states.append(dict(
-                                function=f['url'],
-                                owner=model.get_owner_id(),
-                                index=[i,j],
-                                label=f_labels[(i,j)] if (i,j) in f_labels else '',
-                                value=float(f_cvxpy.value[i][j])))
+                    func_states.add(states.StateBatch(
+                        shared,
+                        index=[None],
+                        label=[f['name']],
+                        value=_values(f_cvxpy.value, f['name'])[:1]))
+
+                # Expression vector or matrix
+                #############################
+                elif isinstance(f_cvxpy, Expression) and (f_cvxpy.is_vector() or
+                                                          f_cvxpy.is_matrix()):
+                    if f_cvxpy.is_vector():
+                        shape = [f_cvxpy.size]
+                    else:
+                        shape = list(f_cvxpy.shape)
+                    model.__set_func_type_and_shape__(f, 'array', shape)
+
+                    func_states.add(states.StateBatch(
+                        shared,
+                        index=_indices(shape),
+                        label=_labels(f_labels, shape),
+                        value=_values(f_cvxpy.value, f['name'])))
 
                 # Expression list
                 ###################
@@ -283,40 +294,29 @@ class CvxpyKernel(ComputeKernel):
                         f_labels_local = f_labels[i] if i in f_labels else {}
 
                         if item.is_scalar():
-                            func_states.append(dict(
-                                function=f['url'],
-                                owner=model.get_owner_id(),
-                                index=[i],
-                                label=f_labels_local if not isinstance(f_labels,dict) else '',
-                                value=item.value))
-                        elif item.is_vector():
-                            for j in range(item.size):
-                                func_states.append(dict(
-                                    function=f['url'],
-                                    owner=model.get_owner_id(),
-                                    index=[i,j],
-                                    label=f_labels_local[j] if j in f_labels_local else '',
-                                    value=item.value[j]))
-                        elif item.is_matrix():
-                            for j in range(item.shape[0]):
-                                for k in range(item.shape[1]):
-                                    func_states.append(dict(
-                                        function=f['url'],
-                                        owner=model.get_owner_id(),
-                                        index=[i,j,k],
-                                        label=f_labels_local[(j,k)] if (j,k) in f_labels_local else '',
-                                        value=item.value[j][k]))
+                            func_states.add(states.StateBatch(
+                                shared,
+                                index=[[i]],
+                                label=[f_labels_local if not isinstance(f_labels,dict) else ''],
+                                value=_values(item.value, f['name'])[:1]))
+                        else:
+                            item_shape = [item.size] if item.is_vector() else list(item.shape)
+                            func_states.add(states.StateBatch(
+                                shared,
+                                index=_indices(item_shape, [i]),
+                                label=_labels(f_labels_local, item_shape),
+                                value=_values(item.value, f['name'])))
                             
                 # Unknown
                 #########
                 else:
                     raise TypeError('invalid function type')
 
-            model.__add_function_states__(func_states)
+            func_states.flush()
 
             # Extract constraint states
-            print('Extracting constraint states')
-            constr_states = []
+            self.__phase__('extract', 'Extracting constraint states')
+            constr_states = states.StateUploader(self.__timed__('upload', model.__add_constraint_states__))
             for c in model.__get_constraints__():
 
                 # Extract cvxpy constraint from scope
@@ -330,87 +330,56 @@ class CvxpyKernel(ComputeKernel):
                 else:
                     raise ValueError('unsupported constraint type')
 
+                shared = dict(constraint=c['url'], owner=owner, kind=kind)
+
+                # Duals and violations (evaluated once per constraint)
+                if c_cvxpy.dual_value is None:
+                    duals = np.zeros(c_cvxpy.size)
+                else:
+                    duals = _values(c_cvxpy.dual_value, c['name'])
+                violations = _values(c_cvxpy.violation(), c['name'])
+
                 # Constraint scalar
                 ###################
                 if c_cvxpy.size == 1:
 
-                    if c_cvxpy.dual_value is None:
-                        ccdv = 0
-                    else:
-                        ccdv = c_cvxpy.dual_value
-
-                    viol = c_cvxpy.violation()
-                        
                     model.__set_constraint_type_and_shape__(c, 
                                                             'scalar',
                                                             None)
 
-                    constr_states.append(dict(
-                        constraint=c['url'],
-                        owner=model.get_owner_id(),
-                        index=None,
-                        label=c['name'],
-                        kind=kind,
-                        dual=ccdv if type(ccdv) != np.ndarray else ccdv[0],
-                        violation=viol if type(viol) != np.ndarray else viol[0]))                        
-
-                # Constraint array 1d
-                #####################
-                elif len(c_cvxpy.shape) == 1:
-                    if c_cvxpy.dual_value is None:
-                        ccdv = np.zeros(c_cvxpy.shape)                        
-                    elif not c_cvxpy.dual_value.any():
-                        ccdv = np.zeros(c_cvxpy.shape)
-                    else:
-                        ccdv = c_cvxpy.dual_value
-                    model.__set_constraint_type_and_shape__(c, 
-                                                            'array',
-                                                            [c_cvxpy.size])
-                                
-                    for i in range(c_cvxpy.size):
-                        constr_states.append(dict(
-                            constraint=c['url'],
-                            owner=model.get_owner_id(),
-                            index=[i],
-                            label=c_labels[i] if i in c_labels else '',
-                            kind=kind,
-                            dual=ccdv[i],
-                            violation=c_cvxpy.violation()[i]))
-
-                # Constraint array 2d
-                #####################
-                elif len(c_cvxpy.shape) == 2:
-                    if c_cvxpy.dual_value is None:
-                        ccdv = np.zeros(c_cvxpy.shape)                        
-                    elif not c_cvxpy.dual_value.any():
-                        ccdv = np.zeros(c_cvxpy.shape)
+                    constr_states.add(states.StateBatch(
+                        shared,
+                        index=[None],
+                        label=[c['name']],
+                        dual=duals[:1],
+                        violation=violations[:1]))
+
+                # Constraint array 1d or 2d
+                ###########################
+                elif len(c_cvxpy.shape) in [1, 2]:
+
+                    if len(c_cvxpy.shape) == 1:
+                        shape = [c_cvxpy.size]
                     else:
-                        ccdv = c_cvxpy.dual_value
- 
-                    model.__set_constraint_type_and_shape__(c, 
-                                                            'array',
-                                                            list(c_cvxpy.shape))
-                                
-                    for j in range(c_cvxpy.shape[0]):
-                        for k in range(c_cvxpy.shape[1]):                                
-                            constr_states.append(dict(
-                                constraint=c['url'],
-                                owner=model.get_owner_id(),
-                                index=[j,k],
-                                label=c_labels[(j,k)] if (j,k) in c_labels else '',
-                                kind=kind,
-                                dual=ccdv[j][k],
-                                violation=c_cvxpy.violation()[j][k]))
+                        shape = list(c_cvxpy.shape)
+                    model.__set_constraint_type_and_shape__(c, 'array', shape)
+
+                    constr_states.add(states.StateBatch(
+                        shared,
+                        index=_indices(shape),
+                        label=_labels(c_labels, shape),
+                        dual=duals,
+                        violation=violations))
 
                 # Unknown
                 #########
                 else:
                     raise TypeError('unsupported constraint structure')
 
-            model.__add_constraint_states__(constr_states)
+            constr_states.flush()
 
             # Extract problem state
-            print('Extracting problem state')
+            self.__phase__('extract', 'Extracting problem state')
             if model.has_problem():
                 p = model.__get_problem__()
                 p_cvxpy = scope[p['name']]
@@ -425,14 +394,14 @@ class CvxpyKernel(ComputeKernel):
                     problem_type = 'unknown'
 
                 p_state = dict(problem=p['url'],
-                               owner=model.get_owner_id(),
+                               owner=owner,
                                kind=problem_type,
                                num_constraints=int(metrics.num_scalar_eq_constr + metrics.num_scalar_leq_constr), 
                                num_vars=int(metrics.num_scalar_variables))
                 model.__add_problem_state__(p_state)
 
             # Extract solver state
-            print('Extracting solver state')
+            self.__phase__('extract', 'Extracting solver state')
             if model.has_solver() and model.has_problem():
                 s = model.__get_solver__()
                 s_cvxpy = scope[s['name']]
@@ -441,7 +410,7 @@ class CvxpyKernel(ComputeKernel):
                 time_recorded = p_cvxpy.solver_stats.solve_time
                     
                 s_state = dict(solver=s['url'],
-                               owner=model.get_owner_id(),
+                               owner=owner,
                                name=s_cvxpy if isinstance(s_cvxpy, str) else 'unknown',
                                status=p_cvxpy.status,
                                message='',
@@ -451,16 +420,23 @@ class CvxpyKernel(ComputeKernel):
                 model.__add_solver_state__(s_state)
 
             # Extract output files
-            print('Extracting output files')
+            self.__phase__('extract', 'Extracting output files')
             for f in model.__get_interface_files__(type='output'):
                 model.__set_interface_file__(f, f['name']+f['extension'])
 
             # Extract output objects
-            print('Extracting output objects')
+            self.__phase__('extract', 'Extracting output objects')
             for o in model.__get_interface_objects__(type='output'):
                 o_cvxpy = scope[o['name']]
                 model.__set_interface_object__(o, o_cvxpy)
 
+            # Keep problem for parameter-only re-solves
+            max_problems = int(os.getenv('MOS_COMPUTE_CVXPY_PROBLEM_CACHE_SIZE', 8))
+            if max_problems > 0 and callable(scope.get('mos_resolve')):
+                _problems[key] = scope
+                while len(_problems) > max_problems:
+                    _problems.popitem(last=False)
+
         except Exception as e:
 
             print('ERROR')
@@ -469,7 +445,7 @@ class CvxpyKernel(ComputeKernel):
         finally:
 
             # Cleanup
-            print('Cleaning up local files')
+            self.__phase__('cleanup', 'Cleaning up local files')
             model.__delete_input_files__()
             model.__delete_input_object_files__()
             model.__delete_output_files__()
@@ -1,12 +1,491 @@
 import os
 import io
+import re
+import csv
 import math
-
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+import numpy as np
+
+from .. import cache
+from .. import states
 from .kernel import ComputeKernel
 
+def _violations(level, lower, upper):
+    """
+    Violations of equations from their levels and bounds.
+    """
+
+    level = np.asarray(level, dtype=float)
+    with np.errstate(invalid='ignore'):
+        viol = np.maximum(np.maximum(np.asarray(lower, dtype=float)-level,
+                                     level-np.asarray(upper, dtype=float)),
+                          0.)
+    viol[np.isnan(viol)] = 0.
+    return viol
+
+# Model status codes of GAMS solves
+_MODEL_STATUS = {
+    1: 'Optimal',
+    2: 'Locally Optimal',
+    3: 'Unbounded',
+    4: 'Infeasible',
+    5: 'Locally Infeasible',
+    6: 'Intermediate Infeasible',
+    7: 'Feasible Solution',
+    8: 'Integer Solution',
+    9: 'Intermediate Non-Integer',
+    10: 'Integer Infeasible',
+    11: 'Licensing Problem',
+    12: 'Error Unknown',
+    13: 'Error No Solution',
+    14: 'No Solution Returned',
+    15: 'Solved Unique',
+    16: 'Solved',
+    17: 'Solved Singular',
+    18: 'Unbounded - No Solution',
+    19: 'Infeasible - No Solution',
+}
+
+def _number(value):
+    """
+    Number from a summary field, zero if not available.
+    """
+
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return 0
+    return 0 if math.isnan(value) else value
+
+def _trace_summary(filename):
+    """
+    Summary of the last solve of a job, from its solver trace file
+    (traceopt 3), or None if it lacks any of the fields needed. The trace
+    record definition may be wrapped over several comment lines.
+    """
+
+    header = None
+    wrapped = False
+    record = None
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('*'):
+                text = line[1:].strip()
+                if 'InputFileName' in text or 'ModelType' in text:
+                    header = [text]
+                    wrapped = True
+                elif wrapped and text:
+                    header.append(text)
+                else:
+                    wrapped = False
+            elif line:
+                wrapped = False
+                record = next(csv.reader([line]))
+    if header is None or record is None:
+        return None
+
+    fields = [x.strip() for x in ','.join(header).split(',') if x.strip()]
+    record = dict(zip(fields, record))
+    if any(record.get(name) is None for name in ['ModelStatus', 'ModelType', 'SolverName']):
+        return None
+    try:
+        status = _MODEL_STATUS.get(int(float(record['ModelStatus'])),
+                                   record['ModelStatus'])
+    except ValueError:
+        status = record['ModelStatus']
+    return dict(type=record['ModelType'],
+                solver=record['SolverName'],
+                status=status,
+                time=_number(record.get('SolverTime')),
+                iterations=_number(record.get('NumberOfIterations')))
+
+def _listing_summary(filename, max_bytes=64*1024*1024):
+    """
+    Summary of the last solve of a job, from the solve summaries found in
+    the first max_bytes of its listing file.
+    """
+
+    summary = None
+    count = 0
+    remaining = 0
+    with open(filename, 'r', errors='replace') as f:
+        for line in f:
+            count += len(line)
+            if count > max_bytes:
+                break
+            tokens = line.split()
+            if 'S O L V E' in line:
+                summary = dict(type='unknown', solver='unknown', status='unknown',
+                               time=0, iterations=0)
+                remaining = 20
+                continue
+            remaining -= 1
+            if remaining < 0 or len(tokens) < 2:
+                continue
+            if tokens[0] == 'TYPE':
+                summary['type'] = tokens[1]
+            elif tokens[0] == 'SOLVER':
+                summary['solver'] = tokens[1]
+            elif tokens[:3] == ['****', 'MODEL', 'STATUS'] and len(tokens) > 4:
+                summary['status'] = ' '.join(tokens[4:])
+            elif tokens[:2] == ['RESOURCE', 'USAGE,'] and len(tokens) > 3:
+                summary['time'] = _number(tokens[3])
+            elif tokens[:2] == ['ITERATION', 'COUNT,'] and len(tokens) > 3:
+                summary['iterations'] = _number(tokens[3])
+
+    return summary
+
+def _shape(symbol):
+    """
+    Type and shape of a GAMS symbol, and the number of columns of
+    symbols stored as full matrices (None otherwise).
+    """
+
+    if symbol.dimension == 0:
+        return 'scalar', None, None
+    if symbol.dimension == 2:
+        d = [len(symbol.domains[0]), len(symbol.domains[1])]
+        if d[0]*d[1] == len(symbol):
+            return 'array', d, d[1]
+    return 'array', [len(symbol)], None
+
+def _read(db, names, system_directory):
+    """
+    Reads the given symbols of a GAMS database with gams.transfer, if
+    available.
+    """
+
+    try:
+        import gams.transfer as gt
+        container = gt.Container(system_directory=system_directory)
+        container.read(db, symbols=list(names))
+        return container
+    except Exception:
+        return None
+
+def _records(container, symbol, fields):
+    """
+    Keys and numeric fields of all records of a GAMS symbol, as a list
+    and a dictionary of NumPy arrays.
+    """
+
+    records = None
+    if container is not None:
+        try:
+            records = container[symbol.name].records
+        except Exception:
+            records = None
+
+    if records is not None:
+        keys = records.iloc[:, :symbol.dimension].astype(str).values.tolist()
+        values = {f: records[f].to_numpy(dtype=float) for f in fields}
+    else:
+        records = list(symbol)
+        keys = [r.keys for r in records]
+        values = {f: np.array([getattr(r, f) for r in records], dtype=float)
+                  for f in fields}
+
+    return keys, values
+
+def _indices(n, dimension, cols):
+    """
+    State indices of the records of a GAMS symbol, by position.
+    """
+
+    if dimension == 0:
+        return [None]*n
+    if cols:
+        return np.stack(np.divmod(np.arange(n), cols), axis=1)
+    return np.arange(n)
+
+def _labels(keys, name):
+    """
+    State labels from record keys, or the symbol name for single records.
+    """
+
+    if len(keys) > 1:
+        return [str(k) for k in keys]
+    return [name]*len(keys)
+
+class WorkspacePool:
+    """
+    Pool of reusable GAMS workspaces of a worker process, each with its
+    own private scratch directory. Released workspaces have their scratch
+    directory emptied, and only a bounded number of idle workspaces is
+    kept.
+
+    Parameters
+    ----------
+    max_idle : maximum number of idle workspaces kept (integer)
+    path : parent directory of scratch directories (string)
+    """
+
+    def __init__(self, max_idle, path=None):
+
+        self.max_idle = max_idle
+        self.path = path
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def acquire(self):
+        """
+        Gets a workspace with an empty scratch directory.
+
+        Returns
+        -------
+        ws : GamsWorkspace
+        """
+
+        import gams
+
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+        # Named after the process, so that they are removed if it is killed
+        scratch = tempfile.mkdtemp(prefix='mos-gams-%d-' %os.getpid(), dir=self.path)
+        return gams.GamsWorkspace(scratch, debug=1)
+
+    def release(self, ws):
+        """
+        Returns workspace to the pool, removing its scratch files.
+
+        Parameters
+        ----------
+        ws : GamsWorkspace
+        """
+
+        scratch = ws.working_directory
+        with self.lock:
+            keep = len(self.idle) < self.max_idle
+        if not keep:
+            shutil.rmtree(scratch, ignore_errors=True)
+            return
+
+        for name in os.listdir(scratch):
+            path = os.path.join(scratch, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        with self.lock:
+            self.idle.append(ws)
+
+_workspace_pool = None
+
+def get_workspace_pool():
+    """
+    Gets the GAMS workspace pool of the current process, configured by
+    env vars MOS_GAMS_WORKSPACES (idle workspaces) and MOS_GAMS_SCRATCH
+    (directory, optional).
+
+    Returns
+    -------
+    pool : WorkspacePool
+    """
+
+    global _workspace_pool
+
+    if _workspace_pool is None:
+        path = os.getenv('MOS_GAMS_SCRATCH')
+        _workspace_pool = WorkspacePool(
+            int(os.getenv('MOS_GAMS_WORKSPACES', 2)),
+            os.path.join(cache._start_dir, path) if path else None)
+    return _workspace_pool
+
+# Recipe line separating the model source, compiled once into a
+# checkpoint, from the data-dependent part run from that checkpoint
+CHECKPOINT_MARKER = '* mos: checkpoint'
+
+# Dollar control options that read files at compile time, with the
+# extension GAMS adds to file names without one
+_INCLUDE = re.compile(r'^\$\s*(include|batinclude|gdxin)\s+("[^"]*"|\'[^\']*\'|\S+)',
+                      re.IGNORECASE | re.MULTILINE)
+_INCLUDE_EXT = {'include': '.gms', 'batinclude': '.gms', 'gdxin': '.gdx'}
+
+def _hash_source(source, base_dir):
+    """
+    SHA-256 of GAMS source and of the files it includes or loads at
+    compile time, recursively, resolved relative to base_dir. Recipes
+    refer to input files by their path in base_dir, a scratch directory
+    that differs between workspaces, so it is hashed as '.'.
+    """
+
+    sha = hashlib.sha256(source.replace(base_dir, '.').encode())
+    sources = [source]
+    seen = set()
+    while sources:
+        for option, name in _INCLUDE.findall(sources.pop()):
+            path = os.path.join(base_dir, name.strip('"\''))
+            if not os.path.splitext(path)[1] and not os.path.exists(path):
+                path += _INCLUDE_EXT[option.lower()]
+            if path in seen:
+                continue
+            seen.add(path)
+            sha.update(path.replace(base_dir, '.').encode())
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                continue
+            sha.update(data)
+            if option.lower() != 'gdxin':
+                sources.append(data.decode(errors='replace'))
+    return sha.hexdigest()
+
+class CheckpointCache:
+    """
+    On-disk cache of GAMS checkpoints (save files) of the model part of
+    recipes, keyed by the SHA-256 of its source and of the files it
+    includes or loads at compile time. Recipes split by the
+    CHECKPOINT_MARKER line only compile their model part once; later runs
+    restart from the cached checkpoint and only execute the part after
+    the marker. Least recently used checkpoints are evicted beyond the
+    size cap.
+
+    Parameters
+    ----------
+    path : cache directory (string)
+    max_size : size cap in bytes (integer)
+    """
+
+    def __init__(self, path, max_size):
+
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+
+    def add_job(self, ws, source):
+        """
+        Adds job for recipe to workspace, restarting from the checkpoint
+        of its model part.
+
+        Parameters
+        ----------
+        ws : GamsWorkspace
+        source : recipe source (string)
+
+        Returns
+        -------
+        job : GamsJob
+        """
+
+        lines = source.splitlines(keepends=True)
+        for i, line in enumerate(lines):
+            if line.strip().lower() == CHECKPOINT_MARKER:
+                break
+        else:
+            return ws.add_job_from_string(source)
+        head = ''.join(lines[:i])
+        tail = ''.join(lines[i+1:])
+
+        key = _hash_source(head, ws.working_directory)
+        filename = os.path.join(self.path, key+'.g00')
+        checkpoint = os.path.join(ws.working_directory, 'mos-%s.g00' %key)
+
+        # Shared lock keeps the checkpoint from being evicted while copied
+        with open(os.path.join(self.path, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            try:
+                shutil.copyfile(filename, checkpoint)
+                os.utime(filename)
+                cached = True
+            except OSError:
+                cached = False
+
+        cp = ws.add_checkpoint(checkpoint)
+        if cached:
+            self.hits += 1
+        else:
+            self.misses += 1
+            ws.add_job_from_string(head).run(checkpoint=cp)
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+            os.close(fd)
+            shutil.copyfile(checkpoint, tmp)
+            os.replace(tmp, filename)
+            self.evict()
+
+        return ws.add_job_from_string(tail, cp)
+
+    def evict(self):
+        """
+        Removes least recently used checkpoints until the cache fits its
+        size cap.
+        """
+
+        with open(os.path.join(self.path, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            entries = []
+            for name in os.listdir(self.path):
+                path = os.path.join(self.path, name)
+                try:
+
+                    # Copies left by killed processes
+                    if name.startswith('.tmp-'):
+                        if os.path.getmtime(path) < time.time()-86400:
+                            os.remove(path)
+                        continue
+                    if name.endswith('.g00'):
+                        st = os.stat(path)
+                        entries.append((st.st_mtime, path, st.st_size))
+                except FileNotFoundError:
+                    pass
+            total = sum(size for _, _, size in entries)
+            entries.sort()
+
+            for _, path, size in entries:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+_checkpoint_cache = None
+
+def get_checkpoint_cache():
+    """
+    Gets the GAMS checkpoint cache of the current process, configured by
+    env vars MOS_GAMS_CHECKPOINT_CACHE (directory) and
+    MOS_GAMS_CHECKPOINT_CACHE_SIZE (megabytes).
+
+    Returns
+    -------
+    cache : CheckpointCache, or None if checkpoint reuse is disabled
+    """
+
+    global _checkpoint_cache
+
+    path = os.getenv('MOS_GAMS_CHECKPOINT_CACHE')
+    if not path:
+        return None
+
+    if _checkpoint_cache is None:
+        _checkpoint_cache = CheckpointCache(
+            os.path.join(cache._start_dir, path),
+            int(os.getenv('MOS_GAMS_CHECKPOINT_CACHE_SIZE', 1024))*1024*1024)
+    return _checkpoint_cache
+
 class GamsKernel(ComputeKernel):
 
     system = 'gams'
+    modules = ['gams']
 
     def __run_model__(self):
 
@@ -18,60 +497,64 @@ class GamsKernel(ComputeKernel):
         # Locals
         model = self.model
 
-        try:
+        # Run in private scratch directory of pooled workspace
+        ws = get_workspace_pool().acquire()
+        start_dir = os.getcwd()
+        os.chdir(ws.working_directory)
 
-            #ws = gams.GamsWorkspace(os.getcwd(),'/home/ubuntu/Downloads/gams30.2_linux_x64_64_sfx/',debug=1)
-            ws = gams.GamsWorkspace(os.getcwd(),debug=1)
+        try:
             
             # Get recipe
-            print('Getting recipe')
+            self.__phase__('recipe', 'Getting recipe')
             recipe = io.StringIO()
             model.__write__(recipe, base_path=os.getcwd())
 
             # Download input files
-            print('Downloading input files')
-            model.__download_input_files__()
+            self.__phase__('download', 'Downloading input files')
+            self.__download_input_files__()
+
+            # Replay results of an identical earlier run
+            if self.__replay__(recipe):
+                return
 
             #print('recipe')
             #model.show_recipe()
 
             # Execute recipe in isolated scope
-            print('Executing model')
-            t1 = ws.add_job_from_string(recipe.getvalue())
+            self.__phase__('execute', 'Executing model')
+            checkpoints = get_checkpoint_cache()
+            if checkpoints is not None:
+                t1 = checkpoints.add_job(ws, recipe.getvalue())
+            else:
+                t1 = ws.add_job_from_string(recipe.getvalue())
+
+            # Solver trace gives a structured summary of the solve
+            opt = ws.add_options()
+            opt.trace = os.path.join(ws.working_directory, t1.name+'.trc')
+            opt.traceopt = 3
 
             # we may want to allow solver designation, feature not finished yet
-            newsolver = False
             for item in model.__get_interface_objects__(type='input'):
                 if item['name'] == 'solver_designation':
                     r=requests.get(item['data'])
-                    opt = ws.add_options()
                     opt.all_model_types = json.loads(r.content)
-                    newsolver = True
-            if newsolver == True:
-                t1.run(opt)
-            else:
-                t1.run()
-
-            # pull some information from gams listing file
-            t1f = t1._file_name
-            t1f = t1f.replace('.gms','.lst')
-            capture = []
-            f = open(t1f,'r')
-            for i in range(10000):
-                j=f.readline()
-                if 'S O L V E' in j:
-                    capture.append(j)
-                    for k in range(10):
-                        capture.append(f.readline())
-                    break
-            f.close()
-
-            ptype = capture[3].split()[1]
-            psolver = capture[4].split()[1]
+            t1.run(opt)
+
+            # Get solve summary, from listing file if not traced
+            try:
+                summary = _trace_summary(opt.trace)
+            except (OSError, csv.Error):
+                summary = None
+            if summary is None:
+                summary = _listing_summary(t1._file_name.replace('.gms','.lst'))
+            if summary is None:
+                print('No solve summary found')
+                summary = dict(type='unknown', solver='unknown', status='unknown',
+                               time=0, iterations=0)
 
             # Extract context objects
             # need to distinguish below between gams parameters and sets
-            print('Extracting context objects')
+            self.__phase__('extract', 'Extracting context objects')
             for o in model.__get_helper_objects__():
                 tmp = []
                 o_gams = t1.out_db[o['name']]
@@ -86,32 +569,23 @@ class GamsKernel(ComputeKernel):
 
                 model.__set_helper_object__(o, tmp)
             
+            # Read symbols in bulk
+            container = _read(t1.out_db,
+                              [x['name'] for x in (model.__get_variables__() +
+                                                   model.__get_functions__() +
+                                                   model.__get_constraints__())],
+                              ws.system_directory)
+
             # Extract variable states
-            print('Extracting variable states')
-            var_states = []
+            self.__phase__('extract', 'Extracting variable states')
+            var_states = states.StateUploader(self.__timed__('upload', model.__add_variable_states__))
             for v in model.__get_variables__():
                 
                 # Extract gams var from gams python api
                 v_gams = t1.out_db[v['name']]
 
                 if isinstance(v_gams, gams.database.GamsVariable):
-                    if v_gams.dimension == 0:
-                        vtype = 'scalar'
-                        vshape = None
-                    elif v_gams.dimension == 1:
-                        vtype = 'array'
-                        vshape = [len(v_gams)]
-                    elif v_gams.dimension == 2:
-                        vtype = 'array'
-                        vd = [len(v_gams.domains[0]), len(v_gams.domains[1])]                                  
-                        if vd[0]*vd[1] == len(v_gams):
-                            vshape = [vd[0],vd[1]]
-                        else:
-                            vshape = [len(v_gams)]
-                    else:
-                        vtype = 'array'
-                        vshape = [len(v_gams)]
-                        
+                    vtype, vshape, vcols = _shape(v_gams)
                     model.__set_var_type_and_shape__(v, vtype, vshape)
 
                     if v_gams.vartype == 1:
@@ -123,158 +597,76 @@ class GamsKernel(ComputeKernel):
                     else:
                         kind_v = 'unknown'
 
-                    
-                    for i in enumerate(v_gams):
-                        if v_gams.dimension == 0:
-                            ind = None
-                        elif v_gams.dimension == 2:
-                            if vd[0]*vd[1] == len(v_gams):
-                                floor = math.floor(i[0]/vd[1])
-                                ind = [floor, i[0]-floor*vd[1]]
-                            else:
-                                ind = i[0]
-                        else:
-                            ind = i[0]
-
-                        label = str(i[1].keys) if len(v_gams) > 1 else v['name']
-                        if str(i[1].upper)=='inf':
-                            ub=1e9
-                        else:
-                            ub=i[1].upper
-                        if str(i[1].lower)=='-inf':
-                            lb=-1e9
-                        else:
-                            lb=i[1].lower
-                        var_states.append(dict(
-                            variable=v['url'],
-                            owner=model.get_owner_id(),
-                            index=ind,
-                            label=label,
-                            kind=kind_v,
-                            value=i[1].level,
-                            upper_bound=ub,   
-                            lower_bound=lb))
+                    keys, r = _records(container, v_gams, ['level', 'lower', 'upper'])
+                    var_states.add(states.StateBatch(
+                        dict(variable=v['url'],
+                             owner=model.get_owner_id(),
+                             kind=kind_v),
+                        index=_indices(len(keys), v_gams.dimension, vcols),
+                        label=_labels(keys, v['name']),
+                        value=r['level'],
+                        upper_bound=np.where(np.isposinf(r['upper']), 1e9, r['upper']),
+                        lower_bound=np.where(np.isneginf(r['lower']), -1e9, r['lower'])))
                         
                 # Unknown
                 else:
                     raise TypeError('invalid variable type')
-            model.__add_variable_states__(var_states)
+            var_states.flush()
 
             # Extract function states from gams python api
-            print('Extracting function states')
-            func_states = []
+            self.__phase__('extract', 'Extracting function states')
+            func_states = states.StateUploader(self.__timed__('upload', model.__add_function_states__))
             for f in model.__get_functions__():
+
                 # Extract gams functions
                 f_gams = t1.out_db[f['name']]
-                if f_gams.dimension == 0:
-                    ftype = 'scalar'
-                    fshape = None
-                elif f_gams.dimension == 1:
-                    ftype = 'array'
-                    fshape = [len(f_gams)]
-                elif f_gams.dimension == 2:
-                    ftype = 'array'
-                    fd = [len(f_gams.domains[0]), len(f_gams.domains[1])]
-                    if fd[0] * fd[1] == len(f_gams):
-                           fshape = [fd[0], fd[1]]
-                    else:
-                           fshape = [len(f_gams)]
-                else:
-                    ftype = 'array'
-                    fshape = [len(f_gams)]
-                           
-                    
+                ftype, fshape, fcols = _shape(f_gams)
                 model.__set_func_type_and_shape__(f, ftype, fshape)                
 
-
                 # Expression
                 if isinstance(f_gams, gams.database.GamsParameter):
-                    for i in enumerate(f_gams):
-
-                        if f_gams.dimension == 0:
-                            ind = None
-                        elif f_gams.dimension == 2:
-                            if fd[0]*fd[1] == len(f_gams):
-                                floor = math.floor(i[0]/fd[1])
-                                ind = [floor, i[0]-floor*fd[1]]
-                            else:
-                                ind = i[0]
-                        else:
-                            ind = i[0]
-                        
-                        label = str(i[1].keys) if len(f_gams) > 1 else f['name']
-                        
-                        func_states.append(dict(
-                            function=f['url'],
-                            owner=model.get_owner_id(),
-                            index=ind,
-                            label=label, 
-                            value=i[1].value))
+                    keys, r = _records(container, f_gams, ['value'])
+                    func_states.add(states.StateBatch(
+                        dict(function=f['url'],
+                             owner=model.get_owner_id()),
+                        index=_indices(len(keys), f_gams.dimension, fcols),
+                        label=_labels(keys, f['name']),
+                        value=r['value']))
                 else:
                     print('unknown function type in GAMS kernel')
                     raise TypeError('invalid function type')
 
-            model.__add_function_states__(func_states)               
+            func_states.flush()
 
             # Extract constraint states
-            print('Extracting constraint states')
-            constr_states = []
+            self.__phase__('extract', 'Extracting constraint states')
+            constr_states = states.StateUploader(self.__timed__('upload', model.__add_constraint_states__))
             for c in model.__get_constraints__():
 
                 # Extract gams constraint from scope
                 c_gams = t1.out_db[c['name']]
-                if c_gams.dimension==0:
-                    ctype = 'scalar'
-                    cshape = None
-                elif c_gams.dimension==1:
-                    ctype = 'array'
-                    cshape = [len(c_gams)]
-                elif c_gams.dimension==2:
-                    ctype = 'array'
-                    cd = [len(c_gams.domains[0]), len(c_gams.domains[1])]
-                    if cd[0] * cd[1] == len(c_gams):
-                        cshape = [cd[0], cd[1]]
-                    else:
-                        cshape = [len(c_gams)]
-                else:
-                        ctype = 'array'
-                        cshape = [len(c_gams)]                    
-                    
+                ctype, cshape, ccols = _shape(c_gams)
                 model.__set_constraint_type_and_shape__(c, ctype ,cshape)                
+
                 if isinstance(c_gams, gams.database.GamsEquation):
-                    for i in enumerate(c_gams):
-                        
-                        if c_gams.dimension == 0:
-                            ind = None
-                        elif c_gams.dimension == 2:
-                            if cd[0]*cd[1] == len(c_gams):
-                                floor = math.floor(i[0]/cd[1])
-                                ind = [floor, i[0]-floor*cd[1]]
-                            else:
-                                ind = i[0]
-                        else:
-                            ind = i[0]
-                        
-                        label = str(i[1].keys) if len(c_gams) > 1 else c['name']
-                        
-                        ckind = 'equality' if c_gams._equtype == 0 else 'inequality'
-                        
-                        constr_states.append(dict(
-                            constraint=c['url'],
-                            owner=model.get_owner_id(),
-                            index=ind,
-                            label=label,
-                            dual=i[1].marginal,
-                            kind=ckind,
-                            violation=0)) # NEED TO FIX
+                    ckind = 'equality' if c_gams._equtype == 0 else 'inequality'
+                    keys, r = _records(container, c_gams, ['level', 'marginal', 'lower', 'upper'])
+                    constr_states.add(states.StateBatch(
+                        dict(constraint=c['url'],
+                             owner=model.get_owner_id(),
+                             kind=ckind),
+                        index=_indices(len(keys), c_gams.dimension, ccols),
+                        label=_labels(keys, c['name']),
+                        dual=r['marginal'],
+                        violation=_violations(r['level'], r['lower'], r['upper'])))
                 else:
                     raise TypeError('invalid constraint type')
 
-            model.__add_constraint_states__(constr_states)
+            constr_states.flush()
 
             
             # Extract problem state
-            print('Extracting problem state')
+            self.__phase__('extract', 'Extracting problem state')
             if model.has_problem():
                 num_rows = 0
                 num_columns = 0
@@ -286,10 +678,9 @@ class GamsKernel(ComputeKernel):
                 
                 p = model.__get_problem__()
 
-                p_value = t1.out_db['solver'].find_record('objective').value
                 p_state = dict(problem=p['url'],
                                owner=model.get_owner_id(),
-                               kind=ptype.lower(),
+                               kind=summary['type'].lower(),
                                num_constraints=num_rows,
                                num_vars=num_columns)
                 model.__add_problem_state__(p_state)
@@ -297,29 +688,22 @@ class GamsKernel(ComputeKernel):
             # Extract solver state
             if model.has_solver() and model.has_problem():
                 s = model.__get_solver__()
-                s_gams = t1.out_db['solver']
-                if math.isnan(s_gams.find_record('iterations').value):
-                    checkiter = 0
-                else:
-                    checkiter = s_gams.find_record('iterations').value
-                    
                 s_state = dict(solver=s['url'],
-                           name = psolver,
-                           owner=model.get_owner_id(),    
-                           #status=s_gams.find_record('status').value,
-                           status=capture[7].split()[4],
-                           time=s_gams.find_record('time').value,
-                           iterations=checkiter)
-            model.__add_solver_state__(s_state)
+                               name=summary['solver'],
+                               owner=model.get_owner_id(),
+                               status=summary['status'],
+                               time=summary['time'],
+                               iterations=summary['iterations'])
+                model.__add_solver_state__(s_state)
 
             # Extract output files
             # For now we will not deal with output GDX files
-            print('Extracting output files')
+            self.__phase__('extract', 'Extracting output files')
             for f in model.__get_interface_files__(type='output'):
                 model.__set_interface_file__(f, f['name']+f['extension'])
             
             # Extract output objects
-            print('Extracting output objects')
+            self.__phase__('extract', 'Extracting output objects')
             for o in model.__get_interface_objects__(type='output'):
                 tmp = []
                 o_gams = t1.out_db[o["name"]]
@@ -335,7 +719,11 @@ class GamsKernel(ComputeKernel):
         finally:
 
             # Cleanup
-            print('Cleaning up local files')
-            model.__delete_input_files__()
-            model.__delete_output_files__()
+            self.__phase__('cleanup', 'Cleaning up local files')
+            try:
+                model.__delete_input_files__()
+                model.__delete_output_files__()
+            finally:
+                os.chdir(start_dir)
+                get_workspace_pool().release(ws)
             
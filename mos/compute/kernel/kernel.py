@@ -1,12 +1,23 @@
-import io
+import os
+import json
+import time
+import hashlib
+import threading
 import traceback
-from contextlib import redirect_stderr, redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
 
+from .. import log
 from .. import utils
+from .. import cache
+from ..supervisor import TaskCancelled, acquire_solve_slot, release_solve_slot
+
+# Maximum number of input files or objects downloaded concurrently
+DOWNLOAD_THREADS = int(os.getenv('MOS_COMPUTE_DOWNLOAD_THREADS', 4))
 
 class ComputeKernel:
 
     system = None
+    modules = []
 
     def __init__(self, model, caller_id):
 
@@ -15,6 +26,70 @@ class ComputeKernel:
 
         self.pusher = utils.PusherClient(caller_id)
 
+        self.status = None
+        self.timings = {}
+        self.phase = None
+        self.thread = None
+        self.recorder = None
+        self.solving = False
+
+    def __phase__(self, name, msg=None):
+        """
+        Starts a phase of the model run, ending the current one. Time spent
+        in each phase is accumulated in timings. The execute phase holds
+        one of the worker's solve slots, if solves are limited, and time
+        spent waiting for it is accumulated as phase wait.
+
+        Parameters
+        ----------
+        name : phase name, or None to end the current phase (string)
+        msg : progress message printed to the execution log (string)
+        """
+
+        if name == 'execute' and not self.solving:
+            self.__phase__('wait')
+            self.solving = acquire_solve_slot()
+        elif name != 'execute' and self.solving:
+            release_solve_slot()
+            self.solving = False
+
+        now = time.perf_counter()
+        if self.phase is not None:
+            self.timings[self.phase] = self.timings.get(self.phase, 0.)+now-self.phase_start
+        self.phase = name
+        self.phase_start = now
+        if msg:
+            print(msg)
+
+    def __timed__(self, name, func):
+        """
+        Wraps function so that time spent in it is accumulated in phase
+        name, e.g. state uploads during extraction. Calls made from the
+        thread running the model are taken out of the current phase, while
+        calls from background threads overlap with it.
+
+        Parameters
+        ----------
+        name : phase name (string)
+        func : function
+
+        Returns
+        -------
+        func : function
+        """
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                dt = time.perf_counter()-start
+                self.timings[name] = self.timings.get(name, 0.)+dt
+                if self.phase is not None and threading.get_ident() == self.thread:
+                    self.phase_start += dt
+
+        return timed
+
     def run_model(self): 
 
         # Running
@@ -28,17 +103,31 @@ class ComputeKernel:
         )
 
         # Run
-        s = io.StringIO()
+        self.timings = {}
+        self.phase = None
+        self.thread = threading.get_ident()
+        s = log.ExecutionLog(self.model.__set_execution_log__)
         try:
 
             # Execute custom kernel code
-            with redirect_stdout(s), redirect_stderr(s):
-                self.__run_model__()
+            with s.capture():
+                try:
+                    self.__run_model__()
+                    if self.recorder is not None:
+                        self.recorder.commit(s.getvalue())
+                        self.recorder = None
+                finally:
+                    if self.recorder is not None:
+                        self.recorder.discard()
+                        self.recorder = None
+                    self.__phase__(None)
+                    print('Timings: %s' %', '.join('%s %.3fs' %x for x in self.timings.items()))
         
             # Log
-            self.model.__set_execution_log__(s.getvalue())
+            s.close()
 
             # Success
+            self.status = 'success'
             self.model.__set_status__('success')
             self.pusher.send(
                 {
@@ -48,6 +137,25 @@ class ComputeKernel:
                 }
             )
 
+        except TaskCancelled:
+
+            s.write('\n')
+            s.write('Run cancelled\n')
+
+            # Log
+            s.close()
+
+            # Cancelled
+            self.status = 'cancelled'
+            self.model.__set_status__('cancelled')
+            self.pusher.send(
+                {
+                    'model_id': self.model.get_id(),
+                    'model_name': self.model.get_name(),
+                    'status': 'cancelled'
+                }
+            )
+
         except Exception:
 
             s.write('\n')
@@ -55,9 +163,10 @@ class ComputeKernel:
             traceback.print_exc(file=s)
             
             # Log
-            self.model.__set_execution_log__(s.getvalue())
+            s.close()
 
             # Error
+            self.status = 'error'
             self.model.__set_status__('error')
             self.pusher.send(
                 {
@@ -67,9 +176,137 @@ class ComputeKernel:
                 }
             )
 
-        finally:
+    def __fetch__(self, url, filename, transform=None, version=None):
+
+        input_cache = cache.get_input_cache()
+        if input_cache is not None:
+            input_cache.fetch(self.model.requests, url, filename, transform=transform, version=version)
+            return
+
+        r = self.model.requests.get(url, stream=True)
+        r.raise_for_status()
+        with open(filename, 'wb') as handle:
+            for data in r.iter_content(chunk_size=1024*1024):
+                handle.write(data)
+        if transform is not None:
+            transform(filename)
+
+    def __fetch_all__(self, items):
+        """
+        Downloads inputs concurrently, through the input cache if enabled.
+
+        Parameters
+        ----------
+        items : list of (url, filename, transform, version) tuples, with
+                the version of each input reported by the backend, if any
+        """
+
+        for url, filename, transform, version in items:
+            print("Downloading file %s" %filename)
+
+        if DOWNLOAD_THREADS <= 1 or len(items) <= 1:
+            for item in items:
+                self.__fetch__(*item)
+            return
+
+        with ThreadPoolExecutor(max_workers=min(DOWNLOAD_THREADS, len(items))) as executor:
+            for future in [executor.submit(self.__fetch__, *item) for item in items]:
+                future.result()
+
+    def __download_input_files__(self):
+
+        self.__fetch_all__([(f['data'], '%s%s' %(f['name'], f['extension']), None, f.get('updated_at'))
+                            for f in self.model.__get_interface_files__(type='input')
+                            if f['data'] is not None])
+
+    def __download_input_object_files__(self):
+
+        def normalize(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            with open(path, 'w') as f:
+                json.dump(data, f)
+
+        self.__fetch_all__([(o['data'], '%s%s' %(o['name'], '.json'), normalize, o.get('updated_at'))
+                            for o in self.model.__get_interface_objects__(type='input')
+                            if o['data'] is not None])
+
+    def __result_key__(self, recipe):
+        """
+        Hash of everything the results of the run depend on: modeling
+        system, model and its components, recipe, contents of input files
+        and values of input objects. Input files and objects are read
+        from the working directory once downloaded.
+        """
+
+        model = self.model
+        sha = hashlib.sha256()
+        def add(x):
+            sha.update(json.dumps(x, sort_keys=True).encode()+b'\n')
+
+        # Recipes may refer to files in the working directory
+        add([self.system, model.get_id(), recipe.getvalue().replace(os.getcwd(), '.')])
+        for c in model.__get_variables__()+model.__get_functions__()+model.__get_constraints__():
+            add([c['name'], c['labels'], c['url']])
+        for c in [model.__get_problem__(), model.__get_solver__()]+model.__get_helper_objects__():
+            add([c['name'], c['url']] if c else None)
+
+        for f in model.__get_interface_files__():
+            add([f['name'], f['extension'], f['type'], f.get('url')])
+            if f['type'] == 'input' and f['data'] is not None:
+                with open('%s%s' %(f['name'], f['extension']), 'rb') as handle:
+                    for data in iter(lambda: handle.read(1024*1024), b''):
+                        sha.update(data)
+
+        for o in model.__get_interface_objects__():
+            add([o['name'], o['type'], o.get('url')])
+            if o['type'] == 'input' and o['data'] is not None:
+                filename = '%s%s' %(o['name'], '.json')
+                if os.path.isfile(filename):
+                    with open(filename, 'r') as handle:
+                        add(json.load(handle))
+                else:
+                    r = model.requests.get(o['data'])
+                    r.raise_for_status()
+                    add(r.json())
+
+        return sha.hexdigest()
+
+    def __replay__(self, recipe):
+        """
+        Replays the results of an identical earlier run from the result
+        cache, or starts recording the results of this run for later
+        ones. Called by kernels once the inputs are downloaded.
+
+        Parameters
+        ----------
+        recipe : model recipe (StringIO)
+
+        Returns
+        -------
+        flag : True if results were replayed, and the recipe must not be
+               executed (boolean)
+        """
+
+        results = cache.get_result_cache()
+        if results is None:
+            return False
+
+        self.__phase__('cache', 'Looking up results of identical runs')
+        key = self.__result_key__(recipe)
+        log = results.replay(self.model, key)
+        if log is None:
+            self.recorder = results.record(self.model, key)
+            return False
+
+        print('Replayed results of an identical run, with log:')
+        print(log)
+        return True
+
+    def __exec_recipe__(self, recipe, scope):
 
-            print(s.getvalue())
+        code = cache.get_recipe_cache().compile(recipe.getvalue())
+        exec(code, scope, scope)
 
     def __run_model__(self):
 
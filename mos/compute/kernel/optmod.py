@@ -1,10 +1,12 @@
 import io
 
+from .. import states
 from .kernel import ComputeKernel
  
 class OptmodKernel(ComputeKernel):
 
     system = 'optmod'
+    modules = ['optmod']
 
     def __run_model__(self):
 
@@ -16,32 +18,36 @@ class OptmodKernel(ComputeKernel):
         try:
 
             # Get recipe
-            print('Getting recipe')
+            self.__phase__('recipe', 'Getting recipe')
             recipe = io.StringIO()
             model.__write__(recipe)
             
             # Download input files
-            print('Downloading input files')
-            model.__download_input_files__()
+            self.__phase__('download', 'Downloading input files')
+            self.__download_input_files__()
 
             # Download input object files
-            print('Downloading input object files')
-            model.__download_input_object_files__()
+            self.__phase__('download', 'Downloading input object files')
+            self.__download_input_object_files__()
+
+            # Replay results of an identical earlier run
+            if self.__replay__(recipe):
+                return
 
             # Execute recipe in isolated scope
-            print('Executing model')
+            self.__phase__('execute', 'Executing model')
             scope = {}
-            exec(recipe.getvalue(), scope, scope)
+            self.__exec_recipe__(recipe, scope)
 
             # Extract helper objects
-            print('Extracting helper objects') 
+            self.__phase__('extract', 'Extracting helper objects') 
             for o in model.__get_helper_objects__():
                 o_optmod = scope[o['name']]
                 model.__set_helper_object__(o, o_optmod)
  
             # Extract variable states
-            print('Extracting variable states')
-            var_states = []
+            self.__phase__('extract', 'Extracting variable states')
+            var_states = states.StateUploader(self.__timed__('upload', model.__add_variable_states__))
             for v in model.__get_variables__():
                 
                 # Extract optmod var from scope
@@ -64,6 +70,10 @@ class OptmodKernel(ComputeKernel):
                                                      [len(v_optmod)])
 
                     # States
+                    batch = states.StateBatch(dict(variable=v['url'],
+                                                   owner=model.get_owner_id(),
+                                                   upper_bound=0.,
+                                                   lower_bound=0.))
                     for key in v_optmod.keys():
                         vs = v_optmod[key]
                         if vs.type == 'continuous':
@@ -72,26 +82,23 @@ class OptmodKernel(ComputeKernel):
                             kind = 'integer'
                         else:
                             kind = 'unknown'
-                        var_states.append(dict(
-                            variable=v['url'],
-                            owner=model.get_owner_id(),
+                        batch.append(
                             index=key,
                             label=v_labels[key] if key in v_labels else '',
                             kind=kind,
-                            value=vs.get_value(),
-                            upper_bound=0.,
-                            lower_bound=0.))
+                            value=vs.get_value())
+                    var_states.add(batch)
 
                 # Unknown
                 #########
                 else:
                     raise TypeError('invalid variable type')
 
-            model.__add_variable_states__(var_states)
+            var_states.flush()
 
             # Extract function states
-            print('Extracting function states')
-            func_states = []
+            self.__phase__('extract', 'Extracting function states')
+            func_states = states.StateUploader(self.__timed__('upload', model.__add_function_states__))
             for f in model.__get_functions__():
 
                 # Extract optmod function from scope
@@ -101,12 +108,11 @@ class OptmodKernel(ComputeKernel):
                 ###################
                 if isinstance(f_optmod, optmod.expression.Expression):
                     model.__set_func_type_and_shape__(f, 'scalar', None)
-                    func_states.append(dict(
-                        function=f['url'],
-                        owner=model.get_owner_id(),
-                        index=None,
-                        label=f['name'],
-                        value=f_optmod.get_value()))
+                    func_states.add(states.StateBatch(
+                        dict(function=f['url'], owner=model.get_owner_id()),
+                        index=[None],
+                        label=[f['name']],
+                        value=[f_optmod.get_value()]))
 
                 # Expression array
                 ##################
@@ -118,11 +124,11 @@ class OptmodKernel(ComputeKernel):
                 #########
                 else:
                     raise TypeError('invalid function type')
-            model.__add_function_states__(func_states)
+            func_states.flush()
 
             # Extract constraint states
-            print('Extracting constraint states')
-            constr_states = []
+            self.__phase__('extract', 'Extracting constraint states')
+            constr_states = states.StateUploader(self.__timed__('upload', model.__add_constraint_states__))
             for c in model.__get_constraints__():
 
                 # Extract optmod constraint from scope
@@ -144,21 +150,22 @@ class OptmodKernel(ComputeKernel):
                     model.__set_constraint_type_and_shape__(c, 
                                                             'array',
                                                             [len(c_optmod)])
+                    batch = states.StateBatch(dict(constraint=c['url'],
+                                                   owner=model.get_owner_id()))
                     for i, cc in enumerate(c_optmod):
-                        constr_states.append(dict(
-                            constraint=c['url'],
-                            owner=model.get_owner_id(),
+                        batch.append(
                             index=[i],
                             label=c_labels[i] if i in c_labels else '',
                             kind='equality' if cc.op == '==' else 'inequality',
                             dual=cc.get_dual(),
-                            violation=cc.get_violation()))
+                            violation=cc.get_violation())
+                    constr_states.add(batch)
                 else:
                     raise TypeError('invalid constraint type')
-            model.__add_constraint_states__(constr_states)
+            constr_states.flush()
 
             # Extract solver state
-            print('Extracting solver state')
+            self.__phase__('extract', 'Extracting solver state')
             if model.has_solver():
                 s = model.__get_solver__()
                 s_optmod = scope[s['name']]
@@ -173,7 +180,7 @@ class OptmodKernel(ComputeKernel):
                 model.__add_solver_state__(s_state)
 
             # Extract problem state
-            print('Extracting problem state')
+            self.__phase__('extract', 'Extracting problem state')
             if model.has_problem():
                 p = model.__get_problem__()
                 p_optmod = scope[p['name']]
@@ -183,12 +190,12 @@ class OptmodKernel(ComputeKernel):
                 model.__add_problem_state__(p_state)
 
             # Extract output files
-            print('Extracting output files')
+            self.__phase__('extract', 'Extracting output files')
             for f in model.__get_interface_files__(type='output'):
                 model.__set_interface_file__(f, f['name']+f['extension'])
 
             # Extract output objects
-            print('Extracting output objects')
+            self.__phase__('extract', 'Extracting output objects')
             for o in model.__get_interface_objects__(type='output'):
                 o_optmod = scope[o['name']]
                 model.__set_interface_object__(o, o_optmod)
@@ -201,7 +208,7 @@ class OptmodKernel(ComputeKernel):
         finally:
 
             # Cleanup
-            print('Cleaning up local files')
+            self.__phase__('cleanup', 'Cleaning up local files')
             model.__delete_input_files__()
             model.__delete_input_object_files__()
             model.__delete_output_files__()
@@ -1,11 +1,121 @@
 import io
 import numpy as np
 
+from .. import states
 from .kernel import ComputeKernel
 
+def _component(instance, name):
+    """
+    Resolves model component by name.
+    """
+
+    component = instance.find_component(name)
+    if component is None:
+        raise ValueError('component %s not found' %name)
+    return component
+
+def _items(component):
+    """
+    Index keys and data objects of indexed component, in index order.
+    """
+
+    keys = []
+    data = []
+    for key, d in component.items():
+        keys.append(key)
+        data.append(d)
+    return keys, data
+
+def _shape(component, keys):
+    """
+    Shape of indexed component, two-dimensional if its index is a full
+    product of two sets.
+    """
+
+    shape = [len(keys)]
+    if component.dim() == 2:
+        d = [len(set([k[j] for k in keys])) for j in range(2)]
+        if d[0]*d[1] == len(keys):
+            shape = d
+    return shape
+
+def _violations(instance):
+    """
+    Violations of the active linear constraints of the instance, by
+    constraint data id. Each constraint body is reduced once to its linear
+    coefficients, gathered into a sparse matrix in coordinate form, so
+    that residuals cost a single vectorized product. Nonlinear constraints
+    are left out.
+    """
+
+    import pyomo.environ as pyo
+    from pyomo.repn import generate_standard_repn
+
+    rows, cols, coefs = [], [], []
+    columns = {}
+    x = []
+    data, constants, lower, upper = [], [], [], []
+    for d in instance.component_data_objects(pyo.Constraint, active=True):
+        try:
+            repn = generate_standard_repn(d.body, quadratic=False)
+        except Exception:
+            continue
+        if not repn.is_linear():
+            continue
+        i = len(data)
+        for v, coef in zip(repn.linear_vars, repn.linear_coefs):
+            j = columns.get(id(v))
+            if j is None:
+                j = columns[id(v)] = len(x)
+                x.append(v.value)
+            rows.append(i)
+            cols.append(j)
+            coefs.append(coef)
+        data.append(d)
+        constants.append(repn.constant)
+        lower.append(pyo.value(d.lower) if d.has_lb() else -np.inf)
+        upper.append(pyo.value(d.upper) if d.has_ub() else np.inf)
+
+    # Row residuals
+    x = np.array(x, dtype=float)
+    x[np.isnan(x)] = 0.
+    cols = np.array(cols, dtype=int)
+    ax = np.bincount(np.array(rows, dtype=int),
+                     weights=np.array(coefs, dtype=float)*x[cols],
+                     minlength=len(data))
+    ax += np.array(constants, dtype=float)
+    viol = np.maximum(np.maximum(np.array(lower, dtype=float)-ax,
+                                 ax-np.array(upper, dtype=float)),
+                      0.)
+
+    return {id(d): v for d, v in zip(data, viol.tolist())}
+
+def _violation(violations, d):
+    """
+    Violation of constraint data, from its slacks if it is nonlinear.
+    """
+
+    v = violations.get(id(d))
+    if v is None:
+        try:
+            v = max(0., -d.lslack(), -d.uslack())
+        except Exception:
+            v = 0.
+    return v
+
+def _labels(labels, keys):
+    """
+    Labels for the given keys, empty if not labeled.
+    """
+
+    if not labels:
+        return ['']*len(keys)
+    return [labels[k] if k in labels else '' for k in keys]
+
 class PyomoKernel(ComputeKernel):
 
     system = 'pyomo'
+    modules = ['pyomo.environ']
 
     def __run_model__(self):
 
@@ -17,22 +127,26 @@ class PyomoKernel(ComputeKernel):
         try:
 
             # Get recipe
-            print('Getting recipe')
+            self.__phase__('recipe', 'Getting recipe')
             recipe = io.StringIO()
             model.__write__(recipe)
 
             # Download input files
-            print('Downloading input files')
-            model.__download_input_files__()
+            self.__phase__('download', 'Downloading input files')
+            self.__download_input_files__()
 
             # Download input object files
-            print('Downloading input object files')
-            model.__download_input_object_files__()
+            self.__phase__('download', 'Downloading input object files')
+            self.__download_input_object_files__()
+
+            # Replay results of an identical earlier run
+            if self.__replay__(recipe):
+                return
 
             # Execute recipe in isolated scope
-            print('Executing model')
+            self.__phase__('execute', 'Executing model')
             scope = {}
-            exec(recipe.getvalue(), scope, scope)
+            self.__exec_recipe__(recipe, scope)
 
             try:
                 instance = scope['instance']
@@ -43,10 +157,10 @@ class PyomoKernel(ComputeKernel):
                     print("****Under MOS Pyomo kernel currently, an instance of AbstractModel must be named 'instance', while a a Concrete Model must be named 'model'****")
                     
             # Extract helper objects
-            print('Extracting helper objects')
+            self.__phase__('extract', 'Extracting helper objects')
             for o in model.__get_helper_objects__():
 
-                helper = eval('instance.' + o['name'])
+                helper = _component(instance, o['name'])
 
                 try:
                     if helper.is_parameter_type():
@@ -62,11 +176,11 @@ class PyomoKernel(ComputeKernel):
 
 
             # Extract variable states
-            print('Extracting variable states')
-            var_states = []
+            self.__phase__('extract', 'Extracting variable states')
+            var_states = states.StateUploader(self.__timed__('upload', model.__add_variable_states__))
             for v in model.__get_variables__():
 
-                variable = eval('instance.' + v['name'])
+                variable = _component(instance, v['name'])
                 
                 v_labels = scope[v['labels']] if v['labels'] else {}
                 
@@ -75,66 +189,61 @@ class PyomoKernel(ComputeKernel):
                     vshape = None
 
                     model.__set_var_type_and_shape__(v, vtype, vshape)
-                    var_states.append(dict(
-                        variable=v['url'],
-                        owner=model.get_owner_id(),
-                        index=None,
-                        label=v['name'],
-                        value=variable.expr()
-                        ))
+                    var_states.add(states.StateBatch(
+                        dict(variable=v['url'], owner=model.get_owner_id()),
+                        index=[None],
+                        label=[v['name']],
+                        value=[pyo.value(variable, exception=False)]))
                     
                 else:
-                    variable_dict = variable.get_values()
+                    keys, data = _items(variable)
                     vtype = 'array'
-                    vshape = [len(variable_dict)]
-                    
-
-                    if variable.dim() == 2:
-                        indices = list(variable_dict.keys())
-                        vd = []
-                        for j in range(2):
-                            vd.append(len(set([i[j] for i in indices])))
-                        if vd[0]*vd[1] == len(variable_dict):
-                            vshape = [vd[0],vd[1]]
-                        else:
-                            vshape = [len(variable_dict)]
-                        
+                    vshape = _shape(variable, keys)
                     model.__set_var_type_and_shape__(v, vtype, vshape)
 
-                    if variable._bounds_init_value != None:
-                        v_lb = variable._bounds_init_value[0] if variable._bounds_init_value[0] != None else -1e9
-                        v_ub = variable._bounds_init_value[1] if variable._bounds_init_value[1] != None else 1e9
-
-                    for key in variable_dict:
-                        vdomain = eval('instance.'+v['name']+'['+str(key)+'].domain')
-                        vkind = 'unknown'
-                        if vdomain.to_string() == 'Reals':
-                            vkind = 'continuous'
-                        elif vdomain.to_string() == 'Binary':
-                            vkind = 'binary'
-                            v_lb = 0
-                            v_ub = 1
-                        
-                        var_states.append(dict(
-                            variable=v['url'],
-                            owner=model.get_owner_id(),
-                            index=str(key),
-                            label=v_labels[key] if key in v_labels else '',
-                            value=variable_dict[key],
-                            kind = vkind,
-                            upper_bound=v_ub,
-                            lower_bound=v_lb
-                        ))
-            model.__add_variable_states__(var_states)
+                    # Kinds, resolved once per domain, which is kept so
+                    # that its id is not reused by another domain
+                    kinds = {}
+                    kind = []
+                    for d in data:
+                        domain = d.domain
+                        if id(domain) not in kinds:
+                            name = domain.to_string() if hasattr(domain, 'to_string') else str(domain)
+                            if name == 'Reals':
+                                kinds[id(domain)] = (domain, 'continuous')
+                            elif name == 'Binary':
+                                kinds[id(domain)] = (domain, 'binary')
+                            else:
+                                kinds[id(domain)] = (domain, 'unknown')
+                        kind.append(kinds[id(domain)][1])
+                    binary = np.array([k == 'binary' for k in kind], dtype=bool)
+
+                    # Bounds
+                    lb = np.array([d.lb for d in data], dtype=float)
+                    ub = np.array([d.ub for d in data], dtype=float)
+                    lb[np.isnan(lb)] = -1e9
+                    ub[np.isnan(ub)] = 1e9
+                    lb[binary] = 0
+                    ub[binary] = 1
+
+                    var_states.add(states.StateBatch(
+                        dict(variable=v['url'], owner=model.get_owner_id()),
+                        index=[str(key) for key in keys],
+                        label=_labels(v_labels, keys),
+                        value=[d.value for d in data],
+                        kind=kind,
+                        upper_bound=ub,
+                        lower_bound=lb))
+            var_states.flush()
 
 
             # Extract function states
-            print('Extracting function states')
-            func_states = []
+            self.__phase__('extract', 'Extracting function states')
+            func_states = states.StateUploader(self.__timed__('upload', model.__add_function_states__))
             for f in model.__get_functions__():
 
                 # Extract pyomo function 
-                f_pyomo = eval('instance.' + f['name'])
+                f_pyomo = _component(instance, f['name'])
                 f_labels = scope[f['labels']] if f['labels'] else {}
 
                 # Expression scalar
@@ -143,86 +252,56 @@ class PyomoKernel(ComputeKernel):
                     ftype = 'scalar'
                     fshape = None
                     model.__set_func_type_and_shape__(f, ftype, fshape)
-                    func_states.append(dict(
-                        function=f['url'],
-                        owner=model.get_owner_id(),
-                        index=None,
-                        label=f['name'],
-                        value=(f_pyomo.expr())
-                    ))
+                    func_states.add(states.StateBatch(
+                        dict(function=f['url'], owner=model.get_owner_id()),
+                        index=[None],
+                        label=[f['name']],
+                        value=[pyo.value(f_pyomo)]))
 
                     
                 #TODO add array and matrix function capabilities
                         
-            model.__add_function_states__(func_states)
+            func_states.flush()
 
             # Extract constraint states
-            print('Extracting constraint states')
-            constr_states = []
+            self.__phase__('extract', 'Extracting constraint states')
+            constr_states = states.StateUploader(self.__timed__('upload', model.__add_constraint_states__))
+            duals = instance.component('dual')
+            if not isinstance(duals, pyo.Suffix):
+                duals = {}
+            violations = _violations(instance)
     
             for c in model.__get_constraints__():
 
                 c_labels = scope[c['labels']] if c['labels'] else {}
 
-                c_pyomo = eval('instance.'+c['name'])
+                c_pyomo = _component(instance, c['name'])
                 
                 if c_pyomo.dim() == 0:
                     ctype = 'scalar'
                     cshape = None
-                                
-                    try:
-                        instance.dual[c_pyomo]
-                        exist_dual = True
-                    except:
-                        exist_dual = False
-
-                    constr_states.append(dict(
-                        constraint=c['url'],
-                        owner=model.get_owner_id(),
-                        index=None,
-                        label=c['name'],
-                        kind='equality' if c_pyomo.equality else 'inequality',
-                        dual=instance.dual[c_pyomo] if exist_dual else 0,
-                        violation=0)) # NEED TO FIX
-
+                    keys, data = [None], [c_pyomo]
+                    labels = [c['name']]
                 else:
+                    keys, data = _items(c_pyomo)
                     ctype = 'array'
-                    cshape = [len(c_pyomo)]
-                    
-                    if c_pyomo.dim() == 2:
-                        indices_c = list(c_pyomo.keys())
-                        cd = []
-                        for j in range(2):
-                            cd.append(len(set([i[j] for i in indices_c])))
-                        if cd[0]*cd[1] == len(indices_c):
-                            cshape = [cd[0],cd[1]] 
-
-                    for key in c_pyomo:
-
-                        try:
-                            instance.dual[c_pyomo[key]]
-                            exist_dual = True
-                        except:
-                            exist_dual = False
-
-                        
-                        constr_states.append(dict(
-                            constraint=c['url'],
-                            owner=model.get_owner_id(),
-                            index=key,
-                            label=c_labels[key] if key in c_labels else '',
-                            kind='equality' if c_pyomo[key].equality else 'inequality',
-                            dual=instance.dual[c_pyomo[key]] if exist_dual else 0,
-                            violation=0)) # NEED TO FIX
-
+                    cshape = _shape(c_pyomo, keys)
+                    labels = _labels(c_labels, keys)
                             
                 model.__set_constraint_type_and_shape__(c, ctype, cshape)
+                constr_states.add(states.StateBatch(
+                    dict(constraint=c['url'], owner=model.get_owner_id()),
+                    index=keys,
+                    label=labels,
+                    kind=['equality' if d.equality else 'inequality' for d in data],
+                    dual=[duals.get(d, 0) for d in data],
+                    violation=np.array([_violation(violations, d) for d in data], dtype=float)))
 
-            model.__add_constraint_states__(constr_states)
+            constr_states.flush()
 
 
             # Extract problem state
-            print('Extracting problem state')
+            self.__phase__('extract', 'Extracting problem state')
 
             p = model.__get_problem__()
             
@@ -234,7 +313,7 @@ class PyomoKernel(ComputeKernel):
 
 
             # Extract solver state
-            print('Extracting solver state')
+            self.__phase__('extract', 'Extracting solver state')
 
             s = model.__get_solver__()
             
@@ -260,7 +339,7 @@ class PyomoKernel(ComputeKernel):
         finally:
 
             # Cleanup
-            print('Cleaning up local files')
+            self.__phase__('cleanup', 'Cleaning up local files')
             model.__delete_input_files__()
             model.__delete_input_object_files__()
             model.__delete_output_files__()
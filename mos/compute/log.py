@@ -0,0 +1,199 @@
+import os
+import sys
+import codecs
+import ctypes
+import threading
+import collections
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+
+class ExecutionLog:
+    """
+    Execution log of a model run that keeps only its most recent output in
+    memory and uploads it to the backend while the model runs, at most
+    once per interval. Output is also echoed to the worker's stdout as it
+    arrives.
+
+    Parameters
+    ----------
+    upload : function that sets the log of the model, e.g.
+             model.__set_execution_log__
+    max_size : maximum number of characters kept (integer)
+    interval : minimum number of seconds between uploads (float)
+    """
+
+    def __init__(self, upload, max_size=None, interval=None):
+
+        if max_size is None:
+            max_size = int(os.getenv('MOS_COMPUTE_LOG_SIZE', 1024*1024))
+        if interval is None:
+            interval = float(os.getenv('MOS_COMPUTE_LOG_INTERVAL', 2))
+        self.upload = upload
+        self.max_size = max_size
+        self.interval = interval
+
+        self.cond = threading.Condition()
+        self.chunks = collections.deque()
+        self.size = 0
+        self.dropped = 0
+        self.dirty = False
+        self.closed = False
+        self.fd = None
+
+        self.thread = threading.Thread(target=self.__run__, daemon=True)
+        self.thread.start()
+
+    def __append__(self, data):
+
+        with self.cond:
+            self.chunks.append(data)
+            self.size += len(data)
+            while self.size > self.max_size:
+                excess = self.size-self.max_size
+                first = self.chunks[0]
+                if len(first) <= excess:
+                    self.chunks.popleft()
+                    n = len(first)
+                else:
+                    self.chunks[0] = first[excess:]
+                    n = excess
+                self.size -= n
+                self.dropped += n
+            self.dirty = True
+
+    def write(self, data):
+        """
+        Writes output to the log.
+
+        Parameters
+        ----------
+        data : output (string)
+
+        Returns
+        -------
+        n : number of characters written (integer)
+        """
+
+        if not data:
+            return 0
+
+        # Through the captured stdout, which keeps native output in order
+        if self.fd is not None:
+            buf = data.encode('utf-8', errors='replace')
+            while buf:
+                buf = buf[os.write(self.fd, buf):]
+            return len(data)
+
+        self.__append__(data)
+        sys.__stdout__.write(data)
+        return len(data)
+
+    def flush(self):
+
+        if self.fd is None:
+            sys.__stdout__.flush()
+
+    def getvalue(self):
+        """
+        Gets the output kept in memory.
+
+        Returns
+        -------
+        log : log (string)
+        """
+
+        with self.cond:
+            value = ''.join(self.chunks)
+            if self.dropped:
+                value = '[... %d characters truncated ...]\n' %self.dropped + value
+            return value
+
+    @contextmanager
+    def capture(self, fds=None):
+        """
+        Context that sends stdout and stderr to the log. By default, this
+        includes output written to file descriptors 1 and 2 by native
+        code, e.g. solvers, unless env var MOS_COMPUTE_LOG_CAPTURE_FD is 0.
+
+        Parameters
+        ----------
+        fds : whether to capture file descriptors 1 and 2 (boolean)
+        """
+
+        if fds is None:
+            fds = os.getenv('MOS_COMPUTE_LOG_CAPTURE_FD', '1') != '0'
+
+        with redirect_stdout(self), redirect_stderr(self):
+            if not fds:
+                yield
+                return
+
+            # Route file descriptors 1 and 2 through a pipe
+            sys.__stdout__.flush()
+            sys.__stderr__.flush()
+            r, w = os.pipe()
+            saved = [os.dup(1), os.dup(2)]
+            os.dup2(w, 1)
+            os.dup2(w, 2)
+            os.close(w)
+            reader = threading.Thread(target=self.__read__, args=(r, saved[0]), daemon=True)
+            reader.start()
+            self.fd = 1
+
+            try:
+                yield
+            finally:
+
+                # Flush C stdio buffers of native code
+                try:
+                    ctypes.CDLL(None).fflush(None)
+                except Exception:
+                    pass
+
+                # Restore file descriptors, closing the write end of the pipe
+                self.fd = None
+                os.dup2(saved[0], 1)
+                os.dup2(saved[1], 2)
+                reader.join()
+                os.close(r)
+                for fd in saved:
+                    os.close(fd)
+
+    def __read__(self, fd, echo_fd):
+
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        while True:
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            try:
+                os.write(echo_fd, data)
+            except OSError:
+                pass
+            self.__append__(decoder.decode(data))
+        self.__append__(decoder.decode(b'', final=True))
+
+    def __run__(self):
+
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.closed, self.interval)
+                if self.closed:
+                    return
+                if not self.dirty:
+                    continue
+                self.dirty = False
+            try:
+                self.upload(self.getvalue())
+            except Exception as e:
+                print('Unable to upload execution log: %s' %e, file=sys.__stdout__)
+
+    def close(self):
+        """
+        Stops periodic uploads and uploads the final log.
+        """
+
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.upload(self.getvalue())
@@ -0,0 +1,156 @@
+import threading
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Metrics:
+    """
+    Counters, gauges and summaries of a worker, rendered in the Prometheus
+    text exposition format. Safe to use from concurrent threads.
+    """
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.types = collections.OrderedDict()
+        self.helps = {}
+        self.values = collections.OrderedDict()
+
+    def __declare__(self, name, typ, help):
+
+        if name not in self.types:
+            self.types[name] = typ
+            self.helps[name] = help
+
+    def __key__(self, name, labels):
+
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, help='', **labels):
+        """
+        Increments counter.
+
+        Parameters
+        ----------
+        name : metric name (string)
+        value : increment (float)
+        help : metric description (string)
+        labels : metric labels
+        """
+
+        with self.lock:
+            self.__declare__(name, 'counter', help)
+            key = self.__key__(name, labels)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, help='', **labels):
+        """
+        Sets gauge.
+
+        Parameters
+        ----------
+        name : metric name (string)
+        value : value (float)
+        help : metric description (string)
+        labels : metric labels
+        """
+
+        with self.lock:
+            self.__declare__(name, 'gauge', help)
+            self.values[self.__key__(name, labels)] = value
+
+    def add(self, name, value, help='', **labels):
+        """
+        Adds to gauge.
+
+        Parameters
+        ----------
+        name : metric name (string)
+        value : increment, possibly negative (float)
+        help : metric description (string)
+        labels : metric labels
+        """
+
+        with self.lock:
+            self.__declare__(name, 'gauge', help)
+            key = self.__key__(name, labels)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, help='', **labels):
+        """
+        Adds observation to summary.
+
+        Parameters
+        ----------
+        name : metric name (string)
+        value : observed value (float)
+        help : metric description (string)
+        labels : metric labels
+        """
+
+        with self.lock:
+            self.__declare__(name, 'summary', help)
+            for suffix, v in [('_sum', value), ('_count', 1)]:
+                key = self.__key__(name+suffix, labels)
+                self.values[key] = self.values.get(key, 0) + v
+
+    def render(self):
+        """
+        Renders metrics in the Prometheus text format.
+
+        Returns
+        -------
+        text : metrics (string)
+        """
+
+        lines = []
+        with self.lock:
+            for name, typ in self.types.items():
+                if self.helps[name]:
+                    lines.append('# HELP %s %s' %(name, self.helps[name]))
+                lines.append('# TYPE %s %s' %(name, typ))
+                names = [name+'_sum', name+'_count'] if typ == 'summary' else [name]
+                for (n, labels), value in self.values.items():
+                    if n not in names:
+                        continue
+                    if labels:
+                        n += '{%s}' %','.join('%s="%s"' %(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                              for k, v in labels)
+                    lines.append('%s %s' %(n, repr(float(value))))
+        return '\n'.join(lines)+'\n'
+
+    def serve(self, port, host=''):
+        """
+        Serves metrics over HTTP from a background thread.
+
+        Parameters
+        ----------
+        port : port (integer)
+        host : address to bind (string)
+
+        Returns
+        -------
+        server : ThreadingHTTPServer
+        """
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                data = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -0,0 +1,188 @@
+import os
+import queue
+import threading
+import numpy as np
+
+# Maximum number of states per upload request
+CHUNK_SIZE = int(os.getenv('MOS_COMPUTE_STATE_CHUNK_SIZE', 10000))
+
+# Maximum number of chunks waiting to be uploaded in the background
+UPLOAD_QUEUE_SIZE = int(os.getenv('MOS_COMPUTE_STATE_UPLOAD_QUEUE', 2))
+
+class StateBatch:
+    """
+    Columnar batch of states of a single model component.
+
+    Parameters
+    ----------
+    shared : fields common to all states of the batch, e.g. the component
+             url and the owner (dictionary)
+    columns : per-state fields, as NumPy arrays or sequences of equal length,
+              ValueError is raised otherwise
+    """
+
+    def __init__(self, shared, **columns):
+
+        self.shared = dict(shared)
+        self.columns = {}
+        for name, values in columns.items():
+            if not isinstance(values, np.ndarray):
+                values = list(values)
+            self.columns[name] = values
+
+        # Columns must line up with the labels, or the first column
+        ref = 'label' if 'label' in self.columns else next(iter(self.columns), None)
+        for name, values in self.columns.items():
+            n = len(self.columns[ref])
+            if len(values) != n:
+                raise ValueError('column %s has %d states, %s has %d' %(name, len(values), ref, n))
+
+    def __len__(self):
+
+        for values in self.columns.values():
+            return len(values)
+        return 0
+
+    def append(self, **fields):
+        """
+        Appends a single state to the batch.
+
+        Parameters
+        ----------
+        fields : per-state fields
+        """
+
+        for name, value in fields.items():
+            self.columns.setdefault(name, []).append(value)
+
+    def records(self, start=0, stop=None):
+        """
+        Expands a range of states into state records.
+
+        Parameters
+        ----------
+        start : first state (integer)
+        stop : end of range, exclusive (integer)
+
+        Returns
+        -------
+        records : list of dictionaries
+        """
+
+        names = list(self.columns.keys())
+        columns = []
+        for name in names:
+            values = self.columns[name][start:stop]
+            if isinstance(values, np.ndarray):
+                values = values.tolist()
+            columns.append(values)
+
+        return [dict(self.shared, **dict(zip(names, row))) for row in zip(*columns)]
+
+class StateUploader:
+    """
+    Uploads state batches in chunks of bounded size. Full chunks are
+    uploaded by a background thread while the next states are extracted,
+    with at most queue_size chunks waiting, so that memory stays bounded
+    regardless of model size.
+
+    Parameters
+    ----------
+    upload : function that uploads a list of state records, e.g.
+             model.__add_variable_states__
+    chunk_size : maximum number of states per upload (integer)
+    queue_size : maximum number of chunks waiting to be uploaded, or 0 to
+                 upload in the calling thread (integer)
+    """
+
+    # Seconds the upload thread waits for chunks before it exits
+    idle_timeout = 10.
+
+    def __init__(self, upload, chunk_size=None, queue_size=None):
+
+        self.upload = upload
+        self.chunk_size = chunk_size if chunk_size else CHUNK_SIZE
+        self.queue_size = queue_size if queue_size is not None else UPLOAD_QUEUE_SIZE
+        self.pending = []
+        self.count = 0
+
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(max(self.queue_size, 1))
+        self.thread = None
+        self.error = None
+
+    def __run__(self):
+
+        while True:
+            try:
+                records = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+
+                # Idle, e.g. extraction failed before flushing
+                with self.lock:
+                    if self.queue.empty():
+                        self.thread = None
+                        return
+                continue
+            if records is None:
+                return
+            try:
+                if self.error is None:
+                    self.upload(records)
+            except Exception as e:
+                self.error = e
+
+    def __send__(self, records):
+
+        if self.error is not None:
+            raise self.error
+
+        if self.queue_size <= 0:
+            self.upload(records)
+            return
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__run__, daemon=True)
+                self.thread.start()
+            self.queue.put(records)
+
+    def add(self, batch):
+        """
+        Adds batch of states, uploading every full chunk.
+
+        Parameters
+        ----------
+        batch : StateBatch
+        """
+
+        start = 0
+        while start < len(batch):
+            stop = min(len(batch), start+self.chunk_size-len(self.pending))
+            self.pending.extend(batch.records(start, stop))
+            start = stop
+            if len(self.pending) >= self.chunk_size:
+                self.__send__(self.pending)
+                self.count += len(self.pending)
+                self.pending = []
+
+    def flush(self):
+        """
+        Uploads pending states and waits for all uploads to finish.
+        """
+
+        if self.pending:
+            self.__send__(self.pending)
+            self.count += len(self.pending)
+            self.pending = []
+
+        with self.lock:
+            thread = self.thread
+            if thread is not None:
+                self.queue.put(None)
+                self.thread = None
+        if thread is not None:
+            thread.join()
+
+        if self.error is not None:
+            raise self.error
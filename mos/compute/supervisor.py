@@ -0,0 +1,531 @@
+import os
+import time
+import signal
+import itertools
+import collections
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import Future
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+class TaskError(Exception):
+    """
+    Task raised an exception, or its process exited before returning.
+    """
+
+class TaskKilled(TaskError):
+    """
+    Task process was killed for going over one of its limits.
+
+    Parameters
+    ----------
+    limit : limit that was exceeded, 'memory', 'cpu' or 'timeout' (string)
+    message : description (string)
+    pid : id of the killed process (integer)
+    """
+
+    def __init__(self, limit, message, pid=None):
+
+        super().__init__(message)
+        self.limit = limit
+        self.pid = pid
+
+class TaskCancelled(BaseException):
+    """
+    Raised in a task process when its task is cancelled, so that recipes
+    catching Exception do not swallow it, and set on the future of a
+    cancelled task that did not return.
+
+    Parameters
+    ----------
+    message : description (string)
+    pid : id of the task process, if it was killed (integer)
+    """
+
+    def __init__(self, message='Task cancelled', pid=None):
+
+        super().__init__(message)
+        self.pid = pid
+
+def _rss(pid):
+    """
+    Resident memory of a process and its descendants, in bytes, read from
+    /proc. Returns None where /proc is not available.
+    """
+
+    try:
+        with open('/proc/%d/statm' %pid) as f:
+            rss = int(f.read().split()[1])*PAGE_SIZE
+        for tid in os.listdir('/proc/%d/task' %pid):
+            with open('/proc/%d/task/%s/children' %(pid, tid)) as f:
+                for child in f.read().split():
+                    rss += _rss(int(child)) or 0
+    except (OSError, ValueError, IndexError):
+        return None
+    return rss
+
+# Connection of a task process to its supervisor, if solves are limited
+_supervisor = None
+
+def acquire_solve_slot():
+    """
+    Waits for one of the solve slots shared by the task processes of a
+    supervisor. Returns at once if solves are not limited.
+
+    Returns
+    -------
+    flag : True if a slot was acquired and must be released (boolean)
+    """
+
+    if _supervisor is None:
+        return False
+    _supervisor.send(('acquire',))
+    _supervisor.recv()
+    return True
+
+def release_solve_slot():
+    """
+    Releases solve slot acquired with acquire_solve_slot.
+    """
+
+    _supervisor.send(('release',))
+
+def _serve(conn, max_cpu, solve_slots):
+    """
+    Runs tasks received from the supervisor until told to stop. Each task
+    gets max_cpu seconds of CPU time on top of what the process has used.
+    """
+
+    global _supervisor
+
+    if solve_slots:
+        _supervisor = conn
+
+    # Own process group, so that solver subprocesses are killed with it
+    if hasattr(os, 'setsid'):
+        os.setsid()
+
+    # Cancellation of the running task
+    running = False
+    def cancel(signum, frame):
+        nonlocal running
+        if running:
+            running = False
+            raise TaskCancelled()
+    signal.signal(signal.SIGTERM, cancel)
+
+    while True:
+        try:
+            item = conn.recv()
+        except EOFError:
+            break
+        if item is None:
+            break
+
+        # Slot granted to a cancelled task
+        if item is True:
+            continue
+        func, args = item
+
+        if max_cpu and resource is not None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            soft = int(usage.ru_utime+usage.ru_stime)+max_cpu
+            if hard != resource.RLIM_INFINITY:
+                soft = min(soft, hard)
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+        try:
+            running = True
+            result = ('result', True, func(*args))
+        except BaseException:
+            result = ('result', False, traceback.format_exc())
+        finally:
+            running = False
+        try:
+            conn.send(result)
+        except Exception:
+            conn.send(('result', False, traceback.format_exc()))
+
+class Scheduler:
+    """
+    Queue of tasks, served by priority and, among tasks of equal priority,
+    by fair share between keys, e.g. users. The key with the fewest
+    running tasks goes first, then the one with the least recent usage,
+    i.e. run time decayed with the given half-life. Tasks of a key are
+    served in order of arrival. Safe to use from concurrent threads.
+
+    Parameters
+    ----------
+    half_life : half-life of past usage in seconds (float)
+    """
+
+    def __init__(self, half_life=600.):
+
+        self.half_life = half_life
+        self.cond = threading.Condition()
+        self.tasks = collections.defaultdict(lambda: collections.defaultdict(collections.deque))
+        self.running = collections.Counter()
+        self.usage = {}
+        self.count = itertools.count()
+        self.closed = False
+
+    def __usage__(self, key, now):
+
+        value, t = self.usage.get(key, (0., now))
+        return value*0.5**((now-t)/self.half_life)
+
+    def put(self, item, priority=0, key=None):
+        """
+        Adds task.
+
+        Parameters
+        ----------
+        item : task
+        priority : priority, higher first (integer)
+        key : fair share key
+        """
+
+        with self.cond:
+            self.tasks[priority][key].append((next(self.count), item))
+            self.cond.notify()
+
+    def get(self):
+        """
+        Waits for the next task to serve, which counts as running until
+        done is called.
+
+        Returns
+        -------
+        task : item and key, or None once closed and empty (tuple)
+        """
+
+        with self.cond:
+            self.cond.wait_for(lambda: self.tasks or self.closed)
+            if not self.tasks:
+                return None
+            priority = max(self.tasks)
+            now = time.monotonic()
+            keys = self.tasks[priority]
+            key = min(keys, key=lambda k: (self.running[k], self.__usage__(k, now), keys[k][0][0]))
+            n, item = keys[key].popleft()
+            if not keys[key]:
+                del keys[key]
+                if not keys:
+                    del self.tasks[priority]
+            self.running[key] += 1
+            return item, key
+
+    def done(self, key, seconds):
+        """
+        Records end of a task returned by get.
+
+        Parameters
+        ----------
+        key : fair share key
+        seconds : run time (float)
+        """
+
+        with self.cond:
+            self.running[key] -= 1
+            if not self.running[key]:
+                del self.running[key]
+            now = time.monotonic()
+            self.usage[key] = (self.__usage__(key, now)+seconds, now)
+
+            # Forget negligible usage
+            for k in [k for k in self.usage if k not in self.running and self.__usage__(k, now) < 1e-3]:
+                del self.usage[k]
+
+    def close(self):
+        """
+        Makes get return None once all tasks are served.
+        """
+
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class Supervisor:
+    """
+    Runs tasks in supervised child processes, one task at a time per
+    process. The resident memory of each process, including its
+    subprocesses, and the wall-clock time of its task are watched from a
+    thread of the parent, and CPU time is capped with RLIMIT_CPU. A
+    process that goes over a limit is killed with its process group and
+    replaced, and its task fails with TaskKilled. Processes otherwise stay
+    up across tasks, like those of a process pool.
+
+    Queued tasks are served by a Scheduler, by priority and fair share.
+    With solve_slots, tasks of all processes share that many solve slots,
+    so that more tasks than slots can download and upload concurrently.
+    Slots held by a process are released when its task ends, even if the
+    process is killed.
+
+    Cancelled tasks are dropped if still queued. Running ones get SIGTERM,
+    which raises TaskCancelled in the task, and are killed if they have
+    not returned within the grace period. Their process is replaced.
+
+    Parameters
+    ----------
+    num_workers : number of processes (integer)
+    mp_context : multiprocessing context
+    max_tasks_per_child : number of tasks after which a process is
+                          replaced (integer, None for no limit)
+    max_rss : memory limit per task in bytes (integer, None for no limit)
+    max_cpu : CPU time limit per task in seconds (integer, None for no limit)
+    timeout : wall-clock time limit per task in seconds (float, None for no limit)
+    cancel_grace : seconds a cancelled task has to return before its
+                   process is killed (float)
+    half_life : half-life of past usage in fair share, in seconds (float)
+    solve_slots : number of tasks solving at a time (integer, None for
+                  no limit)
+    interval : seconds between checks of running tasks (float)
+    """
+
+    def __init__(self, num_workers, mp_context=None, max_tasks_per_child=None,
+                 max_rss=None, max_cpu=None, timeout=None, cancel_grace=10.,
+                 half_life=600., solve_slots=None, interval=0.5):
+
+        self.ctx = mp_context if mp_context is not None else multiprocessing.get_context()
+        self.max_tasks_per_child = max_tasks_per_child
+        self.max_rss = max_rss
+        self.max_cpu = max_cpu
+        self.timeout = timeout
+        self.cancel_grace = cancel_grace
+        self.interval = interval
+        self.solve_slots = threading.Semaphore(solve_slots) if solve_slots else None
+
+        self.lock = threading.Lock()
+        self.held = {}
+        self.cancelled = {}
+        self.scheduler = Scheduler(half_life)
+        self.threads = [threading.Thread(target=self.__run__, daemon=True)
+                        for i in range(num_workers)]
+        for t in self.threads:
+            t.start()
+
+    def submit(self, func, *args, priority=0, key=None):
+        """
+        Schedules task.
+
+        Parameters
+        ----------
+        func : picklable function
+        args : picklable arguments
+        priority : priority, higher first (integer)
+        key : fair share key, e.g. user id
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+        """
+
+        future = Future()
+        self.scheduler.put((future, func, args), priority, key)
+        return future
+
+    def cancel(self, future):
+        """
+        Cancels task.
+
+        Parameters
+        ----------
+        future : future returned by submit
+
+        Returns
+        -------
+        flag : False if the task had already finished (boolean)
+        """
+
+        if future.cancel():
+            return True
+        with self.lock:
+            if future.done():
+                return False
+            self.cancelled.setdefault(future, time.monotonic())
+            return True
+
+    def shutdown(self, wait=True):
+        """
+        Stops processes once queued tasks are done.
+
+        Parameters
+        ----------
+        wait : whether to wait for queued tasks (boolean)
+        """
+
+        self.scheduler.close()
+        if wait:
+            for t in self.threads:
+                t.join()
+
+    def __start__(self):
+
+        conn, child_conn = self.ctx.Pipe()
+        process = self.ctx.Process(target=_serve,
+                                   args=(child_conn, self.max_cpu, self.solve_slots is not None))
+        process.start()
+        child_conn.close()
+        return process, conn
+
+    def __stop__(self, process, conn):
+
+        try:
+            conn.send(None)
+        except OSError:
+            pass
+        process.join(5)
+        if process.is_alive():
+            self.__kill__(process)
+        conn.close()
+
+    def __signal__(self, process, sig):
+
+        try:
+            os.killpg(process.pid, sig)
+        except (AttributeError, OSError):
+            if sig == signal.SIGKILL:
+                process.kill()
+            else:
+                process.terminate()
+
+    def __kill__(self, process):
+
+        self.__signal__(process, signal.SIGKILL)
+        process.join()
+
+    def __wait__(self, future, process, conn):
+        """
+        Waits for the result of the task sent to process, granting it solve
+        slots and killing it if it goes over a limit or ignores
+        cancellation.
+        """
+
+        try:
+            return self.__serve__(future, process, conn)
+        finally:
+            if self.held.pop(process.pid, False):
+                self.solve_slots.release()
+
+    def __serve__(self, future, process, conn):
+
+        start = time.monotonic()
+        terminated = False
+        waiting = False
+        while True:
+
+            # Grant solve slot
+            if waiting and self.solve_slots.acquire(blocking=False):
+                self.held[process.pid] = True
+                waiting = False
+                try:
+                    conn.send(True)
+                except OSError:
+                    pass
+
+            if conn.poll(0.05 if waiting else self.interval):
+                try:
+                    msg = conn.recv()
+                except EOFError:
+                    break
+                if msg[0] == 'acquire':
+                    waiting = True
+                elif msg[0] == 'release':
+                    if self.held.pop(process.pid, False):
+                        self.solve_slots.release()
+                else:
+                    _, ok, value = msg
+                    if ok:
+                        return value
+                    raise TaskError(value)
+                continue
+
+            cancelled = self.cancelled.get(future)
+            if cancelled is not None:
+                if not terminated:
+                    self.__signal__(process, signal.SIGTERM)
+                    terminated = True
+                elif time.monotonic()-cancelled > self.cancel_grace:
+                    self.__kill__(process)
+                    raise TaskCancelled('Task killed %g s after being cancelled' %self.cancel_grace,
+                                        process.pid)
+
+            if self.timeout and time.monotonic()-start > self.timeout:
+                self.__kill__(process)
+                raise TaskKilled('timeout',
+                                 'Task exceeded its wall-clock time limit of %g s' %self.timeout,
+                                 process.pid)
+
+            if self.max_rss:
+                rss = _rss(process.pid)
+                if rss is not None and rss > self.max_rss:
+                    self.__kill__(process)
+                    raise TaskKilled('memory',
+                                     'Task exceeded its memory limit of %.0f MB (%.0f MB resident)'
+                                     %(self.max_rss/2**20, rss/2**20),
+                                     process.pid)
+
+            if not process.is_alive():
+                break
+
+        # Process exited without returning
+        process.join()
+        if hasattr(signal, 'SIGXCPU') and process.exitcode == -signal.SIGXCPU:
+            raise TaskKilled('cpu',
+                             'Task exceeded its CPU time limit of %d s' %self.max_cpu,
+                             process.pid)
+        raise TaskError('Task process exited with code %s' %process.exitcode)
+
+    def __run__(self):
+
+        process = conn = None
+        count = 0
+        while True:
+
+            item = self.scheduler.get()
+            if item is None:
+                break
+            (future, func, args), key = item
+            if not future.set_running_or_notify_cancel():
+                self.scheduler.done(key, 0.)
+                continue
+            start = time.monotonic()
+
+            try:
+                if process is None:
+                    process, conn = self.__start__()
+                    count = 0
+                conn.send((func, args))
+                count += 1
+                result = self.__wait__(future, process, conn)
+            except BaseException as e:
+                pid = None
+                if process is not None and not process.is_alive():
+                    pid = process.pid
+                    conn.close()
+                    process = None
+                if future in self.cancelled and not isinstance(e, TaskCancelled):
+                    e = TaskCancelled(pid=pid)
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            with self.lock:
+                cancelled = self.cancelled.pop(future, None) is not None
+            self.scheduler.done(key, time.monotonic()-start)
+
+            # Processes interrupted by a cancellation may be left in a
+            # broken state, e.g. by a partial import, and are replaced
+            if process is not None and (cancelled or self.max_tasks_per_child and count >= self.max_tasks_per_child):
+                self.__stop__(process, conn)
+                process = None
+
+        if process is not None:
+            self.__stop__(process, conn)
@@ -1,49 +1,134 @@
 import os
-from mos.interface import Interface
+import glob
+import time
+import shutil
+import tempfile
 
 from . import utils
+from . import cache
+from . import backend
 from .kernel import new_kernel
 
-def model_run(model_id, model_name, caller_id):
+def model_run(model_id, model_name, caller_id, queued_at=None):
+    """
+    Runs model.
+
+    Parameters
+    ----------
+    model_id : model id
+    model_name : model name (string)
+    caller_id : id of user to notify
+    queued_at : time the task was queued, in seconds since the epoch (float)
+
+    Returns
+    -------
+    result : dictionary with modeling system, status, queue wait and total
+             time, time spent in each phase of the run, and hits and
+             misses of each cache during the run
+    """
+
+    started = time.time()
+    start = time.perf_counter()
+
+    # Private working directory for task files
+    start_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='mos-task-%d-' %os.getpid(), dir=os.getenv('MOS_COMPUTE_WORKDIR'))
+    os.chdir(work_dir)
 
-    backend_host = os.getenv('MOS_BACKEND_HOST', 'localhost')
-    backend_port = os.getenv('MOS_BACKEND_PORT', '8000')
-    
-    # Get kernel
     try:
-        if backend_port == '443':
-            protocol = 'https'
-        else:
-            protocol = 'http'
-            
-        interface = Interface('%s://%s:%s/api/' %(
-            protocol, 
-            backend_host, 
-            backend_port))
-
-        if not os.getenv('MOS_BACKEND_TOKEN'):
-            token = interface.get_user_token(
-                os.getenv('MOS_ADMIN_USR'),
-                os.getenv('MOS_ADMIN_PWD'),
+    
+        # Get kernel
+        try:
+            interface = backend.get_pool().get_interface()
+            model = interface.get_model_with_id(model_id)
+            kernel = new_kernel(model, caller_id)
+
+        except Exception as e:
+            pusher = utils.PusherClient(caller_id)
+            pusher.send(
+                {
+                    'model_id': model_id,
+                    'model_name': model_name,
+                    'status': 'error'
+                }
             )
-        else:
-            token = os.getenv('MOS_BACKEND_TOKEN')
-            
-        interface.set_token(token)
+            raise e
+
+        # Run model
+        counts = cache.get_cache_counts()
+        kernel.run_model()
+
+        caches = {}
+        for name, c in cache.get_cache_counts().items():
+            before = counts.get(name, {})
+            caches[name] = {k: v-before.get(k, 0) for k, v in c.items()}
+
+        return dict(system=kernel.system,
+                    status=kernel.status,
+                    wait=started-queued_at if queued_at is not None else None,
+                    elapsed=time.perf_counter()-start,
+                    timings=kernel.timings,
+                    caches=caches)
 
+    finally:
+
+        # Remove working directory
+        os.chdir(start_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+        # Deliver status notifications before the process may exit
+        utils.get_notifier().flush(float(os.getenv('MOS_NOTIFY_FLUSH_TIMEOUT', 5)))
+
+def model_status(model_id, model_name, caller_id, status, message):
+    """
+    Reports final status of model run on behalf of a task that could not
+    do so itself, e.g. because its process was killed or it was cancelled
+    before starting. The message is appended to the execution log
+    uploaded so far.
+
+    Parameters
+    ----------
+    model_id : model id
+    model_name : model name (string)
+    caller_id : id of user to notify
+    status : 'error' or 'cancelled' (string)
+    message : reason (string)
+
+    Returns
+    -------
+    system : modeling system (string)
+    """
+
+    try:
+        interface = backend.get_pool().get_interface()
         model = interface.get_model_with_id(model_id)
-        kernel = new_kernel(model, caller_id)
+        model.__set_execution_log__('%s\n%s\n' %(model.get_execution_log() or '', message))
+        model.__set_status__(status)
+        return model.get_system()
 
-    except Exception as e:
+    finally:
         pusher = utils.PusherClient(caller_id)
         pusher.send(
             {
                 'model_id': model_id,
                 'model_name': model_name,
-                'status': 'error'
+                'status': status
             }
         )
-        raise e
+        utils.get_notifier().flush(float(os.getenv('MOS_NOTIFY_FLUSH_TIMEOUT', 5)))
+
+def cleanup(pid):
+    """
+    Removes working directories and GAMS scratch directories left by
+    tasks of a process that was killed.
+
+    Parameters
+    ----------
+    pid : process id (integer)
+    """
 
-    # Run model
-    kernel.run_model()
+    root = os.getenv('MOS_COMPUTE_WORKDIR') or tempfile.gettempdir()
+    scratch = os.getenv('MOS_GAMS_SCRATCH') or tempfile.gettempdir()
+    for path in (glob.glob(os.path.join(root, 'mos-task-%d-*' %pid))+
+                 glob.glob(os.path.join(scratch, 'mos-gams-%d-*' %pid))):
+        shutil.rmtree(path, ignore_errors=True)
@@ -1,10 +1,28 @@
 import os
+import sys
 import json
+import time
+import select
+import threading
+import collections
 from websocket import create_connection
 
-class PusherClient:
+class Notifier:
+    """
+    Long-lived sender of user notifications, shared by all tasks of a
+    worker process. Messages are queued without blocking and delivered by
+    a background thread over one websocket per user, kept open across
+    tasks and reopened when it fails. Identical messages still waiting to
+    be sent are coalesced into the most recent one, so that they keep
+    their order relative to the messages queued in between.
 
-    def __init__(self, user_id):
+    Parameters
+    ----------
+    max_connections : maximum number of open websockets (integer)
+    max_attempts : delivery attempts per message (integer)
+    """
+
+    def __init__(self, max_connections=None, max_attempts=None):
 
         host = os.getenv('MOS_BACKEND_HOST', 'localhost')
         port = os.getenv('MOS_BACKEND_PORT', '8000')
@@ -12,13 +30,143 @@ class PusherClient:
             ws = 'wss'
         else:
             ws = 'ws'
-        self.ws = create_connection('{ws}://{host}:{port}/ws/notifications/{user_id}/'.format(
+        self.url = '{ws}://{host}:{port}/ws/notifications/'.format(
             ws=ws,
             host=host,
-            port=port,
-            user_id=user_id 
-        )) 
+            port=port
+        )
+
+        if max_connections is None:
+            max_connections = int(os.getenv('MOS_NOTIFY_MAX_CONNECTIONS', 32))
+        if max_attempts is None:
+            max_attempts = int(os.getenv('MOS_NOTIFY_MAX_ATTEMPTS', 5))
+        self.max_connections = max_connections
+        self.max_attempts = max_attempts
+
+        self.pid = os.getpid()
+        self.cond = threading.Condition()
+        self.pending = collections.OrderedDict()
+        self.sending = False
+        self.connections = collections.OrderedDict()
+
+        self.thread = threading.Thread(target=self.__run__, daemon=True)
+        self.thread.start()
+
+    def send(self, user_id, msg):
+        """
+        Queues message for user. Never blocks.
+
+        Parameters
+        ----------
+        user_id : user id
+        msg : message (dictionary)
+        """
+
+        data = json.dumps(msg)
+        with self.cond:
+            self.pending[(user_id, data)] = None
+            self.pending.move_to_end((user_id, data))
+            self.cond.notify()
+
+    def flush(self, timeout=None):
+        """
+        Waits for queued messages to be delivered.
+
+        Parameters
+        ----------
+        timeout : maximum wait in seconds (float)
+
+        Returns
+        -------
+        flag : True if all messages were handled (boolean)
+        """
+
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.pending and not self.sending,
+                                      timeout)
+
+    def __connect__(self, user_id):
+
+        return create_connection('%s%s/' %(self.url, user_id), timeout=10)
+
+    def __drain__(self, ws):
+
+        # Discard incoming frames so the socket buffer never fills up
+        while select.select([ws.sock], [], [], 0)[0]:
+            ws.recv()
+
+    def __close__(self, ws):
+
+        try:
+            ws.close()
+        except Exception:
+            pass
+
+    def __deliver__(self, user_id, data):
+
+        for attempt in range(self.max_attempts):
+            ws = self.connections.pop(user_id, None)
+            try:
+                if ws is None:
+                    ws = self.__connect__(user_id)
+                else:
+                    self.__drain__(ws)
+                ws.send(data)
+            except Exception:
+                if ws is not None:
+                    self.__close__(ws)
+                time.sleep(min(0.1*2**attempt, 5.))
+                continue
+
+            # Keep most recently used connections open
+            self.connections[user_id] = ws
+            while len(self.connections) > self.max_connections:
+                self.__close__(self.connections.popitem(last=False)[1])
+            return
+
+        print('Unable to send notification to user %s' %user_id, file=sys.__stdout__)
+
+    def __run__(self):
+
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending)
+                user_id, data = self.pending.popitem(last=False)[0]
+                self.sending = True
+            try:
+                self.__deliver__(user_id, data)
+            finally:
+                with self.cond:
+                    self.sending = False
+                    self.cond.notify_all()
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+def get_notifier():
+    """
+    Gets the notifier of the current process, creating it on first use
+    (and again in forked children, which do not inherit its thread).
+
+    Returns
+    -------
+    notifier : Notifier
+    """
+
+    global _notifier
+
+    with _notifier_lock:
+        if _notifier is None or _notifier.pid != os.getpid():
+            _notifier = Notifier()
+        return _notifier
+
+class PusherClient:
+
+    def __init__(self, user_id):
+
+        self.user_id = user_id
+        self.notifier = get_notifier()
 
     def send(self, msg):
 
-        self.ws.send(json.dumps(msg))
+        self.notifier.send(self.user_id, msg)
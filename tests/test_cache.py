@@ -0,0 +1,234 @@
+import os
+import sys
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pytest
+import requests
+
+from mos.compute import cache as cache_module
+from mos.compute.cache import InputCache, RecipeCache, ResultCache, RESULT_CALLS
+
+class FileServer:
+    """
+    Local HTTP server of input files, optionally with ETag validators.
+    """
+
+    def __init__(self, etags=True):
+
+        self.files = {}
+        self.gets = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                data = server.files[self.path]
+                etag = '"%s"' %hashlib.md5(data).hexdigest()
+                server.gets.append((self.path, self.headers.get('If-None-Match')))
+                if etags and self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                if etags:
+                    self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def url(self, path):
+
+        return 'http://127.0.0.1:%d%s' %(self.httpd.server_address[1], path)
+
+    def close(self):
+
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+@pytest.fixture
+def server():
+
+    s = FileServer()
+    yield s
+    s.close()
+
+def read(path):
+
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_input_cache_revalidates(server, tmp_path):
+
+    cache = InputCache(str(tmp_path/'cache'), 1024)
+    server.files['/a'] = b'a'*10
+
+    cache.fetch(requests, server.url('/a'), str(tmp_path/'a1'))
+    cache.fetch(requests, server.url('/a'), str(tmp_path/'a2'))
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert server.gets[1][1] is not None
+    assert read(tmp_path/'a2') == b'a'*10
+
+    # Changed content is downloaded again
+    server.files['/a'] = b'b'*10
+    cache.fetch(requests, server.url('/a'), str(tmp_path/'a3'))
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert read(tmp_path/'a3') == b'b'*10
+    assert read(tmp_path/'a1') == b'a'*10
+
+    # Content no url maps to is removed
+    assert len(os.listdir(cache.objects)) == 1
+
+def test_input_cache_versions(tmp_path):
+
+    server = FileServer(etags=False)
+    try:
+        cache = InputCache(str(tmp_path/'cache'), 1024)
+        server.files['/a'] = b'a'*10
+
+        cache.fetch(requests, server.url('/a'), str(tmp_path/'a1'), version='1')
+        cache.fetch(requests, server.url('/a'), str(tmp_path/'a2'), version='1')
+        assert len(server.gets) == 1
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # Without validators or versions, inputs are downloaded every time
+        cache.fetch(requests, server.url('/a'), str(tmp_path/'a3'))
+        server.files['/a'] = b'b'*10
+        cache.fetch(requests, server.url('/a'), str(tmp_path/'a4'), version='2')
+        assert len(server.gets) == 3
+        assert (cache.hits, cache.misses) == (1, 3)
+        assert read(tmp_path/'a4') == b'b'*10
+    finally:
+        server.close()
+
+def test_input_cache_evicts_shared_content(server, tmp_path):
+
+    cache = InputCache(str(tmp_path/'cache'), 25)
+    server.files.update({'/a': b'x'*10, '/b': b'x'*10, '/c': b'y'*10, '/d': b'z'*10})
+
+    for name in 'abc':
+        cache.fetch(requests, server.url('/'+name), str(tmp_path/name))
+    assert len(os.listdir(cache.objects)) == 2
+    for t, name in enumerate('acb'):
+        os.utime(cache.__meta_path__(server.url('/'+name)), (t, t))
+
+    # Oldest url goes first, but its content stays while /b maps to it
+    cache.fetch(requests, server.url('/d'), str(tmp_path/'d'))
+    assert len(os.listdir(cache.keys)) == 2
+    assert sorted(read(os.path.join(cache.objects, name)) for name in os.listdir(cache.objects)) == [b'x'*10, b'z'*10]
+
+    # Input files are not links into the cache
+    assert read(tmp_path/'c') == b'y'*10
+    assert not any(os.path.islink(tmp_path/name) for name in 'abcd')
+
+def test_recipe_cache(tmp_path):
+
+    cache = RecipeCache(2, str(tmp_path/'recipes'))
+    a = cache.compile('x = 1')
+    assert cache.compile('x = 1') is a
+    cache.compile('x = 2')
+    cache.compile('x = 3')
+    assert list(cache.entries.values())[0] is not a
+    assert (cache.hits, cache.misses) == (1, 3)
+
+    # Evicted and new processes' recipes are loaded from disk
+    scope = {}
+    exec(RecipeCache(2, str(tmp_path/'recipes')).compile('x = 1'), scope)
+    assert scope['x'] == 1
+    assert cache.compile('x = 1') is not a
+    assert (cache.hits, cache.misses) == (2, 3)
+
+class Model:
+    """
+    Model recording the calls through which results are stored, with the
+    contents of stored files.
+    """
+
+    def __init__(self):
+
+        self.calls = []
+        for name in RESULT_CALLS:
+            setattr(Model, name, Model.__store__(name))
+
+    @staticmethod
+    def __store__(name):
+
+        def store(self, *args):
+            if name == '__set_interface_file__':
+                args = (args[0], read(args[1]))
+            self.calls.append((name, args))
+
+        return store
+
+def run(model, path):
+
+    model.__set_var_type_and_shape__({'name': 'x'}, 'scalar', [])
+    model.__add_variable_states__([{'label': 'x', 'value': 1.}])
+    model.__set_helper_object__({'name': 'h'}, {'a': [1, 2]})
+    with open(path, 'wb') as f:
+        f.write(b'output')
+    model.__set_interface_file__({'name': 'f'}, path)
+
+def test_result_cache(tmp_path):
+
+    cache = ResultCache(str(tmp_path/'results'), 2**20)
+    assert cache.replay(Model(), 'key') is None
+
+    # Recorded calls reach the model and are replayed in order
+    model = Model()
+    recorder = cache.record(model, 'key')
+    run(model, str(tmp_path/'out.txt'))
+    recorder.commit('log')
+    assert '__add_variable_states__' not in model.__dict__
+    replayed = Model()
+    assert cache.replay(replayed, 'key') == 'log'
+    assert replayed.calls == model.calls
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Discarded runs are not cached
+    recorder = cache.record(Model(), 'other')
+    recorder.discard()
+    assert cache.replay(Model(), 'other') is None
+    assert sorted(os.listdir(str(tmp_path/'results'))) == ['.lock', 'key']
+
+def test_result_cache_evicts(tmp_path):
+
+    cache = ResultCache(str(tmp_path/'results'), 3*2**19)
+    for key in ['a', 'b']:
+        model = Model()
+        recorder = cache.record(model, key)
+        run(model, str(tmp_path/'out.txt'))
+        recorder.commit('x'*600000)
+    assert cache.replay(Model(), 'a') == 'x'*600000
+    os.utime(str(tmp_path/'results'/'a'), (2., 2.))
+    os.utime(str(tmp_path/'results'/'b'), (1., 1.))
+
+    # Least recently used entry goes first
+    model = Model()
+    recorder = cache.record(model, 'c')
+    run(model, str(tmp_path/'out.txt'))
+    recorder.commit('x'*600000)
+    assert sorted(os.listdir(str(tmp_path/'results'))) == ['.lock', 'a', 'c']
+
+def test_cache_counts(monkeypatch, tmp_path):
+
+    monkeypatch.setattr(cache_module, '_recipe_cache', None)
+    monkeypatch.setattr(cache_module, '_input_cache', None)
+    monkeypatch.setenv('MOS_COMPUTE_INPUT_CACHE', str(tmp_path/'inputs'))
+    monkeypatch.delenv('MOS_COMPUTE_RESULT_CACHE', raising=False)
+    monkeypatch.delenv('MOS_COMPUTE_RECIPE_CACHE', raising=False)
+
+    cache_module.get_recipe_cache().compile('x = 1')
+    cache_module.get_recipe_cache().compile('x = 1')
+    assert cache_module.get_cache_counts() == dict(input=dict(hits=0, misses=0),
+                                                  recipe=dict(hits=1, misses=1))
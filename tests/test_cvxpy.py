@@ -0,0 +1,81 @@
+import os
+import sys
+import json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import pytest
+
+pytest.importorskip('cvxpy')
+
+import stub
+from mos.compute.kernel import new_kernel
+from mos.compute.kernel import cvxpy as cvxpy_kernel
+
+RECIPE = '''
+import json
+import cvxpy as cp
+import numpy as np
+
+c = cp.Parameter(3)
+x = cp.Variable(3)
+p = cp.Problem(cp.Minimize(c@x), [x >= -1, x <= 1])
+calls = []
+
+def mos_resolve():
+    global h
+    with open('c.json') as f:
+        c.value = np.array(json.load(f))
+    h = [c.value, 'label']
+    calls.append(1)
+    p.solve()
+
+mos_resolve()
+'''
+
+def run(model, c):
+
+    with open('c.json', 'w') as f:
+        json.dump(c, f)
+    kernel = new_kernel(model, 0)
+    kernel.pusher = stub.StubPusher()
+    kernel.run_model()
+    assert kernel.status == 'success', model.data['execution_log']
+
+def test_resolve_with_list_helper_object(monkeypatch, tmp_path):
+
+    monkeypatch.setenv('MOS_COMPUTE_LOG_CAPTURE_FD', '0')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cvxpy_kernel, '_problems', type(cvxpy_kernel._problems)())
+
+    model = stub.new_model('cvxpy', RECIPE, variables=[('x', None)], problem='p')
+    model.data['helper_objects'] = [dict(name='h', url=stub.BASE_URL+'helper_object/0/')]
+
+    # Uploaded states and helper objects
+    uploads = []
+    request = model.requests.request
+    def recorded(method, url, json=None, **kwargs):
+        if url.endswith('bulk_create/') or 'helper_object' in url:
+            uploads.append(json)
+        return request(method, url, json=json, **kwargs)
+    model.requests.request = recorded
+
+    run(model, [1., 1., 1.])
+    [(key, scope)] = cvxpy_kernel._problems.items()
+    assert key[0] == model.get_id()
+    assert len(scope['calls']) == 1
+    helper, states = uploads
+    assert helper == {'data': [[1., 1., 1.], 'label']}
+    assert [round(s['value']) for s in states] == [-1, -1, -1]
+
+    # Second run re-solves the cached problem with the new inputs instead
+    # of executing the recipe
+    uploads.clear()
+    run(model, [-1., 1., -1.])
+    assert list(cvxpy_kernel._problems.items()) == [(key, scope)]
+    assert len(scope['calls']) == 2
+    helper, states = uploads
+    assert helper == {'data': [[-1., 1., -1.], 'label']}
+    assert [round(s['value']) for s in states] == [1, -1, 1]
@@ -0,0 +1,109 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mos.compute.kernel.gams import CHECKPOINT_MARKER, CheckpointCache, _trace_summary, _hash_source
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+def test_trace_summary_wrapped():
+
+    summary = _trace_summary(os.path.join(DATA, 'wrapped.trc'))
+    assert summary == dict(type='MIP',
+                           solver='CPLEX',
+                           status='Integer Solution',
+                           time=0.5,
+                           iterations=12)
+
+def test_trace_summary_single_line(tmp_path):
+
+    path = tmp_path/'job.trc'
+    path.write_text('* Trace Record Definition\n'
+                    '* InputFileName,ModelType,SolverName,ModelStatus,SolverStatus,SolverTime,NumberOfIterations\n'
+                    '*\n'
+                    'job.gms,NLP,CONOPT,2,1,NA,17\n')
+    summary = _trace_summary(str(path))
+    assert summary == dict(type='NLP',
+                           solver='CONOPT',
+                           status='Locally Optimal',
+                           time=0,
+                           iterations=17)
+
+def test_trace_summary_missing_fields(tmp_path):
+
+    # Listing file is used instead
+    path = tmp_path/'job.trc'
+    path.write_text('* InputFileName,ModelType,SolverName\n'
+                    'job.gms,LP,CPLEX\n')
+    assert _trace_summary(str(path)) is None
+    path.write_text('* InputFileName,ModelType,SolverName,ModelStatus\n'
+                    'job.gms,LP\n')
+    assert _trace_summary(str(path)) is None
+
+def test_checkpoint_key(tmp_path):
+
+    # Same model in two scratch directories, with a nested include
+    dirs = [tmp_path/'a', tmp_path/'b']
+    for d in dirs:
+        d.mkdir()
+        (d/'model.gms').write_text('set i /1*3/;\n$gdxIn data.gdx\n')
+        (d/'data.gdx').write_bytes(b'v1')
+    def key(d):
+        return _hash_source('$include "%s"\nvariable x;\n' %(d/'model'), str(d))
+    assert key(dirs[0]) == key(dirs[1])
+
+    # Changed input read at compile time
+    (dirs[1]/'data.gdx').write_bytes(b'v2')
+    assert key(dirs[0]) != key(dirs[1])
+
+class Job:
+
+    def __init__(self, ws, source):
+
+        self.ws = ws
+        self.source = source
+
+    def run(self, checkpoint=None):
+
+        self.ws.compiled.append(self.source)
+        with open(checkpoint, 'w') as f:
+            f.write(self.source)
+
+class Workspace:
+    """
+    Stand-in for a GamsWorkspace, compiling checkpoints into text files.
+    """
+
+    def __init__(self, path):
+
+        self.working_directory = str(path)
+        self.compiled = []
+
+    def add_checkpoint(self, path):
+
+        return path
+
+    def add_job_from_string(self, source, checkpoint=None):
+
+        return Job(self, source)
+
+def test_checkpoint_cache(tmp_path):
+
+    ws = Workspace(tmp_path)
+    checkpoints = CheckpointCache(str(tmp_path/'cache'), 25)
+    recipe = 'set i /1*3/;\n'+CHECKPOINT_MARKER+'\nsolve m using lp;\n'
+
+    job = checkpoints.add_job(ws, recipe)
+    assert job.source == 'solve m using lp;\n'
+    checkpoints.add_job(ws, recipe)
+    assert ws.compiled == ['set i /1*3/;\n']
+    assert (checkpoints.hits, checkpoints.misses) == (1, 1)
+
+    # Least recently used checkpoints are evicted beyond the size cap
+    os.utime(os.path.join(checkpoints.path, os.listdir(checkpoints.path)[0]), (0, 0))
+    checkpoints.add_job(ws, 'set j /1*3/;\n'+CHECKPOINT_MARKER+'\n')
+    checkpoints.add_job(ws, 'set i /1*3/;\n'+CHECKPOINT_MARKER+'\n')
+    assert ws.compiled[1:] == ['set j /1*3/;\n', 'set i /1*3/;\n']
+    assert len([n for n in os.listdir(checkpoints.path) if n.endswith('.g00')]) == 1
@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+import pytest
+
+from mos.compute.states import StateBatch, StateUploader
+
+def test_state_batch_records():
+
+    batch = StateBatch(dict(variable='v', owner=1),
+                       index=np.array([[0, 0], [0, 1], [1, 0]]),
+                       label=['a', 'b', ''],
+                       value=np.array([1., 2., 3.]))
+    assert len(batch) == 3
+    assert batch.records(1) == [dict(variable='v', owner=1, index=[0, 1], label='b', value=2.),
+                                dict(variable='v', owner=1, index=[1, 0], label='', value=3.)]
+    assert isinstance(batch.records()[0]['value'], float)
+
+def test_state_batch_append():
+
+    batch = StateBatch(dict(constraint='c'))
+    assert len(batch) == 0
+    batch.append(index='x', dual=0.5)
+    batch.append(index='y', dual=1.5)
+    assert batch.records() == [dict(constraint='c', index='x', dual=0.5),
+                               dict(constraint='c', index='y', dual=1.5)]
+
+def test_state_batch_lengths():
+
+    with pytest.raises(ValueError):
+        StateBatch({}, index=[0, 1, 2], label=['a', 'b', 'c'], value=np.ones(1))
+    with pytest.raises(ValueError):
+        StateBatch({}, index=[0], value=[1., 2.])
+
+def test_state_uploader_chunks():
+
+    uploads = []
+    uploader = StateUploader(uploads.append, chunk_size=3, queue_size=0)
+    uploader.add(StateBatch({}, value=range(5)))
+    assert [[r['value'] for r in u] for u in uploads] == [[0, 1, 2]]
+    uploader.add(StateBatch({}, value=range(5, 7)))
+    uploader.add(StateBatch({}, value=[]))
+    uploader.flush()
+    assert [[r['value'] for r in u] for u in uploads] == [[0, 1, 2], [3, 4, 5], [6]]
+    assert uploader.count == 7
+
+    # Nothing pending
+    uploader.flush()
+    assert len(uploads) == 3
+
+def test_state_uploader_background():
+
+    uploads = []
+    main = threading.get_ident()
+    def upload(records):
+        assert threading.get_ident() != main
+        time.sleep(0.01)
+        uploads.append(len(records))
+    uploader = StateUploader(upload, chunk_size=2, queue_size=1)
+    for i in range(5):
+        uploader.add(StateBatch({}, value=[i, i]))
+    uploader.flush()
+    assert uploads == [2]*5
+    assert uploader.thread is None
+
+def test_state_uploader_errors():
+
+    def upload(records):
+        raise IOError('upload failed')
+    uploader = StateUploader(upload, chunk_size=2, queue_size=2)
+    uploader.add(StateBatch({}, value=[0, 1]))
+    with pytest.raises(IOError):
+        uploader.flush()
+
+    # Later chunks are not sent once an upload failed
+    uploader = StateUploader(upload, chunk_size=1, queue_size=2)
+    uploader.add(StateBatch({}, value=[0]))
+    while uploader.error is None:
+        time.sleep(0.01)
+    with pytest.raises(IOError):
+        uploader.add(StateBatch({}, value=[1]))
+
+def test_state_uploader_idle(monkeypatch):
+
+    monkeypatch.setattr(StateUploader, 'idle_timeout', 0.05)
+    uploads = []
+    uploader = StateUploader(uploads.append, chunk_size=1, queue_size=2)
+
+    # Upload thread exits when extraction stops without flushing
+    uploader.add(StateBatch({}, value=[0]))
+    thread = uploader.thread
+    thread.join(2)
+    assert not thread.is_alive()
+    assert uploader.thread is None
+
+    # and is started again for later chunks
+    uploader.add(StateBatch({}, value=[1, 2]))
+    uploader.flush()
+    assert [r[0]['value'] for r in uploads] == [0, 1, 2]
@@ -0,0 +1,159 @@
+import os
+import sys
+import time
+import multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pytest
+
+from concurrent.futures import CancelledError
+
+from mos.compute.supervisor import Scheduler, Supervisor, TaskError, TaskKilled, TaskCancelled
+
+ctx = multiprocessing.get_context('fork')
+
+def add(a, b):
+    return a+b
+
+def pid():
+    return os.getpid()
+
+def fail():
+    raise RuntimeError('task failed')
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+def allocate(mb):
+    data = b'x'*(mb*2**20)
+    time.sleep(10)
+    return len(data)
+
+def spin():
+    while True:
+        pass
+
+def exit():
+    os._exit(3)
+
+def stubborn(seconds):
+    try:
+        time.sleep(seconds)
+    except BaseException:
+        time.sleep(seconds)
+
+@pytest.fixture
+def supervisor(request):
+
+    kwargs = getattr(request, 'param', {})
+    s = Supervisor(1, mp_context=ctx, interval=0.05, **kwargs)
+    yield s
+    s.shutdown()
+
+def test_results(supervisor):
+
+    assert supervisor.submit(add, 1, 2).result(10) == 3
+    with pytest.raises(TaskError, match='task failed'):
+        supervisor.submit(fail).result(10)
+
+    # Process is kept across tasks, including failed ones
+    assert supervisor.submit(pid).result(10) == supervisor.submit(pid).result(10)
+
+def test_max_tasks_per_child():
+
+    supervisor = Supervisor(1, mp_context=ctx, max_tasks_per_child=1)
+    try:
+        assert supervisor.submit(pid).result(10) != supervisor.submit(pid).result(10)
+    finally:
+        supervisor.shutdown()
+
+def test_exit(supervisor):
+
+    with pytest.raises(TaskError, match='exited with code 3'):
+        supervisor.submit(exit).result(10)
+    assert supervisor.submit(add, 1, 1).result(10) == 2
+
+@pytest.mark.parametrize('supervisor', [dict(timeout=0.5)], indirect=True)
+def test_timeout(supervisor):
+
+    with pytest.raises(TaskKilled) as e:
+        supervisor.submit(sleep, 10).result(10)
+    assert e.value.limit == 'timeout'
+    assert e.value.pid is not None
+
+    # Killed process is replaced
+    assert supervisor.submit(sleep, 0).result(10) == 0
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/statm'), reason='needs /proc')
+@pytest.mark.parametrize('supervisor', [dict(max_rss=200*2**20)], indirect=True)
+def test_memory(supervisor):
+
+    with pytest.raises(TaskKilled) as e:
+        supervisor.submit(allocate, 400).result(20)
+    assert e.value.limit == 'memory'
+
+@pytest.mark.parametrize('supervisor', [dict(max_cpu=1)], indirect=True)
+def test_cpu(supervisor):
+
+    with pytest.raises(TaskKilled) as e:
+        supervisor.submit(spin).result(20)
+    assert e.value.limit == 'cpu'
+
+@pytest.mark.parametrize('supervisor', [dict(cancel_grace=0.5)], indirect=True)
+def test_cancel(supervisor):
+
+    # Running task is interrupted, and its process replaced
+    running = supervisor.submit(pid)
+    first = running.result(10)
+    running = supervisor.submit(sleep, 10)
+    queued = supervisor.submit(sleep, 10)
+    time.sleep(0.5)
+    assert supervisor.cancel(running)
+    assert supervisor.cancel(queued)
+    with pytest.raises(TaskCancelled):
+        running.result(10)
+    with pytest.raises(CancelledError):
+        queued.result(10)
+    assert supervisor.submit(pid).result(10) != first
+
+    # Task ignoring cancellation is killed after the grace period
+    ignoring = supervisor.submit(stubborn, 10)
+    time.sleep(0.5)
+    supervisor.cancel(ignoring)
+    with pytest.raises(TaskCancelled) as e:
+        ignoring.result(10)
+    assert e.value.pid is not None
+
+    done = supervisor.submit(add, 1, 1)
+    assert done.result(10) == 2
+    assert not supervisor.cancel(done)
+
+def test_scheduler():
+
+    scheduler = Scheduler(half_life=600.)
+
+    # Priority first, then fewest running tasks, in order of arrival within a key
+    scheduler.put('a1', key='a')
+    scheduler.put('a2', key='a')
+    scheduler.put('b1', key='b')
+    scheduler.put('c1', priority=1, key='c')
+    assert scheduler.get() == ('c1', 'c')
+    assert scheduler.get() == ('a1', 'a')
+    assert scheduler.get() == ('b1', 'b')
+    scheduler.done('c', 1.)
+    scheduler.done('b', 1.)
+    assert scheduler.get() == ('a2', 'a')
+    scheduler.done('a', 100.)
+    scheduler.done('a', 100.)
+
+    # Least usage first among keys with no running tasks
+    scheduler.put('a3', key='a')
+    scheduler.put('b2', key='b')
+    assert scheduler.get() == ('b2', 'b')
+    assert scheduler.get() == ('a3', 'a')
+
+    scheduler.close()
+    assert scheduler.get() is None
@@ -0,0 +1,117 @@
+import os
+import sys
+import json
+import time
+import threading
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import pytest
+
+pytest.importorskip('cvxpy')
+
+import pika
+from models import models
+from loadtest import FakeBackend, InProcessConnection
+
+class Statuses(dict):
+    """
+    Model statuses, keeping their history.
+    """
+
+    def __init__(self):
+
+        super().__init__()
+        self.history = []
+
+    def __setitem__(self, key, value):
+
+        super().__setitem__(key, value)
+        self.history.append((key, value))
+
+@pytest.fixture
+def worker(monkeypatch, tmp_path):
+    """
+    Worker consuming from the in-process broker of the load test, against
+    its fake backend.
+    """
+
+    backend = FakeBackend()
+    backend.statuses = Statuses()
+    backend.add_model(1, 'cvxpy', models['cvxpy'](1000))
+    backend.start()
+    monkeypatch.setenv('MOS_BACKEND_HOST', '127.0.0.1')
+    monkeypatch.setenv('MOS_BACKEND_PORT', str(backend.port))
+    monkeypatch.setenv('MOS_BACKEND_TOKEN', 'token')
+    monkeypatch.setenv('MOS_COMPUTE_WORKERS', '1')
+    monkeypatch.setenv('MOS_COMPUTE_WORKDIR', str(tmp_path))
+    monkeypatch.setenv('NO_PROXY', '127.0.0.1')
+
+    spec = importlib.util.spec_from_file_location('worker', os.path.join(ROOT, 'workers', 'worker.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    acked = []
+    connection = InProcessConnection(lambda body: acked.append(json.loads(body)))
+    thread = threading.Thread(target=module.main, args=(connection,))
+    thread.start()
+    yield connection, backend, acked
+    connection.stop()
+    thread.join()
+    backend.stop()
+
+def publish(connection, queue, msg, **properties):
+
+    connection.basic_publish(exchange=queue if queue.endswith('.cancel') else '',
+                             routing_key=queue,
+                             body=json.dumps(msg),
+                             properties=pika.BasicProperties(**properties))
+
+def test_rerun_after_cancel(worker):
+
+    connection, backend, acked = worker
+    task = {'model_id': 1, 'model_name': 'benchmark-1', 'caller_id': 1}
+
+    # Run, cancellation and rerun published within the same second
+    second = int(time.time())
+    now = time.time()
+    publish(connection, 'mos-python.cvxpy', task,
+            timestamp=second, headers={'timestamp_in_ms': int(now*1000)})
+    time.sleep(0.5)
+    publish(connection, 'mos-python.cancel', {'model_id': 1, 'cancelled_at': now+0.01},
+            timestamp=second)
+    publish(connection, 'mos-python.cvxpy', task,
+            timestamp=second, headers={'timestamp_in_ms': int((now+0.02)*1000)})
+
+    deadline = time.time()+60
+    while len(acked) < 2 and time.time() < deadline:
+        time.sleep(0.1)
+    assert len(acked) == 2
+    assert [status for id, status in backend.statuses.history] == ['running', 'cancelled', 'running', 'success']
+
+@pytest.mark.parametrize('global_qos', [False, True])
+def test_prefetch(global_qos):
+
+    connection = InProcessConnection()
+    received = []
+    connection.basic_qos(prefetch_count=2, global_qos=global_qos)
+    for queue in ['a', 'b']:
+        connection.queue_declare(queue=queue)
+        connection.basic_consume(queue, lambda ch, method, properties, body: received.append(method))
+        for i in range(3):
+            publish(connection, queue, i)
+
+    thread = threading.Thread(target=connection.start_consuming)
+    thread.start()
+    time.sleep(0.2)
+
+    # Prefetch count applies to each consumer, or to the channel
+    assert len(received) == (2 if global_qos else 4)
+    connection.basic_ack(received[0].delivery_tag)
+    time.sleep(0.2)
+    assert len(received) == (3 if global_qos else 5)
+    connection.stop()
+    thread.join()
@@ -4,6 +4,12 @@ import sys
 import pika
 import json
 import time
+import functools
+import threading
+import traceback
+import importlib.util
+import multiprocessing
+from concurrent.futures import CancelledError
 
 sys.path.insert(0, '.')
 
@@ -11,11 +17,18 @@ from dotenv import load_dotenv, find_dotenv
 load_dotenv(find_dotenv())
 
 from mos.compute import tasks
+from mos.compute import kernel
+from mos.compute.metrics import Metrics
+from mos.compute.supervisor import Supervisor, TaskKilled, TaskCancelled
 
-def main():
+def connect():
+    """
+    Connects to the message broker, waiting for it to be available.
 
-    print('MOS Python worker')
-    print('-----------------')
+    Returns
+    -------
+    connection : pika.BlockingConnection
+    """
 
     credentials = pika.PlainCredentials(
       os.getenv('MOS_RABBIT_USR', 'guest'),  
@@ -27,12 +40,13 @@ def main():
     conn_retries_int = int(os.getenv('MOS_COMPUTE_CONN_RETRIES_INT', 5))
     while conn_retries < conn_retries_max:
         try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters(
+            return pika.BlockingConnection(pika.ConnectionParameters(
                 host=os.getenv('MOS_RABBIT_HOST', 'localhost'),
                 port=os.getenv('MOS_RABBIT_PORT', 5672),
-                credentials=credentials
-            )) 
-            break
+                credentials=credentials,
+                heartbeat=int(os.getenv('MOS_RABBIT_HEARTBEAT', 60)),
+                blocked_connection_timeout=int(os.getenv('MOS_RABBIT_BLOCKED_TIMEOUT', 300))
+            ))
         except pika.exceptions.AMQPConnectionError:
             print('Waiting for message queue to be available ...')
             time.sleep(conn_retries_int)
@@ -40,20 +54,336 @@ def main():
     else:
         raise Exception("Unable to connect to rabbitmq")
 
+def published_at(properties):
+    """
+    Publication time of a message, in seconds since the epoch: header
+    timestamp_in_ms, as set by the broker's message timestamp plugin, or
+    else the AMQP timestamp, which has whole-second resolution.
+
+    Returns
+    -------
+    time : float, or None if the message has no timestamp
+    """
+
+    headers = properties.headers or {}
+    if headers.get('timestamp_in_ms'):
+        return headers['timestamp_in_ms']/1000.
+    if properties.timestamp:
+        return float(properties.timestamp)
+    return None
+
+def main(connection=None):
+    """
+    Consumes model run tasks.
+
+    Parameters
+    ----------
+    connection : broker connection, e.g. an in-process stand-in for load
+                 tests (connects to the broker if not provided)
+    """
+
+    print('MOS Python worker')
+    print('-----------------')
+
+    # Number of model execution slots
+    num_workers = int(os.getenv('MOS_COMPUTE_WORKERS', 1))
+    print('Model execution slots: %d' %num_workers)
+
+    # Number of models solved concurrently, while the other slots download
+    # inputs and upload results
+    num_solvers = int(os.getenv('MOS_COMPUTE_SOLVERS', 0)) or None
+    if num_solvers:
+        print('Solve slots: %d' %num_solvers)
+
+    # Modeling systems served, each from its own queue, and extra tasks
+    # held for the scheduler to choose from
+    systems = [x.strip() for x in os.getenv('MOS_COMPUTE_SYSTEMS', '').split(',') if x.strip()]
+    for system in systems:
+        if system not in [k.system for k in kernel.kernels]:
+            raise ValueError("Unsupported modeling system %s" %system)
+    queues = ['mos-python.%s' %system for system in (systems or [k.system for k in kernel.kernels])]
+    if not systems:
+        queues.append('mos-python')
+    print('Queues: %s' %', '.join(queues))
+    max_priority = int(os.getenv('MOS_COMPUTE_MAX_PRIORITY', 10))
+    prefetch = int(os.getenv('MOS_COMPUTE_PREFETCH', 0))
+    half_life = float(os.getenv('MOS_COMPUTE_FAIR_SHARE_HALF_LIFE', 600))
+
+    # Modeling systems and modules imported ahead of time
+    preload = [x.strip() for x in os.getenv('MOS_COMPUTE_PRELOAD', '').split(',') if x.strip()]
+
+    # Limits of each task, enforced by killing its process
+    max_rss = int(os.getenv('MOS_COMPUTE_TASK_MAX_MEMORY', 0))*2**20 or None
+    max_cpu = int(os.getenv('MOS_COMPUTE_TASK_MAX_CPU', 0)) or None
+    timeout = float(os.getenv('MOS_COMPUTE_TASK_TIMEOUT', 0)) or None
+    if max_rss or max_cpu or timeout:
+        print('Task limits: memory %s MB, CPU time %s s, wall-clock time %s s' %(
+            max_rss//2**20 if max_rss else '-', max_cpu or '-', timeout or '-'))
+
+    # Cancellation
+    cancel_exchange = os.getenv('MOS_COMPUTE_CANCEL_EXCHANGE', 'mos-python.cancel')
+    cancel_grace = float(os.getenv('MOS_COMPUTE_CANCEL_GRACE', 10))
+
+    # Redelivery
+    max_attempts = int(os.getenv('MOS_COMPUTE_MAX_ATTEMPTS', 3))
+    dead_letter_queue = os.getenv('MOS_COMPUTE_DEAD_LETTER_QUEUE', 'mos-python.dead')
+
+    if connection is None:
+        connection = connect()
+
+    # Metrics
+    metrics = Metrics()
+    metrics_port = os.getenv('MOS_COMPUTE_METRICS_PORT')
+    if metrics_port:
+        metrics.serve(int(metrics_port), os.getenv('MOS_COMPUTE_METRICS_HOST', ''))
+        print('Serving metrics on port %s' %metrics_port)
+
     channel = connection.channel()
-    channel.queue_declare(queue='mos-python')
+    for queue in queues:
+        if queue == 'mos-python':
+            channel.queue_declare(queue=queue)
+        else:
+            channel.queue_declare(queue=queue, arguments={'x-max-priority': max_priority})
+    channel.queue_declare(queue=dead_letter_queue, durable=True)
+
+    # Prefetch limit shared by the consumers of all queues of the channel,
+    # rather than applied to each consumer
+    channel.basic_qos(prefetch_count=num_workers+prefetch, global_qos=True)
+
+    # Cancellations are broadcast to all workers, each with its own queue
+    channel.exchange_declare(exchange=cancel_exchange, exchange_type='fanout')
+    cancel_queue = channel.queue_declare(queue='', exclusive=True).method.queue
+    channel.queue_bind(exchange=cancel_exchange, queue=cancel_queue)
+
+    def new_executor():
+
+        limits = dict(max_rss=max_rss, max_cpu=max_cpu, timeout=timeout,
+                      cancel_grace=cancel_grace, half_life=half_life,
+                      solve_slots=num_solvers)
+        if not preload:
+            return Supervisor(num_workers, **limits)
+
+        # Tasks run in children forked from a warm fork server
+        modules = kernel.get_modules(preload)
+        for m in modules:
+            if importlib.util.find_spec(m.split('.')[0]) is None:
+                print('Module %s not available for preloading' %m)
+        print('Preloading %s' %', '.join(modules))
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload(['mos.compute.tasks', 'mos.compute.supervisor'] + modules)
+        return Supervisor(num_workers, mp_context=ctx, max_tasks_per_child=1, **limits)
+
+    executor = new_executor()
+
+    # Tasks received and not finished, by delivery tag, and times of
+    # cancellations by model id
+    active = {}
+    cancelled = {}
+
+    # Callbacks below run on the connection thread, which keeps
+    # servicing heartbeats while models are solved in supervised processes
+
+    def ack(delivery_tag):
+        if channel.is_open:
+            channel.basic_ack(delivery_tag)
+
+    def retry(method, properties, body):
+        """
+        Requeues a failed task with an incremented attempt count, or moves
+        it to the dead-letter queue once the maximum number of attempts has
+        been reached. The original delivery is acked in both cases. Other
+        message properties are kept, so that the timestamp still dates the
+        task for cancellation and queue wait metrics.
+        """
+
+        headers = dict(properties.headers or {})
+        attempts = int(headers.get('x-mos-attempts', 0)) + 1
+        headers['x-mos-attempts'] = attempts
+        if attempts >= max_attempts:
+            print("Task dead-lettered after %d attempts" %attempts)
+            routing_key = dead_letter_queue
+        else:
+            print("Task requeued (attempt %d of %d)" %(attempts+1, max_attempts))
+            routing_key = method.routing_key
+        channel.basic_publish(exchange='',
+                              routing_key=routing_key,
+                              body=body,
+                              properties=pika.BasicProperties(
+                                  headers=headers,
+                                  timestamp=properties.timestamp,
+                                  priority=properties.priority,
+                                  message_id=properties.message_id,
+                                  correlation_id=properties.correlation_id,
+                                  expiration=properties.expiration,
+                                  content_type=properties.content_type,
+                                  delivery_mode=properties.delivery_mode))
+        ack(method.delivery_tag)
+
+    def record(result):
+        """
+        Records metrics of a finished task.
+        """
+
+        system = result['system'] or 'unknown'
+        metrics.inc('mos_compute_tasks_total', system=system, status=result['status'],
+                    help='Tasks run, by modeling system and model status')
+        if result['status'] == 'error':
+            metrics.inc('mos_compute_task_failures_total', system=system,
+                        help='Failed tasks, by modeling system')
+        metrics.observe('mos_compute_task_seconds', result['elapsed'], system=system,
+                        help='Task run time, by modeling system')
+        if result['wait'] is not None:
+            metrics.observe('mos_compute_queue_wait_seconds', max(result['wait'], 0.),
+                            system=system,
+                            help='Time from queuing to start of tasks, by modeling system')
+        for phase, seconds in result['timings'].items():
+            metrics.observe('mos_compute_phase_seconds', seconds, system=system, phase=phase,
+                            help='Time spent in each phase of tasks, by modeling system')
+        for name, counts in result['caches'].items():
+            metrics.inc('mos_compute_cache_hits_total', counts['hits'], cache=name,
+                        help='Cache hits of tasks, by cache')
+            metrics.inc('mos_compute_cache_misses_total', counts['misses'], cache=name,
+                        help='Cache misses of tasks, by cache')
+
+    def killed(task, start, error):
+        """
+        Reports a task killed for going over its limits as a model error,
+        which is final: the task is not retried.
+        """
+
+        print("Task killed: %s" %error)
+        tasks.cleanup(error.pid)
+        system = tasks.model_status(task['model_id'],
+                                    task['model_name'],
+                                    task['caller_id'],
+                                    'error',
+                                    'Task killed: %s' %error)
+        metrics.inc('mos_compute_tasks_killed_total', system=system or 'unknown', limit=error.limit,
+                    help='Tasks killed for going over their limits, by modeling system and limit')
+        record(dict(system=system,
+                    status='error',
+                    wait=None,
+                    elapsed=time.perf_counter()-start,
+                    timings={},
+                    caches={}))
+
+    def dropped(task, start, error):
+        """
+        Reports a task cancelled before it could report itself, either
+        still queued or killed after ignoring cancellation.
+        """
+
+        print("Task cancelled")
+        if getattr(error, 'pid', None) is not None:
+            tasks.cleanup(error.pid)
+        system = tasks.model_status(task['model_id'],
+                                    task['model_name'],
+                                    task['caller_id'],
+                                    'cancelled',
+                                    'Run cancelled')
+        record(dict(system=system,
+                    status='cancelled',
+                    wait=None,
+                    elapsed=time.perf_counter()-start,
+                    timings={},
+                    caches={}))
+
+    def done(method, properties, body, task, start, future):
+        metrics.add('mos_compute_tasks_running', -1)
+        active.pop(method.delivery_tag, None)
+
+        # Tasks dropped while queued are done on the connection thread,
+        # so they are reported from another one
+        args = (method, properties, body, task, start, future)
+        if future.cancelled():
+            threading.Thread(target=finish, args=args, daemon=True).start()
+        else:
+            finish(*args)
+
+    def finish(method, properties, body, task, start, future):
+        try:
+            try:
+                result = future.result()
+            except TaskKilled as e:
+                killed(task, start, e)
+            except (CancelledError, TaskCancelled) as e:
+                dropped(task, start, e)
+            else:
+                print("Task done")
+                record(result)
+            handler = functools.partial(ack, method.delivery_tag)
+        except Exception:
+            traceback.print_exc()
+            print("Task failed")
+            metrics.inc('mos_compute_tasks_total', system='unknown', status='failed',
+                        help='Tasks run, by modeling system and model status')
+            metrics.inc('mos_compute_task_failures_total', system='unknown',
+                        help='Failed tasks, by modeling system')
+            handler = functools.partial(retry, method, properties, body)
+        connection.add_callback_threadsafe(handler)
 
     def callback(ch, method, properties, body):
-        body = json.loads(body)
-        print("Task received %r" %body)
-        tasks.model_run(body['model_id'],
-                        body['model_name'],
-                        body['caller_id'])
-        print("Task done")  
+
+        # Delivered before to a consumer that died without acking
+        if method.redelivered:
+            print("Task redelivered")
+            retry(method, properties, body)
+            return
+
+        task = json.loads(body)
+        print("Task received %r" %task)
+        queued_at = published_at(properties) or time.time()
+        future = executor.submit(tasks.model_run,
+                                 task['model_id'],
+                                 task['model_name'],
+                                 task['caller_id'],
+                                 queued_at,
+                                 priority=properties.priority or 0,
+                                 key=task['caller_id'])
+        active[method.delivery_tag] = (task['model_id'], queued_at, future)
+        metrics.inc('mos_compute_tasks_received_total',
+                    help='Tasks received')
+        metrics.add('mos_compute_tasks_running', 1,
+                    help='Tasks submitted and not finished')
+        future.add_done_callback(functools.partial(done, method, properties, body,
+                                                   task, time.perf_counter()))
+
+        # Cancelled while waiting in the broker queue
+        if queued_at < cancelled.get(task['model_id'], -1):
+            executor.cancel(future)
+
+    def cancel(ch, method, properties, body):
+        """
+        Cancels tasks of a model queued before the cancellation, whether
+        running, waiting for an execution slot or, for tasks published with
+        a timestamp, still in the broker queue. Tasks published in the same
+        instant, e.g. in the same second for whole-second timestamps, are
+        kept, so that a model can be run again right after cancelling it.
+        """
+
+        msg = json.loads(body)
+        print("Cancellation received %r" %msg)
+        model_id = msg['model_id']
+        cancelled_at = msg.get('cancelled_at') or published_at(properties) or time.time()
+
+        # Forget cancellations older than a day
+        for key, t in list(cancelled.items()):
+            if t < cancelled_at-86400:
+                del cancelled[key]
+        cancelled[model_id] = max(cancelled_at, cancelled.get(model_id, -1))
+
+        for tag, (task_model_id, queued_at, future) in list(active.items()):
+            if task_model_id == model_id and queued_at < cancelled_at:
+                executor.cancel(future)
 
     print('Consuming messages ...')
-    channel.basic_consume(queue='mos-python', on_message_callback=callback, auto_ack=True)
-    channel.start_consuming()
+    for queue in queues:
+        channel.basic_consume(queue=queue, on_message_callback=callback)
+    channel.basic_consume(queue=cancel_queue, on_message_callback=cancel, auto_ack=True)
+    try:
+        channel.start_consuming()
+    finally:
+        executor.shutdown(wait=True)
 
 if __name__ == '__main__':
 